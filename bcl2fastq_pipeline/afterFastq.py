@@ -1,7 +1,7 @@
 '''
 This file includes code that actually runs FastQC and any other tools after the fastq files have actually been made. This uses a pool of workers to process each request.
 '''
-import multiprocessing as mp
+import concurrent.futures
 import glob
 import sys
 import subprocess
@@ -19,32 +19,26 @@ import matplotlib.pyplot as plt
 import matplotlib.image as img
 import yaml
 import json
+import zipfile
 import re
 import datetime as dt
 import flowcell_manager.flowcell_manager as fm
 import configmaker.configmaker as cm
 import pandas as pd
+from bcl2fastq_pipeline.scheduler import slot
+import bcl2fastq_pipeline.instruments as instruments
+import bcl2fastq_pipeline.checksum as checksum
+import bcl2fastq_pipeline.stages as stages
+import bcl2fastq_pipeline.dag as dag
+import bcl2fastq_pipeline.splitFastq as splitFastq
+import bcl2fastq_pipeline.stream as stream
+import bcl2fastq_pipeline.versions as versions
+import bcl2fastq_pipeline.interop as interop
+import bcl2fastq_pipeline.manifest as manifest
+import bcl2fastq_pipeline.runMetadata as runMetadata
 
 localConfig = None
 
-SEQUENCERS = {
-        'NB501038' : 'NextSeq 500',
-        'SN7001334' : 'HiSeq 2500',
-        'K00251' : 'HiSeq 4000',
-        'M02675' : 'MiSeq NTNU',
-        'M03942' : 'MiSeq StOlav',
-        'M05617' : 'MiSeq SINTEF'
-        }
-
-SEQUENCER_OUTPUTFOLDER = {
-        'NB501038' : 'nextseq',
-        'SN7001334' : 'hiseq2500',
-        'K00251' : 'hiseq',
-        'M02675' : 'miseq',
-        'M03942' : 'miseq',
-        'M05617' : 'miseq'
-}
-
 QC_PLACEMENT = {
     'External_ID': 0,
     'Sample_Biosource': 10,
@@ -64,6 +58,22 @@ def bgzip_worker(fname) :
     syslog.syslog("[bgzip_worker] Running %s\n" % cmd)
     subprocess.check_call(cmd, shell=True)
 
+def clumpify_finish(config, ifiles, ofiles, dfiles, dupFile):
+    '''
+    Move the output of splitFastq() (written to .tmp files) in place. The
+    duplicate.txt.tmp written last by clumpify_worker() marks that it's
+    complete, so this can also be rerun if it was interrupted. The clumped
+    files are only removed at the end.
+    '''
+    for f in dfiles + ofiles + [dupFile]:
+        if os.path.exists("{}.tmp".format(f)):
+            os.replace("{}.tmp".format(f), f)
+            if f in dfiles:
+                manifest.add(config, f)
+    for f in ifiles:
+        if os.path.exists(f):
+            os.remove(f)
+
 def clumpify_worker(fname):
     global localConfig
     config = localConfig
@@ -79,11 +89,22 @@ def clumpify_worker(fname):
         return
 
     r1 = fname
+    dupFile = r1.replace("R1.fastq.gz", "duplicate.txt")
+    if os.path.exists(dupFile):
+        return None
     r2 = fname.replace("R1.fastq.gz","R2.fastq.gz") if os.path.exists(fname.replace("R1.fastq.gz","R2.fastq.gz")) else None
+    out_r1 = r1.replace(".fastq.gz","_clumped.fastq.gz")
+    out_r2 = r2.replace(".fastq.gz","_clumped.fastq.gz") if r2 else None
+
+    ifiles = [out_r1, out_r2] if r2 else [out_r1]
+    ofiles = [r1, r2] if r2 else [r1]
+    dfiles = [f.replace(".fastq.gz", "_optical_duplicates.fastq.gz") for f in ofiles]
+    #Moving the files in place was interrupted, the output itself is complete
+    if os.path.exists("{}.tmp".format(dupFile)):
+        clumpify_finish(config, ifiles, ofiles, dfiles, dupFile)
+        return None
 
     if r2:
-        out_r1 = r1.replace(".fastq.gz","_clumped.fastq.gz") 
-        out_r2 = r2.replace(".fastq.gz","_clumped.fastq.gz")
         cmd = "{clump_cmd} {clump_opts} in1={in1} in2={in2} out1={out1} out2={out2} rcomp=f rename=f overwrite=true".format(
                 clump_cmd = config.get("clumpify","clumpify_cmd"),
                 clump_opts = config.get("clumpify", "clumpify_opts"),
@@ -93,7 +114,6 @@ def clumpify_worker(fname):
                 out2 = out_r2
                 )
     else:
-        out_r1 = r1.replace(".fastq.gz","_clumped.fastq.gz") 
         cmd = "{clump_cmd} {clump_opts} in={in1} out={out1} rename=f overwrite=true".format(
                 clump_cmd = config.get("clumpify","clumpify_cmd"),
                 clump_opts = config.get("clumpify", "clumpify_opts"),
@@ -102,22 +122,79 @@ def clumpify_worker(fname):
                 )
     syslog.syslog("[clumpify_worker] Processing %s\n" % cmd)
     subprocess.check_call(cmd, shell=True)
-    os.rename(out_r1,r1)
-    if r2:
-        os.rename(out_r2,r2)
+
+    if "markduplicates=t" not in config.get("clumpify", "clumpify_opts"):
+        os.rename(out_r1,r1)
+        if r2:
+            os.rename(out_r2,r2)
+        return None
+
+    #Move the reads clumpify marked as duplicates to their own files, the
+    #originals are only replaced once that's finished
+    tmp = lambda files: ["{}.tmp".format(f) for f in files]
+    dupes, total = splitFastq.splitFastq(ifiles, tmp(ofiles), tmp(dfiles), threads=config.getint("clumpify", "splitFastqThreads", fallback=4))
+    with open("{}.tmp".format(dupFile), "w") as f:
+        f.write("{}\t{}\n".format(dupes, total))
+    clumpify_finish(config, ifiles, ofiles, dfiles, dupFile)
+    return dupes, total
+
+def parse_memory(s):
+    '''
+    Convert something like 20g or 2000M (as given to java -Xmx) to bytes
+    '''
+    m = re.match(r'^\s*([0-9.]+)\s*([kKmMgGtT]?)[bB]?\s*$', s)
+    if not m:
+        raise Exception("Couldn't parse the memory size {}\n".format(s))
+    return int(float(m.group(1)) * 1024**' kmgt'.index(m.group(2).lower() or ' '))
+
+def decon_instances(config):
+    '''
+    The number of bbmap instances that fit in [MaskedGenomes] memory, given the
+    -Xmx in bbmap_opts (bbmap needs that much to hold the index). Without an
+    -Xmx bbmap takes most of the memory, so only one instance is run.
+    '''
+    xmx = re.search(r'-Xmx(\S+)', config.get("MaskedGenomes","bbmap_opts"))
+    if not xmx:
+        return 1
+    budget = config.get("MaskedGenomes","memory",fallback="")
+    if budget:
+        budget = parse_memory(budget)
+    else:
+        #Leave a quarter of the machine for everything else
+        budget = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 3 // 4
+    return max(1, budget // parse_memory(xmx.group(1)))
+
+def decon_threads(config):
+    '''
+    The threads given to each bbmap instance: the CPUs divided over the
+    instances that may run at once. None if bbmap_opts already sets t=.
+    '''
+    if re.search(r'(^|\s)(t|threads)=', config.get("MaskedGenomes","bbmap_opts")):
+        return None
+    instances = min(decon_instances(config), int(config.get("Options","postMakeThreads")))
+    return max(1, (os.cpu_count() or 1) // instances)
 
 def RemoveHumanReads_worker(fname):
+    '''
+    Remove reads mapping to the masked human genome. This is given R1 of a
+    pair (or a single end file) and writes the clean and contaminated reads of
+    both mates to temporary files. contaminated/.<R1>.mapped then marks that
+    mapping finished, while the output is moved in place. Once it's removed,
+    contaminated/R1 marks that the sample is done.
+    '''
     global localConfig
     config = localConfig
 
     #We use R1 files to construct R2 filenames for paired end
-    if "R2.fastq.gz" in fname:
+    if "R2.fastq.gz" in fname and os.path.exists(fname.replace("R2.fastq.gz","R1.fastq.gz")):
         return
 
-    if os.path.exists(fname.replace(os.path.basename(fname),"contaminated/{}".format(os.path.basename(fname)))):
+    contaminated = lambda f: os.path.join(os.path.dirname(f), "contaminated", os.path.basename(f))
+    mapped = os.path.join(os.path.dirname(fname), "contaminated", ".{}.mapped".format(os.path.basename(fname)))
+    if os.path.exists(contaminated(fname)) and not os.path.exists(mapped):
         return
 
-    r2 = fname.replace("R1.fastq.gz","R2.fastq.gz") if os.path.exists(fname.replace("R1.fastq.gz","R2.fastq.gz")) else None
+    r2 = fname.replace("R1.fastq.gz","R2.fastq.gz") if "R1.fastq.gz" in fname and os.path.exists(fname.replace("R1.fastq.gz","R2.fastq.gz")) else None
 
     masked_path = config.get("MaskedGenomes","HGDir")
     if not masked_path:
@@ -128,89 +205,112 @@ def RemoveHumanReads_worker(fname):
     
     os.makedirs("{}/contaminated/".format(os.path.dirname(fname)),exist_ok=True)
 
+    #Everything is written to temporary files first, bbmap can't write over its input
+    files = [fname, r2] if r2 else [fname]
+    tmp_clean = [os.path.join(os.path.dirname(f), "contaminated", "tmp_clean_{}".format(os.path.basename(f))) for f in files]
+    tmp_cont = [os.path.join(os.path.dirname(f), "contaminated", "tmp_{}".format(os.path.basename(f))) for f in files]
+
+    #Moving the output in place was interrupted, mapping the clean reads again would lose the contaminated ones
+    if os.path.exists(mapped):
+        RemoveHumanReads_finish(config, files, tmp_clean, tmp_cont, contaminated, mapped)
+        return
+
+    cmd = "{bbmap_cmd} {bbmap_opts} path={masked_path} in={infile} outu={clean_out} outm={contaminated_out}".format(
+            bbmap_cmd = config.get("MaskedGenomes","bbmap_cmd"),
+            bbmap_opts = config.get("MaskedGenomes","bbmap_opts"),
+            masked_path = config.get("MaskedGenomes","HGDir"),
+            infile = fname,
+            clean_out = tmp_clean[0],
+            contaminated_out = tmp_cont[0]
+            )
+    #Otherwise each bbmap uses every core
+    threads = decon_threads(config)
+    if threads:
+        cmd += " t={}".format(threads)
     if r2:
-        cont_out = fname.replace(os.path.basename(fname),"contaminated/{}".format(os.path.basename(fname).replace("R1.fastq.gz","interleaved.fastq.gz")))
-        cmd = "{bbmap_cmd} {bbmap_opts} path={masked_path} in={infile} in2={infile2} outu={clean_out} outm={contaminated_out}".format(
-                bbmap_cmd = config.get("MaskedGenomes","bbmap_cmd"),
-                bbmap_opts = config.get("MaskedGenomes","bbmap_opts"),
-                masked_path = config.get("MaskedGenomes","HGDir"),
-                infile = fname,
+        cmd += " in2={infile2} outu2={clean_out2} outm2={contaminated_out2}".format(
                 infile2 = r2,
-                clean_out = fname.replace("R1.fastq.gz","interleaved.fastq.gz"),
-                contaminated_out = cont_out 
-                )
-    else:   
-        cmd = "{bbmap_cmd} {bbmap_opts} path={masked_path} in={infile} outu={clean_out} outm={contaminated_out}".format(
-                bbmap_cmd = config.get("MaskedGenomes","bbmap_cmd"),
-                bbmap_opts = config.get("MaskedGenomes","bbmap_opts"),
-                masked_path = config.get("MaskedGenomes","HGDir"),
-                infile = fname,
-                clean_out = fname,
-                contaminated_out = fname.replace(os.path.basename(fname),"contaminated/{}".format(os.path.basename(fname)))
+                clean_out2 = tmp_clean[1],
+                contaminated_out2 = tmp_cont[1]
                 )
 
     syslog.syslog("[RemoveHumanReads_worker] Processing %s\n" % cmd)
-    subprocess.check_call(cmd, shell=True)
-    # clean up
-    os.remove(fname)
-    if r2:
-        os.remove(r2)
-        #If paired end, split interleaved files to R1 and R2
-        cmd = "{rename_cmd} {rename_opts} in={interleaved} out1={out_r1} out2={out_r2}".format(
-                rename_cmd = "rename.sh",
-                rename_opts = "renamebymapping=t",
-                interleaved = fname.replace("R1.fastq.gz","interleaved.fastq.gz"),
-                out_r1 = fname,
-                out_r2 = r2
-                )
-        syslog.syslog("[RemoveHumanReads_worker] De-interleaving %s\n" % cmd)
-        subprocess.check_call(cmd, shell=True)
-        os.remove(fname.replace("R1.fastq.gz","interleaved.fastq.gz"))
-        #De-interleave contaminated file
-        cmd = "{rename_cmd} {rename_opts} in={interleaved} out1={out_r1} out2={out_r2}".format(
-                rename_cmd = "rename.sh",
-                rename_opts = "renamebymapping=t",
-                interleaved = cont_out,
-                out_r1 = cont_out.replace("interleaved.fastq.gz","R1.fastq.gz"),
-                out_r2 = cont_out.replace("interleaved.fastq.gz","R2.fastq.gz")
-                )
-        syslog.syslog("[RemoveHumanReads_worker] De-interleaving %s\n" % cmd)
-        subprocess.check_call(cmd, shell=True)
-        os.remove(cont_out)
-
-
-def fastq_screen_worker(fname) :
-    global localConfig
-    config = localConfig
+    with stages.stage(config, "RemoveHumanReads", fname):
+        stages.check_call(cmd, shell=True)
+    open(mapped, "w").close()
+    RemoveHumanReads_finish(config, files, tmp_clean, tmp_cont, contaminated, mapped)
 
-    os.chdir(os.path.dirname(fname))
+def RemoveHumanReads_finish(config, files, tmp_clean, tmp_cont, contaminated, mapped):
+    '''
+    Move the output of RemoveHumanReads_worker() in place, skipping what was
+    already moved, and then remove the mapped marker
+    '''
+    for tmp, f in zip(tmp_clean, files):
+        if os.path.exists(tmp):
+            os.replace(tmp, f)
+    for tmp, f in reversed(list(zip(tmp_cont, files))):
+        if os.path.exists(tmp):
+            os.replace(tmp, contaminated(f))
+            manifest.add(config, contaminated(f))
+    os.remove(mapped)
 
-    project_nr = get_gcf_name(fname)
 
+def screen_subsample(config, fname):
+    '''
+    The (uncompressed) subsample of fname that fastq_screen is run on, or None
+    if fastq_screen doesn't need to be run on fname
+    '''
     #Skip read 1 when single cell
     if config.get("Options","SingleCell") == '1' and ("R1.fastq" in fname or "R1_001.fastq" in fname):
-        return
+        return None
 
     ofile="{}/{}/QC_{}/fastq_screen/{}".format(
             os.path.join(config.get("Paths","outputDir")),
             config.get("Options","runID"),
-            project_nr,
+            get_gcf_name(fname),
             os.path.basename(fname)
             )
 
     if os.path.exists(ofile.replace(".fastq.gz","_screen.html")) :
+        return None
+    return ofile.replace(".fastq.gz", ".fastq")
+
+def screen_sampler(config, subsample):
+    '''
+    The reservoir sampler producing subsample. All files use the same seed,
+    so the same pairs are kept in R1 and R2.
+    '''
+    return stream.SampleConsumer(subsample,
+                                 config.getint("fastq_screen", "seqtk_size", fallback=1000000),
+                                 config.getint("fastq_screen", "seed", fallback=123456))
+
+def fastq_screen_worker(fname) :
+    global localConfig
+    config = localConfig
+
+    os.chdir(os.path.dirname(fname))
+
+    subsample = screen_subsample(config, fname)
+    if subsample is None:
         return
-    
-    os.makedirs(os.path.dirname(ofile), exist_ok=True)
-    
+
+    os.makedirs(os.path.dirname(subsample), exist_ok=True)
+
+    #The subsample is normally made by FastQC_worker, while it reads the file anyway
+    if not os.path.exists(subsample):
+        with stages.stage(config, "subsample", fname):
+            stream.tee(fname, [screen_sampler(config, subsample)])
+
     #fastq_screen
     cmd = "%s %s --outdir '%s' '%s'" % (
         config.get("fastq_screen", "fastq_screen_command"),
         config.get("fastq_screen", "fastq_screen_options"),
-        os.path.dirname(ofile),
-        fname)
+        os.path.dirname(subsample),
+        subsample)
     syslog.syslog("[fastq_screen_worker] Running %s\n" % cmd)
-    subprocess.check_call(cmd, shell=True)
+    with slot("fastqScreen"), stages.stage(config, "fastq_screen", fname):
+        stages.check_call(cmd, shell=True)
+    os.remove(subsample)
 
     #Unlink/rename
     #os.unlink(ofile)
@@ -289,16 +389,35 @@ def FastQC_worker(fname) :
           os.path.basename(fname).replace(".fastq.gz","_fastqc.zip")
           )))
 
-    if fastqc_fname:
-        return
-
-    os.makedirs("%s/%s%s/QC_%s/FASTQC" % (config.get("Paths","outputDir"),
+    odir = "%s/%s%s/QC_%s/FASTQC" % (config.get("Paths","outputDir"),
           config.get("Options","runID"),
           lanes,
-          projectName), exist_ok=True)
+          projectName)
+    os.makedirs(odir, exist_ok=True)
+
+    #The native QC, the md5sum and the fastq_screen subsample are made from a single read of the file
+    native = config.get("FastQC", "engine", fallback="native") == "native"
+    consumers = []
+    if native and not fastqc_fname:
+        consumers.append(stream.QCConsumer(fname, odir))
+    cache = md5_cache(config)
+    if checksum.cachedDigest(cache, fname) is None:
+        consumers.append(stream.MD5Consumer(fname, cache))
+    subsample = screen_subsample(config, fname)
+    if subsample and not os.path.exists(subsample):
+        os.makedirs(os.path.dirname(subsample), exist_ok=True)
+        consumers.append(screen_sampler(config, subsample))
+    if consumers:
+        syslog.syslog("[FastQC_worker] Reading %s for %s\n" % (fname, ", ".join(type(c).__name__ for c in consumers)))
+        with stages.stage(config, "FastQC", fname):
+            stream.tee(fname, consumers)
+
+    if native or fastqc_fname:
+        return
 
     syslog.syslog("[FastQC_worker] Running %s\n" % cmd)
-    subprocess.check_call(cmd, shell=True)
+    with stages.stage(config, "FastQC", fname):
+        stages.check_call(cmd, shell=True)
 
 def toDirs(files) :
     s = set()
@@ -311,51 +430,46 @@ def toDirs(files) :
     return s
 
 
-def get_read_geometry(run_dir):
-    stats_file = open('{}/Stats/Stats.json'.format(run_dir),'r')
-    stats_json = json.load(stats_file)
-    lane_info = stats_json['ReadInfosForLanes'][0].get('ReadInfos', None)
-    if not lane_info:
-        return 'Read geometry could not be automatically determined.'
-    R1 = None
-    R2 = None
-    for read in lane_info:
-        if read['IsIndexedRead'] == True:
-            continue
-        elif read['Number'] == 1:
-            R1 = int(read['NumCycles'])
-        elif read['Number'] == 2:
-            R2 = int(read['NumCycles'])
-    if R1 and R2:
-        return 'Paired end - forward read length (R1): {}, reverse read length (R2): {}'.format(R1,R2)
-    elif R1 and not R2:
-        return 'Single end - read length (R1): {}'.format(R1)
-    elif not R1 and not R2:
-        return 'Read geometry could not be automatically determined.'
-
-def get_sequencer(run_id):
-	return SEQUENCERS.get(run_id.split('_')[1],'Sequencer could not be automatically determined.')
-
-def get_sequencer_outputfolder(run_id):
-	return SEQUENCER_OUTPUTFOLDER.get(run_id.split('_')[1],'Sequencer could not be automatically determined.')
+def get_read_geometry(config):
+    return runMetadata.get(config).readGeometry()
+
+def get_sequencer(config):
+    instrument = instruments.getInstrument(config)
+    return instrument.name if instrument else 'Sequencer could not be automatically determined.'
+
+def get_sequencer_outputfolder(config):
+    instrument = instruments.getInstrument(config)
+    return instrument.outputFolder if instrument else 'Sequencer could not be automatically determined.'
+
+def md5_cache(config):
+    '''
+    Where the md5sums of fastq files computed by FastQC_worker are kept
+    '''
+    return os.path.join(stages.stageDir(config), "md5cache.jsonl")
+
+def md5sum_project(config, p, threads=None):
+    '''
+    Write md5sum_{p}_fastq.txt, unless it already exists. The paths are
+    relative to the flow cell directory, as with md5sum. threads defaults
+    to [Options] md5Threads.
+    '''
+    flowdir = os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'))
+    ofile = os.path.join(flowdir, 'md5sum_{}_fastq.txt'.format(p))
+    if os.path.exists(ofile):
+        return
+    syslog.syslog("[md5sum_worker] Processing %s\n" % os.path.join(flowdir, p))
+    fnames = checksum.findFiles(os.path.join(flowdir, p), '.fastq.gz')
+    with stages.stage(config, "md5", p):
+        entries = checksum.md5Files(fnames, threads or config.getint("Options","md5Threads",fallback=5), cache=md5_cache(config))
+    checksum.writeManifest(ofile, [(os.path.relpath(f, flowdir), digest) for f, digest in entries])
 
 def md5sum_worker(config):
     global localConfig
     config = localConfig
-    old_wd = os.getcwd()
-    os.chdir(os.path.join(config.get('Paths','outputDir'), config.get('Options','runID')))
     project_dirs = get_project_dirs(config)
     pnames = get_project_names(project_dirs)
     for p in pnames:
-        if os.path.exists('md5sum_{}_fastq.txt'.format(p)):
-            continue
-        cmd = "find {} -type f -name '*.fastq.gz' | parallel -j 5 md5sum > {}".format(
-            p,
-            'md5sum_{}_fastq.txt'.format(p)
-        )
-        syslog.syslog("[md5sum_worker] Processing %s\n" % os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),p))
-        subprocess.check_call(cmd, shell=True)
-    os.chdir(old_wd)
+        md5sum_project(config, p)
 
 def md5sum_archive_worker(config):
     global localConfig
@@ -367,9 +481,8 @@ def md5sum_archive_worker(config):
     for p in pnames:
         if os.path.exists('md5sum_{}_archive.txt'.format(p)):
             continue
-        cmd = "md5sum {p}.7za > md5sum_{p}_archive.txt".format(p=p)
         syslog.syslog("[md5sum_worker] Processing %s\n" % os.path.join(config.get('Paths','outputDir'), config.get('Options','runID')))
-        subprocess.check_call(cmd, shell=True)
+        checksum.writeManifest('md5sum_{}_archive.txt'.format(p), [('{}.7za'.format(p), checksum.md5File('{}.7za'.format(p)))])
     os.chdir(old_wd)
 
 def md5sum_instrument_worker(config):
@@ -381,17 +494,16 @@ def md5sum_instrument_worker(config):
     if os.path.exists('md5sum_{}.txt'.format(config.get('Options','runID'))):
         os.chdir(old_wd)
         return
-    cmd = "md5sum {r}.7za > md5sum_{r}.txt".format(r=config.get('Options','runID'))
     syslog.syslog("[md5sum_worker] Processing %s\n" % os.path.join(config.get('Paths','archiveInstr'), config.get('Options','runID')))
-    subprocess.check_call(cmd, shell=True)
+    checksum.writeManifest('md5sum_{}.txt'.format(config.get('Options','runID')), [('{}.7za'.format(config.get('Options','runID')), checksum.md5File('{}.7za'.format(config.get('Options','runID'))))])
 
     os.chdir(old_wd)
 
 def set_mqc_conf_header(config, mqc_conf, seq_stats=False):
     odir = os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'))
-    read_geometry = get_read_geometry(odir)
+    read_geometry = get_read_geometry(config)
     contact = config.get('MultiQC','report_contact')
-    sequencer = get_sequencer(config.get('Options','runID'))
+    sequencer = get_sequencer(config)
     prepkit = config.get('Options','Libprep')
     organism = config.get('Options','Organism')
 
@@ -489,53 +601,149 @@ def multiqc_worker(d) :
     in_conf.close()
     out_conf.close()
 
-    cmd = "{multiqc_cmd} {multiqc_opts} --config {conf} {flow_dir}/QC_{pname} {flow_dir}/{pname} --filename {flow_dir}/QC_{pname}/multiqc_{pname}.html".format(
+    #MultiQC reads a mirror of the project's QC files, see multiqc_stage()
+    flow_dir = os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'))
+    stage_dir = os.path.join(stages.stageDir(config), ".multiqc_{}".format(pname))
+    cmd = "{multiqc_cmd} {multiqc_opts} --config {conf} {stage_dir} --filename {flow_dir}/QC_{pname}/multiqc_{pname}.html".format(
             multiqc_cmd = config.get("MultiQC", "multiqc_command"),
             multiqc_opts = config.get("MultiQC", "multiqc_options"),
             conf = conf_name,
-            flow_dir = os.path.join(config.get('Paths','outputDir'), config.get('Options','runID')),
+            stage_dir = stage_dir,
+            flow_dir = flow_dir,
             pname=pname,
             )
+    #Skip MultiQC if none of its inputs (nor the command or its config) changed since the report was made
+    report = "{}/QC_{}/multiqc_{}.html".format(flow_dir, pname, pname)
+    cache = os.path.join(stages.stageDir(config), ".multiqc_{}.json".format(pname))
+    inputs = multiqc_inputs(flow_dir, pname)
+    with open(conf_name) as f:
+        signature = {'cmd': cmd, 'config': f.read(), 'inputs': inputs}
+    try:
+        with open(cache) as f:
+            unchanged = json.load(f) == signature and os.path.exists(report)
+    except (OSError, ValueError):
+        unchanged = False
+    if unchanged:
+        syslog.syslog("[multiqc_worker] %s is up to date\n" % report)
+        os.chdir(oldWd)
+        return
+
     syslog.syslog("[multiqc_worker] Processing %s\n" % d)
-    subprocess.check_call(cmd, shell=True)
+    with stages.stage(config, "multiqc", pname):
+        multiqc_stage(flow_dir, stage_dir, inputs)
+        stages.check_call(cmd, shell=True)
+    with open("{}.tmp".format(cache), "w") as f:
+        json.dump(signature, f)
+    os.replace("{}.tmp".format(cache), cache)
     os.chdir(oldWd)
 
+def multiqc_inputs(flow_dir, pname):
+    '''
+    {path: [mtime, size]} of the files MultiQC searches for a project, except
+    for its own output
+    '''
+    own = ["multiqc_{}.html".format(pname), "multiqc_{}_data".format(pname), ".multiqc_config.yaml"]
+    inputs = {}
+    todo = [os.path.join(flow_dir, "QC_{}".format(pname)), os.path.join(flow_dir, pname)]
+    while todo:
+        try:
+            entries = list(os.scandir(todo.pop()))
+        except OSError:
+            continue
+        for e in entries:
+            if e.name in own:
+                continue
+            if e.is_dir(follow_symlinks=False):
+                todo.append(e.path)
+            else:
+                st = e.stat()
+                inputs[e.path] = [st.st_mtime_ns, st.st_size]
+    return inputs
+
+def multiqc_stage(flow_dir, stage_dir, inputs):
+    '''
+    Mirror the MultiQC inputs ({path: [mtime, size]}) of a project in
+    stage_dir, so MultiQC only reads small text files. Each FastQC zip is
+    replaced by the fastqc_data.txt it holds, which is only extracted again
+    if the zip changed. Everything else is symlinked and fastq files are
+    left out. stage_dir/.index.json holds the signature each staged file was
+    made from, so a rerun only touches the inputs that changed.
+    '''
+    index_file = os.path.join(stage_dir, ".index.json")
+    try:
+        with open(index_file) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+
+    staged = {}
+    for path, sig in inputs.items():
+        if path.endswith(".fastq.gz"):
+            continue
+        rel = os.path.relpath(path, flow_dir)
+        if path.endswith("_fastqc.zip"):
+            staged[path] = os.path.join(stage_dir, rel[:-len(".zip")], "fastqc_data.txt")
+        else:
+            staged[path] = os.path.join(stage_dir, rel)
+
+    for path, sig in index.items():
+        if path not in staged and os.path.lexists(sig['staged']):
+            os.remove(sig['staged'])
+
+    new_index = {}
+    for path, dest in staged.items():
+        old = index.get(path)
+        new_index[path] = {'inputs': inputs[path], 'staged': dest}
+        if old == new_index[path] and os.path.lexists(dest):
+            continue
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.lexists(dest):
+            os.remove(dest)
+        if path.endswith("_fastqc.zip"):
+            with zipfile.ZipFile(path) as z:
+                member = [n for n in z.namelist() if n.endswith("/fastqc_data.txt")][0]
+                with z.open(member) as src, open("{}.tmp".format(dest), "wb") as o:
+                    shutil.copyfileobj(src, o)
+            os.replace("{}.tmp".format(dest), dest)
+        else:
+            os.symlink(path, dest)
+
+    with open("{}.tmp".format(index_file), "w") as f:
+        json.dump(new_index, f)
+    os.replace("{}.tmp".format(index_file), index_file)
+
 def multiqc_stats(project_dirs) :
     global localConfig
     config = localConfig
     oldWd = os.getcwd()
     os.chdir(os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),'Stats'))
 
-    shutil.copyfile(
-        os.path.join(config.get("Paths","baseDir"),config.get("Options","sequencer"),'data',config.get('Options','runID'),'RunInfo.xml'),
-        os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),'RunInfo.xml'),
-        )
-    #Illumina sequencer update - RunParameters.xml -> runParameters.xml
-    if os.path.isfile(os.path.join(config.get("Paths","baseDir"),config.get("Options","sequencer"),'data',config.get('Options','runID'),'RunParameters.xml')):
-        shutil.copyfile(
-            os.path.join(config.get("Paths","baseDir"),config.get("Options","sequencer"),'data',config.get('Options','runID'),'RunParameters.xml'),
-            os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),'RunParameters.xml'),
-            )
-    else:
-        shutil.copyfile(
-            os.path.join(config.get("Paths","baseDir"),config.get("Options","sequencer"),'data',config.get('Options','runID'),'runParameters.xml'),
-            os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),'RunParameters.xml'),
-            )
+    meta = runMetadata.get(config)
+    runDir = meta.runDir
+    flowDir = os.path.join(config.get("Paths","outputDir"),config.get("Options","runID"))
+    shutil.copyfile(os.path.join(runDir,'RunInfo.xml'), os.path.join(flowDir,'RunInfo.xml'))
+    #Illumina sequencer update - RunParameters.xml -> runParameters.xml, the copy is always RunParameters.xml
+    shutil.copyfile(meta.parametersFile or os.path.join(runDir,'RunParameters.xml'), os.path.join(flowDir,'RunParameters.xml'))
 
     #Illumina interop
-    cmd = "interop_summary {} --csv=1 > {}".format(
-            os.path.join(config.get("Paths","baseDir"),config.get("Options","sequencer"),'data',config.get("Options","runID")),
-            os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),'Stats','interop_summary.csv'),
-        )
-    syslog.syslog("[multiqc_worker] Interop summary on %s\n" % os.path.join(config.get("Paths","baseDir"),config.get("Options","sequencer"),'data',config.get("Options","runID")))
-    subprocess.check_call(cmd,shell=True)
-    
-    cmd = "interop_index-summary {} --csv=1 > {}".format(
-            os.path.join(config.get("Paths","outputDir"),config.get("Options","runID")),
-            os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),'Stats','interop_index-summary.csv'),
-        )
-    syslog.syslog("[multiqc_worker] Interop index summary on %s\n" % os.path.join(config.get("Paths","baseDir"),config.get("Options","sequencer"),'data',config.get("Options","runID")))
-    subprocess.check_call(cmd,shell=True)
+    summaryCSV = os.path.join(flowDir,'Stats','interop_summary.csv')
+    indexCSV = os.path.join(flowDir,'Stats','interop_index-summary.csv')
+    native = config.get("InterOp","engine",fallback="native") == "native"
+    if native:
+        try:
+            interop.writeSummary(runDir, summaryCSV)
+            interop.writeIndexSummary(flowDir, indexCSV)
+        except (interop.InterOpError, OSError, ValueError) as e:
+            syslog.syslog("[multiqc_worker] Falling back to interop_summary for %s (%s)\n" % (runDir, e))
+            native = False
+    if not native:
+        cmd = "interop_summary {} --csv=1 > {}".format(runDir, summaryCSV)
+        syslog.syslog("[multiqc_worker] Interop summary on %s\n" % runDir)
+        subprocess.check_call(cmd,shell=True)
+
+        cmd = "interop_index-summary {} --csv=1 > {}".format(flowDir, indexCSV)
+        syslog.syslog("[multiqc_worker] Interop index summary on %s\n" % flowDir)
+        subprocess.check_call(cmd,shell=True)
 
     conf_name = "{}/{}/Stats/.multiqc_config.yaml".format(config.get('Paths','outputDir'), config.get('Options','runID'))
     in_conf = open("/config/multiqc_config.yaml","r")
@@ -563,30 +771,49 @@ def multiqc_stats(project_dirs) :
     subprocess.check_call(cmd, shell=True)
     os.chdir(oldWd)
 
+def archive_project(config, p, mmt=None):
+    '''
+    Zip (and md5sum) a single project. mmt is the number of threads 7za may use.
+    '''
+    if os.path.exists(os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),'{}.7za'.format(p))):
+        os.remove(os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),'{}.7za'.format(p)))
+    pw = None
+    if config.get("Options","SensitiveData") == "1":
+        pw = subprocess.check_output("xkcdpass -n 5 -d '-' -v '[a-z]'",shell=True).decode().strip('\n')
+        with open(os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),"encryption.{}".format(p)),'w') as pwfile:
+            pwfile.write('{}\n'.format(pw))
+    opts = "-p{}".format(pw) if pw else ""
+    if mmt:
+        opts += " -mmt={}".format(mmt)
+    #The fastq files are hashed just before they're zipped, so 7za reads them from the page cache.
+    #This uses the same share of [Archive] threads as 7za, it happens before 7za starts.
+    md5sum_project(config, p, min(config.getint("Options","md5Threads",fallback=5), mmt) if mmt else None)
+    cmd = "7za a {opts} {flowdir}/{pnr}.7za {flowdir}/{pnr}/ {flowdir}/QC_{pnr} {flowdir}/Stats {flowdir}/Undetermined*.fastq.gz {flowdir}/{pnr}_samplesheet.tsv {flowdir}/SampleSheet.csv {flowdir}/Sample-Submission-Form.xlsx {flowdir}/md5sum_{pnr}_fastq.txt {flowdir}/software.versions".format(
+            opts = opts,
+            flowdir = os.path.join(config.get('Paths','outputDir'), config.get('Options','runID')),
+            pnr = p
+            )
+    if config.get("Options","singleCell") == "1":
+        cmd += " {}".format(os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),config.get("Options","runID").split("_")[-1][1:]))
+    syslog.syslog("[archive_worker] Zipping %s\n" % os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),'{}.7za'.format(p)))
+    with stages.stage(config, "archive", p):
+        stages.check_call(cmd, shell=True)
+    #Hash the archive right away, while it's still in the page cache
+    archive = os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),'{}.7za'.format(p))
+    with stages.stage(config, "md5", archive):
+        checksum.writeManifest(
+            os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),'md5sum_{}_archive.txt'.format(p)),
+            [('{}.7za'.format(p), checksum.md5File(archive))]
+            )
+
 def archive_worker(config):
     project_dirs = get_project_dirs(config)
     pnames = get_project_names(project_dirs)
 
     for p in pnames:
-        if os.path.exists(os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),'{}.7za'.format(p))):
-            os.remove(os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),'{}.7za'.format(p)))
-        pw = None
-        if config.get("Options","SensitiveData") == "1":
-            pw = subprocess.check_output("xkcdpass -n 5 -d '-' -v '[a-z]'",shell=True).decode().strip('\n')
-            with open(os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),"encryption.{}".format(p)),'w') as pwfile:
-                pwfile.write('{}\n'.format(pw))
-        opts = "-p{}".format(pw) if pw else ""
-        cmd = "7za a {opts} {flowdir}/{pnr}.7za {flowdir}/{pnr}/ {flowdir}/QC_{pnr} {flowdir}/Stats {flowdir}/Undetermined*.fastq.gz {flowdir}/{pnr}_samplesheet.tsv {flowdir}/SampleSheet.csv {flowdir}/Sample-Submission-Form.xlsx {flowdir}/md5sum_{pnr}_fastq.txt {flowdir}/software.versions".format(
-                opts = opts,
-                flowdir = os.path.join(config.get('Paths','outputDir'), config.get('Options','runID')),
-                pnr = p
-            )
-        if config.get("Options","singleCell") == "1":
-            cmd += " {}".format(os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),config.get("Options","runID").split("_")[-1][1:]))
-        syslog.syslog("[archive_worker] Zipping %s\n" % os.path.join(config.get('Paths','outputDir'), config.get('Options','runID'),'{}.7za'.format(p)))
-        subprocess.check_call(cmd, shell=True)
+        archive_project(config, p)
 
-def instrument_archive_worker(config):
+def instrument_archive_worker(config, mmt=None):
     if not os.path.exists(os.path.join(config.get('Paths','archiveInstr'), config.get('Options','runID'))):
         os.makedirs(os.path.join(config.get('Paths','archiveInstr'), config.get('Options','runID')),exist_ok=True)
     if os.path.exists(os.path.join(config.get('Paths','archiveInstr'), config.get('Options','runID'), '{}.7za'.format(config.get('Options','runID')))):
@@ -597,7 +824,9 @@ def instrument_archive_worker(config):
         with open(os.path.join(config.get('Paths','archiveInstr'), config.get('Options','runID'),"encryption.{}".format(config.get('Options','runID'))),'w') as pwfile:
             pwfile.write('{}\n'.format(pw))
     opts = "-p{}".format(pw) if pw else ""
-    seq_out = get_sequencer_outputfolder(config.get('Options','runID'))
+    if mmt:
+        opts += " -mmt={}".format(mmt)
+    seq_out = get_sequencer_outputfolder(config)
     cmd = "7za a {opts} {arch_dir}/{fnm}.7za {instr}".format(
             opts = opts,
             arch_dir = os.path.join(config.get('Paths','archiveInstr'), config.get('Options','runID')),
@@ -605,7 +834,15 @@ def instrument_archive_worker(config):
             instr = os.path.join(config.get('Paths','baseDir'), seq_out,"data",config.get('Options','runID'))
         )
     syslog.syslog("[instrument_archive_worker] Zipping instruments." )
-    subprocess.check_call(cmd, shell=True)
+    with stages.stage(config, "archive", config.get('Options','runID')):
+        stages.check_call(cmd, shell=True)
+    #Hash the archive right away, while it's still in the page cache
+    archive = os.path.join(config.get('Paths','archiveInstr'), config.get('Options','runID'), '{}.7za'.format(config.get('Options','runID')))
+    with stages.stage(config, "md5", archive):
+        checksum.writeManifest(
+            os.path.join(config.get('Paths','archiveInstr'), config.get('Options','runID'), 'md5sum_{}.txt'.format(config.get('Options','runID'))),
+            [('{}.7za'.format(config.get('Options','runID')), checksum.md5File(archive))]
+            )
     
 
 def samplesheet_worker(config,project_dirs):
@@ -656,6 +893,18 @@ def samplesheet_worker(config,project_dirs):
             )
 
 
+def samplesheet_task(project_dirs):
+    config = localConfig
+    with stages.stage(config, "samplesheet"):
+        samplesheet_worker(config, project_dirs)
+
+
+def multiqc_stats_task(project_dirs):
+    config = localConfig
+    with stages.stage(config, "multiqc_stats"):
+        multiqc_stats(project_dirs)
+
+
 def clumpify_mark_done(config):
     global localConfig
     config = localConfig
@@ -670,24 +919,22 @@ def get_project_names(dirs):
     return gcf
 
 def get_project_dirs(config):
-    projectDirs = glob.glob("%s/%s/*/*.fastq.gz" % (config.get("Paths","outputDir"), config.get("Options","runID")))
-    projectDirs.extend(glob.glob("%s/%s/*/*/*.fastq.gz" % (config.get("Paths","outputDir"), config.get("Options","runID"))))
-    return toDirs(projectDirs)
+    return manifest.get(config).projectDirs()
 
 def get_software_versions(config):
-    versions = {}
-    versions['GCF-NTNU bcl2fastq pipeline'] = subprocess.check_output("cat /bfq_version/bfq.version",shell=True).rstrip()
-    if config.get("Options","SingleCell") == "1":
-        subprocess.check_output("cellranger mkfastq --version",stderr=subprocess.STDOUT,shell=True).split(b'\n')[1].split(b' ')[-1].rstrip().strip(b'(').strip(b')')
-    else:
-        versions['bcl2fastq'] = subprocess.check_output("bcl2fastq --version",stderr=subprocess.STDOUT,shell=True).split(b'\n')[1].split(b' ')[1].rstrip()
-        versions['fastq_screen'] = subprocess.check_output("fastq_screen --version",shell=True).split(b' ')[-1].rstrip()
-    versions['FastQC'] = subprocess.check_output("fastqc --version",shell=True).split(b' ')[-1].rstrip()
-    versions['clumpify/bbmap'] = subprocess.check_output("clumpify.sh --version",stderr=subprocess.STDOUT,shell=True).split(b'\n')[1].split(b' ')[-1].rstrip()
-    versions['multiqc'] = subprocess.check_output("multiqc --version",stderr=subprocess.STDOUT,shell=True).split(b' ')[-1].rstrip()
-    software = '\n'.join('{}: {}'.format(key,val.decode()) for (key,val) in versions.items())
-    with open(os.path.join(config.get("Paths","outputDir"),config.get("Options","runID"),"software.versions"),'w+') as sf:
+    '''
+    The software versions used for this flow cell, as text. They're resolved
+    once (see versions.py) by postMakeSteps() and written to software.versions,
+    which the multiqc workers then only read.
+    '''
+    fname = os.path.join(config.get("Paths","outputDir"),config.get("Options","runID"),"software.versions")
+    if os.path.exists(fname):
+        with open(fname) as sf:
+            return sf.read()
+    software = versions.asText(versions.getVersions(config))
+    with open("{}.tmp".format(fname),'w+') as sf:
         sf.write(software)
+    os.replace("{}.tmp".format(fname), fname)
     return software
 
 
@@ -700,18 +947,11 @@ def postMakeSteps(config) :
     Other steps could easily be added to follow those. Note that this function
     will try to use a pool of threads. The size of the pool is set by config.postMakeThreads
     '''
-    lanes = config.get("Options", "lanes")
-    if lanes != "":
-        lanes = "_lanes{}".format(lanes)
-
-    projectDirs = get_project_dirs(config)
-    sampleFiles = glob.glob("%s/%s%s/*/*R[12].fastq.gz" % (config.get("Paths","outputDir"),config.get("Options","runID"), lanes))
-    sampleFiles.extend(glob.glob("%s/%s%s/*/*/*R[12].fastq.gz" % (config.get("Paths","outputDir"),config.get("Options","runID"), lanes)))
-    sampleFiles.extend(glob.glob("%s/%s%s/*/*R[12]_001.fastq.gz" % (config.get("Paths","outputDir"),config.get("Options","runID"), lanes)))
-    sampleFiles.extend(glob.glob("%s/%s%s/*/*/*R[12]_001.fastq.gz" % (config.get("Paths","outputDir"),config.get("Options","runID"), lanes)))
-
-    sampleFiles = [sf for sf in sampleFiles if not 'contaminated' in sf]
-    sampleFiles = [sf for sf in sampleFiles if not 'filtered' in sf]
+    #The clean R1/R2 files, without the contaminated/filtered ones. A rerun
+    #after an interruption may find that files in the manifest were moved.
+    runManifest = manifest.check(config)
+    projectDirs = runManifest.projectDirs()
+    sampleFiles = runManifest.fastqs()
 
     global localConfig
     localConfig = config
@@ -724,12 +964,25 @@ def postMakeSteps(config) :
     p.close()
     p.join()
     """
-    #Decontaminate with masked genome
-    if config.get("Options","RemoveHumanReads") == "1":
-        p = mp.Pool(int(1))
-        p.map(RemoveHumanReads_worker, sampleFiles)
-        p.close()
-        p.join()
+    #Decontaminate with masked genome, then FastQC and fastq_screen on each file and multiqc
+    #on each project as soon as its files are done. See dag.py.
+    decon = config.get("Options","RemoveHumanReads") == "1"
+    limits = {
+        'decon': decon_instances(config) if decon else 1,
+        'FastQC': int(config.get("Options","fastqcThreads")),
+        'fastq_screen': int(config.get("Options","fastqScreenThreads")),
+        'multiqc': int(config.get("Options","postMakeThreads")),
+        'samplesheet': 1,
+    }
+    graph = dag.DAG(limits)
+    deconKeys = []
+    if decon:
+        for fname in sampleFiles:
+            #The R1 task rewrites both files of a pair
+            if "R2.fastq.gz" in fname and fname.replace("R2.fastq.gz","R1.fastq.gz") in sampleFiles:
+                continue
+            graph.add(("decon", fname), "decon", RemoveHumanReads_worker, (fname,))
+            deconKeys.append(("decon", fname))
 
     #clumpify
     """
@@ -739,31 +992,33 @@ def postMakeSteps(config) :
     p.join()
     clumpify_mark_done(config)
     """
-    #FastQC
 
-    p = mp.Pool(int(config.get("Options","fastqcThreads")))
-    p.map(FastQC_worker, sampleFiles)
-    p.close()
-    p.join()
+    projectTasks = {d: [] for d in projectDirs}
+    for fname in sampleFiles:
+        deps = []
+        if decon:
+            r1 = fname.replace("R2.fastq.gz","R1.fastq.gz")
+            deps = [("decon", r1 if ("decon", r1) in deconKeys else fname)]
+        graph.add(("FastQC", fname), "FastQC", FastQC_worker, (fname,), deps)
+        #fastq_screen runs on the subsample made by FastQC_worker
+        graph.add(("fastq_screen", fname), "fastq_screen", fastq_screen_worker, (fname,), [("FastQC", fname)])
+        for d in toDirs([fname]):
+            if d in projectTasks:
+                projectTasks[d].extend([("FastQC", fname), ("fastq_screen", fname)])
 
+    #customer_samplesheet, once the fastq files are final
+    graph.add("samplesheet", "samplesheet", samplesheet_task, (projectDirs,), deconKeys)
 
-    #fastq_screen
-    p = mp.Pool(int(config.get("Options", "fastqScreenThreads")))
-    p.map(fastq_screen_worker, sampleFiles)
-    p.close()
-    p.join()
+    for d, deps in projectTasks.items():
+        graph.add(("multiqc", d), "multiqc", multiqc_worker, (d,), deps + ["samplesheet"])
 
-    #customer_samplesheet
-    samplesheet_worker(config,projectDirs)
+    # multiqc_stats, this only needs the sequencer's output
+    graph.add("multiqc_stats", "multiqc", multiqc_stats_task, (projectDirs,))
 
-    # multiqc
-    p = mp.Pool(int(config.get("Options","postMakeThreads")))
-    p.map(multiqc_worker, projectDirs)
-    p.close()
-    p.join()
+    #Resolve the software versions once, rather than in each multiqc worker
+    get_software_versions(config)
 
-    # multiqc_stats
-    multiqc_stats(projectDirs)
+    graph.run(int(config.get("Options","postMakeThreads")))
 
     #disk usage
     (tot,used,free) = shutil.disk_usage(config.get("Paths","outputDir"))
@@ -795,16 +1050,29 @@ def postMakeSteps(config) :
 
     return(message)
 
+def archive_budget(config, ntasks):
+    '''
+    Returns the number of 7za processes to run at once and the number of
+    threads each of them may use, given [Archive] threads and jobs. The
+    fastq files of a project are hashed with at most that many threads too.
+    '''
+    threads = config.getint("Archive","threads",fallback=int(config.get("Options","postMakeThreads")))
+    jobs = min(config.getint("Archive","jobs",fallback=3), ntasks, threads)
+    jobs = max(1, jobs)
+    return jobs, max(1, threads // jobs)
+
 def finalize(config):
-    #md5sum fastqs
-    md5sum_worker(config)
-    #zip arhive
-    archive_worker(config)
-    #md5sum archive
-    md5sum_archive_worker(config)
-    #archive instruments
-    instrument_archive_worker(config)
-    #md5sum instrument
+    pnames = sorted(get_project_names(get_project_dirs(config)))
+    jobs, mmt = archive_budget(config, len(pnames) + 1)
+    syslog.syslog("[finalize] Archiving {} projects, {} at a time with {} threads each\n".format(len(pnames), jobs, mmt))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        #The instrument archive is the largest, so it's started first
+        futures = [pool.submit(instrument_archive_worker, config, mmt)]
+        #md5sum fastqs, zip and md5sum the archives
+        futures.extend(pool.submit(archive_project, config, p, mmt) for p in pnames)
+    for f in futures:
+        f.result()
+    #In case the instrument archive was already there
     md5sum_instrument_worker(config)
 
     return None
@@ -0,0 +1,151 @@
+'''
+This file contains the checksum engine used when finalizing a flow cell. It
+replaces the md5sum (and GNU parallel) subprocesses.
+
+Files are read sequentially in large blocks, with several files hashed at
+once in a thread pool (hashlib releases the GIL while hashing). The output
+matches that of md5sum, so the md5sum_*.txt files can still be checked with
+`md5sum -c`.
+'''
+import hashlib
+import json
+import os
+import concurrent.futures
+
+#Large reads keep the number of system calls down on network storage
+BUFSIZE = 16*1024*1024
+
+
+def md5File(fname, bufsize=BUFSIZE):
+    '''
+    Return the hex MD5 digest of a file
+    '''
+    h = hashlib.md5()
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    with open(fname, "rb", buffering=0) as f:
+        try:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def rememberDigest(cache, fname, digest):
+    '''
+    Record the digest of fname in cache (a JSON lines file), e.g., after it was
+    computed while the file was read for something else. Like stages.jsonl,
+    this is safe from several processes at once.
+    '''
+    st = os.stat(fname)
+    record = {'path': os.path.abspath(fname), 'size': st.st_size, 'mtime': st.st_mtime_ns, 'md5': digest}
+    with open(cache, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def _records(cache):
+    '''
+    The records in cache, the last one of each path
+    '''
+    found = {}
+    try:
+        with open(cache) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    found[record['path']] = record
+                except (ValueError, KeyError):
+                    continue
+    except OSError:
+        return {}
+    return found
+
+
+def _unchanged(record):
+    try:
+        st = os.stat(record['path'])
+    except OSError:
+        return False
+    return st.st_size == record['size'] and st.st_mtime_ns == record['mtime']
+
+
+def cachedDigests(cache, fnames=None):
+    '''
+    Returns {path: digest} for the files in cache (only those in fnames, if
+    given) that haven't changed since
+    '''
+    found = _records(cache)
+    if fnames is not None:
+        paths = set(os.path.abspath(f) for f in fnames)
+        found = {path: record for path, record in found.items() if path in paths}
+    return {path: record['md5'] for path, record in found.items() if _unchanged(record)}
+
+
+def cachedDigest(cache, fname):
+    '''
+    The digest of fname in cache, or None if it's not there or fname changed
+    since. Only fname is stat()ed.
+    '''
+    path = os.path.abspath(fname)
+    needle = json.dumps(path)
+    record = None
+    try:
+        with open(cache) as f:
+            for line in f:
+                #Most lines are about other files, don't parse those
+                if needle not in line:
+                    continue
+                try:
+                    r = json.loads(line)
+                except ValueError:
+                    continue
+                if r.get('path') == path:
+                    record = r
+    except OSError:
+        return None
+    if record is None or not _unchanged(record):
+        return None
+    return record['md5']
+
+
+def md5Files(fnames, threads=4, cache=None):
+    '''
+    Hash several files at once, returning a list of (fname, digest) in the
+    same order as fnames. Digests found in cache (see rememberDigest()) are
+    used rather than reading the file again.
+    '''
+    fnames = list(fnames)
+    known = cachedDigests(cache, fnames) if cache else {}
+    todo = [f for f in fnames if os.path.abspath(f) not in known]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        known.update(zip([os.path.abspath(f) for f in todo], pool.map(md5File, todo)))
+    return [(f, known[os.path.abspath(f)]) for f in fnames]
+
+
+def writeManifest(ofile, entries):
+    '''
+    Write (fname, digest) pairs in md5sum format. The file is only moved into
+    place once it's complete, so a partial manifest is never left behind.
+    '''
+    tmp = "{}.tmp".format(ofile)
+    with open(tmp, "w") as f:
+        for fname, digest in entries:
+            f.write("{}  {}\n".format(digest, fname))
+    os.replace(tmp, ofile)
+
+
+def findFiles(d, suffix):
+    '''
+    The equivalent of `find d -type f -name '*suffix'`, sorted
+    '''
+    found = []
+    for root, dirs, files in os.walk(d):
+        for f in files:
+            if f.endswith(suffix):
+                found.append(os.path.join(root, f))
+    return sorted(found)
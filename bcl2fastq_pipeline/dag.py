@@ -0,0 +1,99 @@
+'''
+This file contains a small dependency graph executor, used by postMakeSteps()
+so that each fastq file moves on to its next step as soon as it's ready,
+rather than waiting for every other file to finish the current step.
+
+Each task names a resource and the tasks it depends on. Tasks are run in a
+single multiprocessing pool and at most limits[resource] tasks of a resource
+run at once. For example:
+
+    dag = DAG({'FastQC': 4, 'multiqc': 2})
+    dag.add(("FastQC", f), "FastQC", FastQC_worker, (f,))
+    dag.add(("multiqc", d), "multiqc", multiqc_worker, (d,), deps=[("FastQC", f)])
+    dag.run(processes=8)
+
+If a task fails, the tasks depending on it are skipped, everything else is
+still run (the steps skip output that already exists, so they pick up where
+they left off next time) and the first error is then raised.
+'''
+import multiprocessing as mp
+import queue
+import syslog
+
+
+class DAG:
+    def __init__(self, limits):
+        self.limits = dict(limits)
+        self.tasks = {}
+        self.order = []
+
+    def add(self, key, resource, func, args=(), deps=()):
+        '''
+        Add a task. key must be unique and is what other tasks list in deps.
+        func and args must be picklable, as they are run in a pool worker.
+        '''
+        if key in self.tasks:
+            raise Exception("Task {} was added twice\n".format(key))
+        self.tasks[key] = {'resource': resource, 'func': func, 'args': args, 'deps': set(deps)}
+        self.order.append(key)
+
+    def run(self, processes):
+        for key in self.order:
+            missing = self.tasks[key]['deps'] - set(self.tasks)
+            if missing:
+                raise Exception("Task {} depends on unknown tasks {}\n".format(key, missing))
+
+        pending = list(self.order)
+        running = {}
+        done = set()
+        failed = set()
+        errors = []
+        inUse = {r: 0 for r in self.limits}
+        finished = queue.Queue()
+
+        p = mp.Pool(processes)
+        try:
+            while pending or running:
+                #Skip whatever can no longer run, including what depends on skipped tasks
+                skip = [k for k in pending if self.tasks[k]['deps'] & failed]
+                while skip:
+                    for key in skip:
+                        syslog.syslog("[DAG] Skipping {}, since a step it depends on failed\n".format(key))
+                        pending.remove(key)
+                        failed.add(key)
+                    skip = [k for k in pending if self.tasks[k]['deps'] & failed]
+
+                for key in list(pending):
+                    task = self.tasks[key]
+                    r = task['resource']
+                    if not task['deps'] <= done or inUse.get(r, 0) >= self.limits.get(r, 1):
+                        continue
+                    pending.remove(key)
+                    inUse[r] = inUse.get(r, 0) + 1
+                    running[key] = p.apply_async(
+                        task['func'], task['args'],
+                        callback=lambda x, key=key: finished.put((key, None)),
+                        error_callback=lambda e, key=key: finished.put((key, e)))
+
+                if not running:
+                    if pending and errors:
+                        raise errors[0]
+                    if pending:
+                        raise Exception("Tasks {} can never run, check their dependencies\n".format(pending))
+                    break
+
+                key, e = finished.get()
+                del running[key]
+                inUse[self.tasks[key]['resource']] -= 1
+                if e is None:
+                    done.add(key)
+                else:
+                    syslog.syslog("[DAG] {} failed: {}\n".format(key, e))
+                    failed.add(key)
+                    errors.append(e)
+        finally:
+            p.close()
+            p.join()
+
+        if errors:
+            raise errors[0]
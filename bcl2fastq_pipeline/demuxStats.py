@@ -0,0 +1,216 @@
+'''
+This file reads the demultiplexing statistics written by bcl2fastq into two
+compact tables:
+
+    lanes, samples = demuxStats.stats(config)
+
+lanes has a row per lane with the raw and PF clusters ("Clusters" and
+"Clusters PF"), the clusters that were demultiplexed ("Demultiplexed",
+including those with undetermined indices) and "Undetermined", followed by
+"Yield R<n>", "Yield Q30 R<n>" and "Quality Sum R<n>" for each read.
+samples has a row per lane and sample with its Project, Sample, Barcode,
+Clusters (PF), Yield and Yield Q30 (summed over its reads).
+
+Stats/Stats.json is used when it exists. Otherwise ConversionStats.xml and
+DemultiplexingStats.xml are streamed with iterparse, clearing each element
+once it's counted. ConversionStats.xml has an entry per sample and tile, so it
+can be hundreds of MB on a patterned flow cell and isn't loaded as a whole.
+
+The tables are cached in Stats/demux_stats.json, so the email, the PDFs and
+whatever else needs them only parse the statistics once.
+'''
+import collections
+import json
+import os
+import xml.etree.ElementTree as ET
+import pandas as pd
+from bcl2fastq_pipeline.preflight import readSampleSheet
+
+SAMPLE_COLUMNS = ["Lane", "Project", "Sample", "Barcode", "Clusters", "Yield", "Yield Q30"]
+LANE_COLUMNS = ["Lane", "Clusters", "Clusters PF", "Demultiplexed", "Undetermined"]
+#(ReadMetrics key in Stats.json, element in ConversionStats.xml, column)
+READ_METRICS = [("Yield", "Yield", "Yield"),
+                ("YieldQ30", "YieldQ30", "Yield Q30"),
+                ("QualityScoreSum", "QualityScoreSum", "Quality Sum")]
+
+
+def statsDir(config):
+    lanes = config.get("Options", "lanes")
+    if lanes != "":
+        lanes = "_lanes{}".format(lanes)
+    return os.path.join(config.get("Paths", "outputDir"), "{}{}".format(config.get("Options", "runID"), lanes), "Stats")
+
+
+def _newLane():
+    return {'Clusters': 0, 'Clusters PF': 0, 'Demultiplexed': 0, 'Undetermined': 0,
+            'reads': collections.defaultdict(lambda: [0, 0, 0])}
+
+
+def _tables(lanes, samples):
+    '''
+    The DataFrames for {lane: _newLane()} and {(lane, project, sample): [barcode, clusters, yield, yieldQ30]}
+    '''
+    readNumbers = sorted(set(r for l in lanes.values() for r in l['reads']))
+    rows = []
+    for lane in sorted(lanes):
+        l = lanes[lane]
+        row = [lane, l['Clusters'], l['Clusters PF'], l['Demultiplexed'], l['Undetermined']]
+        for r in readNumbers:
+            row.extend(l['reads'][r])
+        rows.append(row)
+    columns = LANE_COLUMNS + ["{} R{}".format(m[2], r) for r in readNumbers for m in READ_METRICS]
+    lanesDF = pd.DataFrame(rows, columns=columns)
+    samplesDF = pd.DataFrame([list(k) + v for k, v in sorted(samples.items(), key=lambda x: x[0][0])],
+                             columns=SAMPLE_COLUMNS)
+    return lanesDF, samplesDF
+
+
+def fromJSON(fname, projects=None):
+    '''
+    The tables from Stats.json. This doesn't include the projects, which
+    are looked up in projects ({sample ID: project}) if that's given.
+    '''
+    with open(fname) as f:
+        js = json.load(f)
+    projects = projects or {}
+    lanes = {}
+    samples = {}
+    for result in js.get("ConversionResults", []):
+        lane = int(result["LaneNumber"])
+        l = lanes.setdefault(lane, _newLane())
+        l['Clusters'] += int(result.get("TotalClustersRaw", 0))
+        l['Clusters PF'] += int(result.get("TotalClustersPF", 0))
+        undetermined = result.get("Undetermined") or {}
+        l['Undetermined'] += int(undetermined.get("NumberReads", 0))
+        l['Demultiplexed'] += int(undetermined.get("NumberReads", 0))
+        for demux in result.get("DemuxResults", []) + [undetermined]:
+            for read in demux.get("ReadMetrics", []):
+                metrics = l['reads'][int(read["ReadNumber"])]
+                for i, (key, tag, column) in enumerate(READ_METRICS):
+                    metrics[i] += int(read.get(key, 0))
+        for demux in result.get("DemuxResults", []):
+            l['Demultiplexed'] += int(demux.get("NumberReads", 0))
+            sid = demux.get("SampleId", "")
+            barcode = "+".join(m.get("IndexSequence", "") for m in demux.get("IndexMetrics", []))
+            key = (lane, projects.get(sid, ""), sid)
+            s = samples.setdefault(key, [barcode, 0, 0, 0])
+            s[1] += int(demux.get("NumberReads", 0))
+            s[2] += sum(int(r.get("Yield", 0)) for r in demux.get("ReadMetrics", []))
+            s[3] += sum(int(r.get("YieldQ30", 0)) for r in demux.get("ReadMetrics", []))
+    return _tables(lanes, samples)
+
+
+def _iterparse(fname, tag):
+    '''
+    Yield (project, sample, barcode, lane, element) for each "tag" element,
+    clearing elements once they're done
+    '''
+    names = {"Project": None, "Sample": None, "Barcode": None, "Lane": None}
+    for event, elem in ET.iterparse(fname, events=("start", "end")):
+        if event == "start":
+            if elem.tag in names:
+                names[elem.tag] = elem.get("number" if elem.tag == "Lane" else "name")
+            continue
+        if elem.tag == tag:
+            yield names["Project"], names["Sample"], names["Barcode"], int(names["Lane"]), elem
+        if elem.tag == tag or elem.tag in names:
+            elem.clear()
+
+
+def _int(elem, path):
+    found = elem.find(path)
+    return int(found.text) if found is not None and found.text else 0
+
+
+def fromXML(conversion, demultiplexing):
+    '''
+    The tables from ConversionStats.xml and DemultiplexingStats.xml
+    '''
+    lanes = collections.defaultdict(_newLane)
+    samples = {}
+    for project, sample, barcode, lane, elem in _iterparse(conversion, "Tile"):
+        if project == "all" and sample == "all" and barcode == "all":
+            l = lanes[lane]
+            l['Clusters'] += _int(elem, "Raw/ClusterCount")
+            l['Clusters PF'] += _int(elem, "Pf/ClusterCount")
+            for read in elem.findall("Pf/Read"):
+                metrics = l['reads'][int(read.get("number"))]
+                for i, (key, tag, column) in enumerate(READ_METRICS):
+                    metrics[i] += _int(read, tag)
+        elif project not in ["all", "default"] and sample != "all":
+            s = samples.setdefault((lane, project, sample), ["", 0, 0, 0])
+            if barcode != "all":
+                s[0] = barcode
+                continue
+            s[1] += _int(elem, "Pf/ClusterCount")
+            for read in elem.findall("Pf/Read"):
+                s[2] += _int(read, "Yield")
+                s[3] += _int(read, "YieldQ30")
+
+    for project, sample, barcode, lane, elem in _iterparse(demultiplexing, "Lane"):
+        if sample != "all" or barcode != "all":
+            continue
+        if project == "all":
+            lanes[lane]['Demultiplexed'] += _int(elem, "BarcodeCount")
+        elif project == "default":
+            lanes[lane]['Undetermined'] += _int(elem, "BarcodeCount")
+    return _tables(lanes, samples)
+
+
+def projectsFromSampleSheet(ss):
+    '''
+    {Sample_ID: Sample_Project} from a sample sheet
+    '''
+    try:
+        lines, start, rows = readSampleSheet(ss)
+    except OSError:
+        return {}
+    return {r.get("Sample_ID", ""): r.get("Sample_Project", "") for r in rows}
+
+
+def _sources(d):
+    '''
+    The statistics files in d that would be used and their sizes and modification times
+    '''
+    names = ["Stats.json"]
+    if not os.path.exists(os.path.join(d, "Stats.json")):
+        names = ["ConversionStats.xml", "DemultiplexingStats.xml"]
+    sources = []
+    for name in names:
+        st = os.stat(os.path.join(d, name))
+        sources.append([name, st.st_size, st.st_mtime_ns])
+    return sources
+
+
+def stats(config):
+    '''
+    (lanes, samples) for the flow cell, see above. Raises OSError if
+    bcl2fastq didn't write any statistics.
+    '''
+    d = statsDir(config)
+    sources = _sources(d)
+    cache = os.path.join(d, "demux_stats.json")
+    try:
+        with open(cache) as f:
+            cached = json.load(f)
+        if cached['sources'] == sources:
+            return (pd.DataFrame(cached['lanes'], columns=cached['laneColumns']),
+                    pd.DataFrame(cached['samples'], columns=SAMPLE_COLUMNS))
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if sources[0][0] == "Stats.json":
+        lanes, samples = fromJSON(os.path.join(d, "Stats.json"), projectsFromSampleSheet(config.get("Options", "sampleSheet")))
+    else:
+        lanes, samples = fromXML(os.path.join(d, "ConversionStats.xml"), os.path.join(d, "DemultiplexingStats.xml"))
+
+    try:
+        with open("{}.tmp".format(cache), "w") as f:
+            json.dump({'sources': sources,
+                       'laneColumns': list(lanes.columns),
+                       'lanes': lanes.values.tolist(),
+                       'samples': samples.values.tolist()}, f)
+        os.replace("{}.tmp".format(cache), cache)
+    except OSError:
+        pass
+    return lanes, samples
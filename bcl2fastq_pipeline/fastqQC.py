@@ -0,0 +1,393 @@
+'''
+This file contains a native replacement for running FastQC on each fastq
+file. Starting a JVM per file, and decompressing every file a second time for
+fastq_screen, dominates on small runs and wastes cores on large ones.
+
+fastqc() reads a fastq.gz file once (inflated in a background thread, see
+splitFastq.readChunks()) and updates the statistics with NumPy one block of
+records at a time. The output is a FastQC-compatible <name>_fastqc.zip
+(holding <name>_fastqc/fastqc_data.txt and summary.txt) plus
+<name>_fastqc.html, so MultiQC reads it like FastQC's own output.
+
+The modules are those of FastQC with --nogroup (one row per base), except
+Per tile sequence quality and the contaminant search for overrepresented
+sequences, which are left out. The pass/warn/fail thresholds are FastQC's
+defaults. Like FastQC, duplication and overrepresented sequences only track
+the first 100,000 distinct sequences, truncated to 50 bases if longer than 75.
+'''
+import collections
+import concurrent.futures
+import html
+import io
+import math
+import os
+import zipfile
+import numpy as np
+from bcl2fastq_pipeline.splitFastq import readChunks, lineBlocks
+
+VERSION = "0.11.9"
+
+#Qualities are phred+33, capped at 93
+MAXQUAL = 94
+
+DUPLICATE_LIMIT = 100000
+
+ADAPTERS = [
+    ("Illumina Universal Adapter", b"AGATCGGAAGAG"),
+    ("Illumina Small RNA 3' Adapter", b"TGGAATTCTCGG"),
+    ("Illumina Small RNA 5' Adapter", b"GATCGTCGGACT"),
+    ("Nextera Transposase Sequence", b"CTGTCTCTTATA"),
+    ("SOLID Small RNA Adapter", b"CGCCTTGGCCGT"),
+]
+
+#A, C, G, T, everything else is an N
+BASES = np.full(256, 4, dtype=np.int64)
+for i, b in enumerate(b"ACGT"):
+    BASES[b] = i
+    BASES[b + 32] = i
+
+
+class FastqStats:
+    '''
+    The running totals for one fastq file
+    '''
+    def __init__(self):
+        self.total = 0
+        self.quals = np.zeros((0, MAXQUAL), dtype=np.int64)
+        self.bases = np.zeros((0, 5), dtype=np.int64)
+        self.lengths = np.zeros(0, dtype=np.int64)
+        self.meanQuals = np.zeros(MAXQUAL, dtype=np.int64)
+        self.gc = np.zeros(101, dtype=np.int64)
+        self.adapters = np.zeros((len(ADAPTERS), 0), dtype=np.int64)
+        self.seqs = collections.Counter()
+        self.countAtLimit = 0
+
+    def _grow(self, maxlen):
+        if maxlen <= len(self.bases):
+            return
+        pad = maxlen - len(self.bases)
+        self.quals = np.vstack([self.quals, np.zeros((pad, MAXQUAL), dtype=np.int64)])
+        self.bases = np.vstack([self.bases, np.zeros((pad, 5), dtype=np.int64)])
+        self.adapters = np.hstack([self.adapters, np.zeros((len(ADAPTERS), pad), dtype=np.int64)])
+
+    def add(self, lines):
+        '''
+        Add the records in lines (a list of fastq lines, a multiple of 4 long)
+        '''
+        seqs = lines[1::4]
+        quals = lines[3::4]
+        n = len(seqs)
+        if n == 0:
+            return
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=n)
+        if not np.array_equal(lengths, np.fromiter(map(len, quals), dtype=np.int64, count=n)):
+            raise ValueError("A sequence and its qualities differ in length\n")
+        maxlen = int(lengths.max())
+        self._grow(maxlen)
+        self.total += n
+        self.lengths = np.pad(self.lengths, (0, max(0, maxlen + 1 - len(self.lengths))))
+        self.lengths[:maxlen + 1] += np.bincount(lengths, minlength=maxlen + 1)
+
+        seq = np.frombuffer(b"".join(seqs), dtype=np.uint8)
+        qual = np.frombuffer(b"".join(quals), dtype=np.uint8).astype(np.int64) - 33
+        if len(qual) and (qual.min() < 0 or qual.max() >= MAXQUAL):
+            raise ValueError("Qualities aren't phred+33\n")
+        starts = np.cumsum(lengths) - lengths
+        pos = np.arange(len(seq), dtype=np.int64) - np.repeat(starts, lengths)
+        base = BASES[seq]
+
+        #Per position
+        L = len(self.bases)
+        self.quals += np.bincount(pos * MAXQUAL + qual, minlength=L * MAXQUAL).reshape(L, MAXQUAL)
+        self.bases += np.bincount(pos * 5 + base, minlength=L * 5).reshape(L, 5)
+
+        #Per read, skipping empty reads
+        nonEmpty = lengths > 0
+        s = starts[nonEmpty]
+        lens = lengths[nonEmpty]
+        if len(s):
+            qsum = np.add.reduceat(qual, s)
+            self.meanQuals += np.bincount(qsum // lens, minlength=MAXQUAL)[:MAXQUAL]
+            gc = np.add.reduceat(((base == 1) | (base == 2)).astype(np.int64), s)
+            called = np.add.reduceat((base < 4).astype(np.int64), s)
+            ok = called > 0
+            pct = np.rint(100 * gc[ok] / called[ok]).astype(np.int64)
+            self.gc += np.bincount(pct, minlength=101)
+
+        #Adapters, the first hit in each read. Reads are separated by newlines so
+        #a hit can't span two reads.
+        joined = b"\n".join(seqs)
+        jstarts = starts + np.arange(n)
+        for i, (_, adapter) in enumerate(ADAPTERS):
+            hits = []
+            idx = joined.find(adapter)
+            while idx >= 0:
+                hits.append(idx)
+                idx = joined.find(adapter, idx + 1)
+            if not hits:
+                continue
+            hits = np.array(hits, dtype=np.int64)
+            rows = np.searchsorted(jstarts, hits, side="right") - 1
+            rows, first = np.unique(rows, return_index=True)
+            self.adapters[i] += np.bincount(hits[first] - jstarts[rows], minlength=L)[:L]
+
+        #Duplication, counting only the first DUPLICATE_LIMIT distinct sequences
+        counts = collections.Counter(x[:50] if len(x) > 75 else x for x in seqs)
+        if len(self.seqs) < DUPLICATE_LIMIT:
+            for k, v in counts.items():
+                if k in self.seqs or len(self.seqs) < DUPLICATE_LIMIT:
+                    self.seqs[k] += v
+            #To the nearest block
+            self.countAtLimit = self.total
+        else:
+            for k, v in counts.items():
+                if k in self.seqs:
+                    self.seqs[k] += v
+
+
+def percentile(counts, p):
+    '''
+    As FastQC's QualityCount.getPercentile(), counts[q] is the number of q's
+    '''
+    total = counts.sum()
+    if total == 0:
+        return float("nan")
+    return int(np.searchsorted(np.cumsum(counts), total * p / 100.0))
+
+
+def correctedCount(countAtLimit, totalCount, level, observations):
+    '''
+    FastQC's estimate of how many distinct sequences with this duplication
+    level there would be had all sequences been tracked
+    '''
+    if countAtLimit == totalCount or totalCount - observations < countAtLimit:
+        return observations
+    pNotSeeing = 1.0
+    limitOfCaring = 1.0 - (observations / (observations + 0.01))
+    for i in range(countAtLimit):
+        pNotSeeing *= ((totalCount - i) - level) / (totalCount - i)
+        if pNotSeeing < limitOfCaring:
+            pNotSeeing = 0
+            break
+    return observations / (1 - pNotSeeing)
+
+
+def status(value, warn, fail, higherIsWorse=True):
+    if not higherIsWorse:
+        value, warn, fail = -value, -warn, -fail
+    if value > fail:
+        return "fail"
+    if value > warn:
+        return "warn"
+    return "pass"
+
+
+def fmt(x):
+    if isinstance(x, np.integer):
+        x = int(x)
+    if isinstance(x, (float, np.floating)):
+        x = float(x)
+        if math.isnan(x):
+            return "NaN"
+        return repr(round(x, 6)) if x != int(x) else "{:.1f}".format(x)
+    return str(x)
+
+
+def modules(stats, fname):
+    '''
+    Returns a list of (module name, status, header, rows)
+    '''
+    out = []
+    total = stats.total
+    L = len(stats.bases)
+    lengths = np.nonzero(stats.lengths)[0]
+    called = stats.bases[:, :4].sum()
+    gcPct = int(100 * stats.bases[:, 1:3].sum() / called) if called else 0
+    if len(lengths) == 0:
+        seqLen = "0"
+    elif lengths[0] == lengths[-1]:
+        seqLen = str(lengths[0])
+    else:
+        seqLen = "{}-{}".format(lengths[0], lengths[-1])
+    out.append(("Basic Statistics", "pass", ["Measure", "Value"], [
+        ["Filename", os.path.basename(fname)],
+        ["File type", "Conventional base calls"],
+        ["Encoding", "Sanger / Illumina 1.9"],
+        ["Total Sequences", total],
+        ["Sequences flagged as poor quality", 0],
+        ["Sequence length", seqLen],
+        ["%GC", gcPct],
+    ]))
+
+    #Per base sequence quality
+    rows = []
+    worst = "pass"
+    for i in range(L):
+        c = stats.quals[i]
+        n = c.sum()
+        mean = float((c * np.arange(MAXQUAL)).sum() / n) if n else float("nan")
+        lq = percentile(c, 25)
+        med = percentile(c, 50)
+        rows.append([i + 1, mean, float(med), float(lq), float(percentile(c, 75)), float(percentile(c, 10)), float(percentile(c, 90))])
+        if n:
+            s = max([status(lq, 10, 5, False), status(med, 25, 20, False)], key=["pass", "warn", "fail"].index)
+            worst = max([worst, s], key=["pass", "warn", "fail"].index)
+    out.append(("Per base sequence quality", worst, ["Base", "Mean", "Median", "Lower Quartile", "Upper Quartile", "10th Percentile", "90th Percentile"], rows))
+
+    #Per sequence quality scores
+    q = np.nonzero(stats.meanQuals)[0]
+    rows = [[int(i), float(stats.meanQuals[i])] for i in range(q[0], q[-1] + 1)] if len(q) else []
+    mode = int(np.argmax(stats.meanQuals)) if len(q) else 0
+    out.append(("Per sequence quality scores", status(mode, 27, 20, False), ["Quality", "Count"], rows))
+
+    #Per base sequence content, as G A T C
+    rows = []
+    maxDiff = 0
+    for i in range(L):
+        a, c, g, t = stats.bases[i, :4]
+        n = a + c + g + t
+        if n == 0:
+            rows.append([i + 1, float("nan"), float("nan"), float("nan"), float("nan")])
+            continue
+        g, a, t, c = [100.0 * x / n for x in (g, a, t, c)]
+        rows.append([i + 1, g, a, t, c])
+        maxDiff = max(maxDiff, abs(a - t), abs(g - c))
+    out.append(("Per base sequence content", status(maxDiff, 10, 20), ["Base", "G", "A", "T", "C"], rows))
+
+    #Per sequence GC content, compared to a normal distribution
+    gcTotal = stats.gc.sum()
+    deviation = 0.0
+    if gcTotal:
+        x = np.arange(101)
+        mean = (stats.gc * x).sum() / gcTotal
+        sd = math.sqrt((stats.gc * (x - mean) ** 2).sum() / gcTotal) or 1.0
+        theory = np.exp(-0.5 * ((x - mean) / sd) ** 2)
+        theory *= gcTotal / theory.sum()
+        deviation = 100.0 * np.abs(stats.gc - theory).sum() / gcTotal
+    out.append(("Per sequence GC content", status(deviation, 15, 30), ["GC Content", "Count"],
+                [[i, float(stats.gc[i])] for i in range(101)]))
+
+    #Per base N content
+    rows = []
+    maxN = 0
+    for i in range(L):
+        n = stats.bases[i].sum()
+        pct = 100.0 * stats.bases[i, 4] / n if n else 0.0
+        rows.append([i + 1, pct])
+        maxN = max(maxN, pct)
+    out.append(("Per base N content", status(maxN, 5, 20), ["Base", "N-Count"], rows))
+
+    #Sequence Length Distribution
+    rows = [[int(i), float(stats.lengths[i])] for i in range(lengths[0], lengths[-1] + 1)] if len(lengths) else []
+    if len(lengths) and lengths[0] == 0:
+        s = "fail"
+    elif len(lengths) > 1:
+        s = "warn"
+    else:
+        s = "pass"
+    out.append(("Sequence Length Distribution", s, ["Length", "Count"], rows))
+
+    #Sequence Duplication Levels
+    labels = [str(i) for i in range(1, 10)] + [">10", ">50", ">100", ">500", ">1k", ">5k", ">10k+"]
+    bounds = [10, 50, 100, 500, 1000, 5000, 10000]
+    dedup = np.zeros(len(labels))
+    raw = np.zeros(len(labels))
+    levels = collections.Counter(stats.seqs.values())
+    for level, observations in levels.items():
+        c = correctedCount(stats.countAtLimit, total, level, observations)
+        if level < 10:
+            b = level - 1
+        else:
+            b = 9 + sum(level >= x for x in bounds[1:])
+        dedup[b] += c
+        raw[b] += c * level
+    dedupTotal = dedup.sum()
+    rawTotal = raw.sum()
+    dedupPct = 100.0 * dedupTotal / rawTotal if rawTotal else 100.0
+    rows = [["#Total Deduplicated Percentage", dedupPct]]
+    for i, label in enumerate(labels):
+        rows.append([label, 100.0 * dedup[i] / dedupTotal if dedupTotal else 0.0, 100.0 * raw[i] / rawTotal if rawTotal else 0.0])
+    out.append(("Sequence Duplication Levels", status(dedupPct, 70, 50, False), ["Duplication Level", "Percentage of deduplicated", "Percentage of total"], rows))
+
+    #Overrepresented sequences
+    rows = []
+    maxPct = 0
+    for seq, count in stats.seqs.most_common():
+        pct = 100.0 * count / total
+        if pct <= 0.1:
+            break
+        rows.append([seq.decode(), count, pct, "No Hit"])
+        maxPct = max(maxPct, pct)
+    out.append(("Overrepresented sequences", status(maxPct, 0.1, 1), ["Sequence", "Count", "Percentage", "Possible Source"], rows))
+
+    #Adapter Content, the percentage of reads with an adapter starting at or before each position
+    cum = 100.0 * np.cumsum(stats.adapters, axis=1) / total if total else np.zeros((len(ADAPTERS), L))
+    rows = [[i + 1] + [float(cum[j, i]) for j in range(len(ADAPTERS))] for i in range(L)]
+    maxAdapter = float(cum.max()) if cum.size else 0.0
+    out.append(("Adapter Content", status(maxAdapter, 5, 10), ["Position"] + [a[0] for a in ADAPTERS], rows))
+    return out
+
+
+def fastqcData(mods):
+    f = io.StringIO()
+    f.write("##FastQC\t{}\n".format(VERSION))
+    for name, s, header, rows in mods:
+        f.write(">>{}\t{}\n".format(name, s))
+        if name == "Sequence Duplication Levels":
+            f.write("{}\t{}\n".format(rows[0][0], fmt(rows[0][1])))
+            rows = rows[1:]
+        f.write("#" + "\t".join(header) + "\n")
+        for row in rows:
+            f.write("\t".join(fmt(x) for x in row) + "\n")
+        f.write(">>END_MODULE\n")
+    return f.getvalue()
+
+
+def report(mods, fname):
+    f = io.StringIO()
+    f.write("<html><head><title>{0} QC Report</title></head><body><h1>{0}</h1>\n".format(html.escape(os.path.basename(fname))))
+    for name, s, header, rows in mods:
+        f.write("<h2>[{}] {}</h2>\n<table border=\"1\"><tr>{}</tr>\n".format(s.upper(), html.escape(name), "".join("<th>{}</th>".format(html.escape(h)) for h in header)))
+        for row in rows:
+            f.write("<tr>{}</tr>\n".format("".join("<td>{}</td>".format(html.escape(fmt(x))) for x in row)))
+        f.write("</table>\n")
+    f.write("</body></html>\n")
+    return f.getvalue()
+
+
+def writeReport(stats, fname, odir):
+    '''
+    Write odir/<name>_fastqc.zip and odir/<name>_fastqc.html from the
+    statistics of fname
+    '''
+    mods = modules(stats, fname)
+    base = os.path.basename(fname)
+    for ext in [".gz", ".fastq", ".fq"]:
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+    base = "{}_fastqc".format(base)
+    summary = "".join("{}\t{}\t{}\n".format(s.upper(), name, os.path.basename(fname)) for name, s, _, _ in mods)
+    page = report(mods, fname)
+
+    #Written under a temporary name, so a partial zip is never mistaken for a finished one
+    zname = os.path.join(odir, "{}.zip".format(base))
+    with zipfile.ZipFile("{}.tmp".format(zname), "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("{}/fastqc_data.txt".format(base), fastqcData(mods))
+        z.writestr("{}/summary.txt".format(base), summary)
+        z.writestr("{}/fastqc_report.html".format(base), page)
+    with open(os.path.join(odir, "{}.html".format(base)), "w") as f:
+        f.write(page)
+    os.replace("{}.tmp".format(zname), zname)
+
+
+def fastqc(fname, odir):
+    '''
+    Write odir/<name>_fastqc.zip and odir/<name>_fastqc.html for fname, a
+    gzipped fastq file. See stream.QCConsumer to do this while the file is
+    read for something else.
+    '''
+    stats = FastqStats()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+        for lines in lineBlocks(readChunks(fname, pool, 2)):
+            stats.add(lines)
+    writeReport(stats, fname, odir)
@@ -7,38 +7,115 @@ such as marking it as having been processed and sending emails.
 
 import os
 import sys
+import json
 import smtplib
 import glob
 from email.mime.text import MIMEText
 import syslog
 from shutil import copyfile
-import xml.etree.ElementTree as ET
 import flowcell_manager.flowcell_manager as fm
 import datetime as dt
 import bcl2fastq_pipeline.afterFastq as af
+import bcl2fastq_pipeline.instruments as instruments
+import bcl2fastq_pipeline.runMetadata as runMetadata
 
 
 CUSTOM_OPTS = ['Organism', 'Libprep', 'User', 'Rerun','SingleCell','RemoveHumanReads','SensitiveData','ReverseComplementIndexP5','ReverseComplementIndexP7','TrimAdapter']
 
 
+class ProcessedRunCache:
+    '''
+    Remembers which runs have already been processed, so that a poll over
+    hundreds of old runs only needs a few stat calls per run.
+
+    An entry stays valid as long as the mtimes of the run directory, its
+    sample sheets and the output directory don't change. Adding, removing or
+    editing a sample sheet (e.g., to set Rerun) or deleting the output
+    directory therefore causes the run to be checked properly again.
+
+    The entries are kept in fname (processed_runs.json in [Paths] logDir), so
+    they also survive restarts. Changes are only written by save(), which
+    bfq.py calls once per poll. This is created once by bfq.py, so it
+    survives the module reloads in the main loop.
+    '''
+    def __init__(self, fname=None):
+        self.fname = fname
+        self.entries = {}
+        self.dirty = False
+        if fname is not None:
+            try:
+                with open(fname) as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                pass
+
+    def save(self):
+        if self.fname is None or not self.dirty:
+            return
+        try:
+            with open("{}.tmp".format(self.fname), "w") as f:
+                json.dump(self.entries, f)
+            os.replace("{}.tmp".format(self.fname), self.fname)
+            self.dirty = False
+        except OSError as e:
+            syslog.syslog("[ProcessedRunCache] Couldn't write {} ({})\n".format(self.fname, e))
+
+    def signature(self, paths):
+        sig = []
+        for p in paths:
+            try:
+                sig.append(os.stat(p).st_mtime_ns)
+            except OSError:
+                sig.append(None)
+        return sig
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if self.signature(entry['paths']) != entry['signature']:
+            del self.entries[key]
+            self.dirty = True
+            return None
+        return entry['processed']
+
+    def set(self, key, paths, signature, processed):
+        self.entries[key] = {'paths': paths, 'signature': signature, 'processed': processed}
+        self.dirty = True
+
+
 #Returns True on processed, False on unprocessed
-def flowCellProcessed(config) :
+def flowCellProcessed(config, cache=None) :
     lanes = config.get("Options", "lanes")
     if lanes != "":
         lanes = "_lanes{}".format(lanes)
 
-    flowcells = fm.list_flowcell_all(os.path.join(config.get("Paths","outputDir"), config.get("Options","runID")))
+    key = "{}{}".format(config.get("Options","runID"), lanes)
+    if cache is not None:
+        processed = cache.get(key)
+        if processed is not None:
+            return processed
+        instrument_dir = os.path.join(config.get("Paths","baseDir"), config.get("Options","sequencer"), "data", config.get("Options","runID"))
+        paths = [instrument_dir, os.path.join(config.get("Paths","outputDir"), config.get("Options","runID"))]
+        paths.extend(glob.glob("%s/SampleSheet*.csv" % instrument_dir))
+        #Taken before checking, so that changes made in the meantime invalidate the entry
+        signature = cache.signature(paths)
+
+    in_inventory = fm.flowcell_in_inventory(os.path.join(config.get("Paths","outputDir"), config.get("Options","runID")), config)
     path = "%s/%s%s/fastq.made" % (config.get("Paths","outputDir"), config.get("Options","runID"), lanes)
-    if os.access(path, os.F_OK) or (not flowcells.empty):
+    if os.access(path, os.F_OK) or in_inventory:
         if rerunFlowcell(config):
             return False
         else:
+            #Only processed runs are remembered, unprocessed ones are about to be processed and would change anyway
+            if cache is not None:
+                cache.set(key, paths, signature, True)
             return True
     return False
 
 #Determine if the flowcell should be rerun
 def rerunFlowcell(config):
-    seq_data_path = af.SEQUENCER_OUTPUTFOLDER[config.get("Options","runID").split("_")[-3]]
+    seq_data_path = instruments.getInstrument(config).outputFolder
     ss, opts = getSampleSheets(os.path.join(config.get("Paths","baseDir"),seq_data_path,"data",config.get("Options","runID")))
     if not opts:
         return False
@@ -53,10 +130,7 @@ def rerunFlowcell(config):
 # Get the number of lanes in the run. This might not match the number of lanes in the sampleSheet
 def getNumLanes(d):
     try:
-        tree = ET.parse("{}/RunInfo.xml".format(d))
-        root = tree.getroot()[0]
-        numLanes = root.findall("FlowcellLayout")[0]
-        return int(numLanes.get("LaneCount"))
+        return runMetadata.load(d).lanes
     except:
         return 1
 
@@ -1,4 +1,5 @@
 import configparser
+import io
 import os
 
 def getConfig() :
@@ -7,3 +8,15 @@ def getConfig() :
     if("Paths" in config.sections()) :
         return config
     return None
+
+def copyConfig(config) :
+    '''
+    Return an independent copy of config, so a flow cell can keep its own
+    runID/sampleSheet/etc. while the main loop moves on to the next one.
+    '''
+    buf = io.StringIO()
+    config.write(buf)
+    buf.seek(0)
+    c = configparser.ConfigParser()
+    c.read_file(buf)
+    return c
@@ -0,0 +1,125 @@
+'''
+This file holds the registry of sequencers that the pipeline knows about, and
+finds the runs that they've finished.
+
+The built-in instruments below can be extended or overridden in
+bcl2fastq.ini with one section per instrument, named after the serial number
+(or a prefix of it), for example:
+
+[Instrument M05617]
+name=MiSeq SINTEF
+outputFolder=miseq
+marker=ImageAnalysis_Netcopy_complete.txt
+runType=MiSeq
+
+  name         - The name used in reports and emails
+  outputFolder - The directory under baseDir the instrument writes to, runs are
+                 expected in baseDir/outputFolder/data/
+  marker       - The file written once a run has finished
+  runType      - The run type given to pyBarcodes (NextSeq, HiSeq2500,
+                 HiSeq3000 or MiSeq)
+'''
+import os
+import collections
+import syslog
+
+Instrument = collections.namedtuple('Instrument', ['serial', 'name', 'outputFolder', 'marker', 'runType'])
+
+INSTRUMENTS = {
+    'NB501038': Instrument('NB501038', 'NextSeq 500', 'nextseq', 'RunCompletionStatus.xml', 'NextSeq'),
+    'SN7001334': Instrument('SN7001334', 'HiSeq 2500', 'hiseq2500', 'ImageAnalysis_Netcopy_complete.txt', 'HiSeq2500'),
+    'K00251': Instrument('K00251', 'HiSeq 4000', 'hiseq', 'SequencingComplete.txt', 'HiSeq3000'),
+    'M026575': Instrument('M026575', 'MiSeq NTNU', 'miseq', 'ImageAnalysis_Netcopy_complete.txt', 'MiSeq'),
+    'M03942': Instrument('M03942', 'MiSeq StOlav', 'miseq', 'ImageAnalysis_Netcopy_complete.txt', 'MiSeq'),
+    'M05617': Instrument('M05617', 'MiSeq SINTEF', 'miseq', 'ImageAnalysis_Netcopy_complete.txt', 'MiSeq'),
+}
+
+SECTION_PREFIX = "Instrument "
+
+
+def getRegistry(config):
+    '''
+    Return a dictionary of serial -> Instrument, from INSTRUMENTS and any
+    [Instrument ...] sections in the config file.
+    '''
+    registry = dict(INSTRUMENTS)
+    for section in config.sections():
+        if not section.startswith(SECTION_PREFIX):
+            continue
+        serial = section[len(SECTION_PREFIX):].strip()
+        default = registry.get(serial, Instrument(serial, serial, "", "", ""))
+        registry[serial] = Instrument(
+            serial,
+            config.get(section, "name", fallback=default.name),
+            config.get(section, "outputFolder", fallback=default.outputFolder),
+            config.get(section, "marker", fallback=default.marker),
+            config.get(section, "runType", fallback=default.runType),
+        )
+    return registry
+
+
+def lookup(registry, runID):
+    '''
+    Return the instrument that produced a run, or None. Run IDs look like
+    YYMMDD_SERIAL_NNNN_FLOWCELL and the serial needs to start with one of
+    those in the registry (the longest match wins).
+    '''
+    fields = os.path.basename(runID).split("_")
+    if len(fields) < 2:
+        return None
+    best = None
+    for serial, instrument in registry.items():
+        if fields[1].startswith(serial) and (best is None or len(serial) > len(best.serial)):
+            best = instrument
+    return best
+
+
+def getInstrument(config, runID=None):
+    if runID is None:
+        runID = config.get("Options","runID")
+    return lookup(getRegistry(config), runID)
+
+
+def getDataDirs(config, registry=None):
+    '''
+    The instrument data directories that exist
+    '''
+    if registry is None:
+        registry = getRegistry(config)
+    dirs = set()
+    for instrument in registry.values():
+        d = os.path.join(config.get("Paths","baseDir"), instrument.outputFolder, "data")
+        if instrument.outputFolder and os.path.isdir(d):
+            dirs.add(d)
+    return sorted(dirs)
+
+
+def getMarkers(registry):
+    return set(instrument.marker for instrument in registry.values() if instrument.marker)
+
+
+def findCompletedRuns(config):
+    '''
+    Return the completion markers of all finished runs, as
+    baseDir/outputFolder/data/runID/marker.
+
+    Each data directory is listed once with os.scandir() and only the marker
+    of the matching instrument is checked in each run directory.
+    '''
+    registry = getRegistry(config)
+    markers = []
+    for d in getDataDirs(config, registry):
+        try:
+            entries = list(os.scandir(d))
+        except OSError as e:
+            syslog.syslog("[findCompletedRuns] Couldn't list {} ({})\n".format(d, e))
+            continue
+        folder = os.path.basename(os.path.dirname(d))
+        for entry in entries:
+            instrument = lookup(registry, entry.name)
+            if instrument is None or instrument.outputFolder != folder:
+                continue
+            marker = os.path.join(entry.path, instrument.marker)
+            if os.path.exists(marker):
+                markers.append(marker)
+    return sorted(markers)
@@ -0,0 +1,387 @@
+'''
+This file reads the Illumina InterOp binary files directly, in place of the
+interop_summary and interop_index-summary commands. The fixed-size records of
+TileMetricsOut.bin, QMetricsOut.bin and ErrorMetricsOut.bin are memory-mapped
+as NumPy structured arrays, IndexMetricsOut.bin (variable length records) is
+parsed with struct.
+
+summary() gives the per read and lane metrics that are shown in the emails:
+
+    for read in interop.summary(runDir):
+        read['label'], read['lanes']  #e.g., "Read 1" and a DataFrame with a row per lane
+
+writeSummary() and writeIndexSummary() write the same CSV files as
+"interop_summary --csv=1" and "interop_index-summary --csv=1", which MultiQC
+reads. Columns that would need the extraction or phasing metrics are "nan".
+
+Supported versions: TileMetrics 2-3, QMetrics 4-7, ErrorMetrics 3-4 and
+IndexMetrics 1-2. InterOpError is raised for anything else.
+'''
+import os
+import struct
+import numpy as np
+import pandas as pd
+import bcl2fastq_pipeline.runMetadata as runMetadata
+
+#TileMetrics v2 codes
+DENSITY = 100
+CLUSTERS = 102
+CLUSTERS_PF = 103
+ALIGNED = 300
+
+TILE2 = np.dtype([('lane', '<u2'), ('tile', '<u2'), ('code', '<u2'), ('value', '<f4')])
+#v3 has "t" (cluster counts) and "r" (% aligned for a read) records of the same size
+TILE3 = np.dtype({'names': ['lane', 'tile', 'code', 'clusters', 'pf', 'read', 'aligned'],
+                  'formats': ['<u2', '<u4', 'u1', '<f4', '<f4', '<u4', '<f4'],
+                  'offsets': [0, 2, 6, 7, 11, 7, 11],
+                  'itemsize': 15})
+
+ERROR3 = np.dtype([('lane', '<u2'), ('tile', '<u2'), ('cycle', '<u2'), ('rate', '<f4'), ('errors', '<u4', (5,))])
+ERROR4 = np.dtype([('lane', '<u2'), ('tile', '<u4'), ('cycle', '<u2'), ('rate', '<f4')])
+
+SUMMARY_COLUMNS = ["Lane", "Surface", "Tiles", "Density", "Cluster PF", "Legacy Phasing/Prephasing Rate",
+                   "Phasing slope/offset", "Prephasing slope/offset", "Reads", "Reads PF", "%>=Q30", "Yield",
+                   "Cycles Error", "Aligned", "Error", "Error (35)", "Error (75)", "Error (100)", "Intensity C1"]
+
+
+class InterOpError(Exception):
+    pass
+
+
+def _records(fname, dtype, offset, recsize):
+    '''
+    Memory-map the records after the header of fname
+    '''
+    if dtype.itemsize != recsize:
+        raise InterOpError("Unexpected record size {} in {}\n".format(recsize, fname))
+    n = (os.path.getsize(fname) - offset) // recsize
+    if n <= 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(fname, dtype=dtype, mode='r', offset=offset, shape=(n,))
+
+
+def _header(fname, size=2):
+    with open(fname, "rb") as f:
+        header = f.read(size)
+    if len(header) < 2:
+        raise InterOpError("{} is truncated\n".format(fname))
+    return header
+
+
+def readTileMetrics(fname):
+    '''
+    Returns (tiles, aligned). tiles has a row per tile with lane, tile,
+    density (clusters/mm2), clusters and pf (clusters passing filter).
+    aligned has lane, tile, read and aligned (the % aligned to PhiX).
+    '''
+    header = _header(fname, 6)
+    version, recsize = header[0], header[1]
+    if version == 2:
+        rec = _records(fname, TILE2, 2, recsize)
+        df = pd.DataFrame({'lane': rec['lane'], 'tile': rec['tile'], 'code': rec['code'], 'value': rec['value']})
+        counts = df[df['code'].isin([DENSITY, CLUSTERS, CLUSTERS_PF])]
+        tiles = counts.groupby(['lane', 'tile', 'code'])['value'].last().unstack()
+        tiles = tiles.reindex(columns=[DENSITY, CLUSTERS, CLUSTERS_PF])
+        tiles.columns = ['density', 'clusters', 'pf']
+        aligned = df[(df['code'] >= ALIGNED) & (df['code'] < ALIGNED + 100)]
+        aligned = pd.DataFrame({'lane': aligned['lane'], 'tile': aligned['tile'],
+                                'read': aligned['code'] - ALIGNED + 1, 'aligned': aligned['value']})
+    elif version == 3:
+        area = struct.unpack("<f", header[2:6])[0]
+        rec = _records(fname, TILE3, 6, recsize)
+        t = rec[rec['code'] == ord('t')]
+        tiles = pd.DataFrame({'lane': t['lane'], 'tile': t['tile'], 'clusters': t['clusters'], 'pf': t['pf']})
+        tiles = tiles.groupby(['lane', 'tile']).last()
+        tiles.insert(0, 'density', tiles['clusters'] / area if area > 0 else np.nan)
+        r = rec[rec['code'] == ord('r')]
+        aligned = pd.DataFrame({'lane': r['lane'], 'tile': r['tile'], 'read': r['read'], 'aligned': r['aligned']})
+    else:
+        raise InterOpError("Unsupported TileMetrics version {}\n".format(version))
+    aligned = aligned[np.isfinite(aligned['aligned'])]
+    return tiles.reset_index(), aligned.reset_index(drop=True)
+
+
+def readQMetrics(fname):
+    '''
+    Returns (records, qscores). records are the lane, tile, cycle and hist
+    (the number of bases in each Q-score bin) of each tile and cycle,
+    qscores the Q-score of each bin.
+    '''
+    header = _header(fname, 4 + 3 * 255)
+    version, recsize = header[0], header[1]
+    if version == 4:
+        offset = 2
+        nbins = 50
+        qscores = np.arange(1, nbins + 1)
+    elif version in [5, 6, 7]:
+        offset = 3
+        qscores = None
+        if header[2]:
+            n = header[3]
+            offset = 4 + 3 * n
+            #The lower and upper bounds of each bin, then its Q-score
+            qscores = np.frombuffer(header[4 + 2 * n:4 + 3 * n], dtype=np.uint8).astype(int)
+        nbins = (recsize - (8 if version == 7 else 6)) // 4
+        if version == 5 or qscores is None or len(qscores) != nbins:
+            qscores = np.arange(1, nbins + 1)
+    else:
+        raise InterOpError("Unsupported QMetrics version {}\n".format(version))
+    dtype = np.dtype([('lane', '<u2'), ('tile', '<u4' if version == 7 else '<u2'), ('cycle', '<u2'), ('hist', '<u4', (nbins,))])
+    return _records(fname, dtype, offset, recsize), qscores
+
+
+def readErrorMetrics(fname):
+    '''
+    The lane, tile, cycle and rate (% error against PhiX) of each tile and cycle
+    '''
+    version, recsize = _header(fname)
+    if version == 3:
+        dtype = ERROR3
+    elif version == 4:
+        dtype = ERROR4
+    else:
+        raise InterOpError("Unsupported ErrorMetrics version {}\n".format(version))
+    return _records(fname, dtype, 2, recsize)
+
+
+def readIndexMetrics(fname):
+    '''
+    A DataFrame with the lane, tile, read, index, count, sample and project of
+    each record
+    '''
+    with open(fname, "rb") as f:
+        data = f.read()
+    if not data:
+        raise InterOpError("{} is empty\n".format(fname))
+    version = data[0]
+    if version == 1:
+        head, count = struct.Struct("<HHH"), struct.Struct("<I")
+    elif version == 2:
+        head, count = struct.Struct("<HIH"), struct.Struct("<Q")
+    else:
+        raise InterOpError("Unsupported IndexMetrics version {}\n".format(version))
+
+    def string(pos):
+        n = struct.unpack_from("<H", data, pos)[0]
+        return data[pos + 2:pos + 2 + n].decode(errors="replace"), pos + 2 + n
+
+    rows = []
+    pos = 1
+    try:
+        while pos < len(data):
+            lane, tile, read = head.unpack_from(data, pos)
+            index, pos = string(pos + head.size)
+            n = count.unpack_from(data, pos)[0]
+            sample, pos = string(pos + count.size)
+            project, pos = string(pos)
+            rows.append((lane, tile, read, index, n, sample, project))
+    except struct.error:
+        raise InterOpError("{} is truncated\n".format(fname))
+    return pd.DataFrame(rows, columns=['lane', 'tile', 'read', 'index', 'count', 'sample', 'project'])
+
+
+def _usable(start, nc):
+    '''
+    The cycles of a read that are summarized, the last one isn't (as with interop_summary)
+    '''
+    return start, start + max(nc - 1, 1)
+
+
+def summary(runDir, reads=None):
+    '''
+    Per read and lane metrics for a run folder (or a bcl2fastq output
+    directory with InterOp/ and RunInfo.xml). Returns a list with a dictionary
+    per read, holding its "label" ("Read 1", "Read 2 (I)", ...), "isIndex",
+    "cycles" and "lanes". lanes is a DataFrame with a row per lane:
+
+     * Lane, Tiles
+     * Density (K/mm2) and Cluster PF (%), the mean over tiles, with the
+       standard deviations in Density SD and Cluster PF SD
+     * Reads and Reads PF (millions), Yield (Gbp)
+     * %>=Q30, along with the underlying base counts in Bases and Bases >=Q30
+     * Aligned (% PhiX) and Error (%) with Aligned SD and Error SD, averaged
+       over tiles. Error is NaN without ErrorMetricsOut.bin
+     * Cycles Error, the number of cycles with an error rate
+    '''
+    interop = os.path.join(runDir, "InterOp")
+    if reads is None:
+        reads = runMetadata.load(runDir).reads
+    if not reads:
+        raise InterOpError("No reads in {}/RunInfo.xml\n".format(runDir))
+
+    tiles, aligned = readTileMetrics(os.path.join(interop, "TileMetricsOut.bin"))
+    q, qscores = readQMetrics(os.path.join(interop, "QMetricsOut.bin"))
+    errors = None
+    if os.path.exists(os.path.join(interop, "ErrorMetricsOut.bin")):
+        errors = readErrorMetrics(os.path.join(interop, "ErrorMetricsOut.bin"))
+
+    tiles = tiles.assign(pct=100 * tiles['pf'] / tiles['clusters'])
+    lanes = tiles.groupby('lane').agg(**{
+        'Tiles': ('tile', 'count'),
+        'Density': ('density', 'mean'),
+        'Density SD': ('density', 'std'),
+        'Cluster PF': ('pct', 'mean'),
+        'Cluster PF SD': ('pct', 'std'),
+        'Reads': ('clusters', 'sum'),
+        'Reads PF': ('pf', 'sum'),
+    })
+    lanes[['Density', 'Density SD']] /= 1000
+    lanesPF = lanes['Reads PF'].copy()
+    lanes[['Reads', 'Reads PF']] /= 1e6
+
+    #Bases and bases >=Q30 per lane and cycle
+    hist = np.asarray(q['hist'], dtype=np.uint64)
+    bases = pd.DataFrame({'lane': q['lane'], 'cycle': q['cycle'],
+                          'Bases': hist.sum(axis=1),
+                          'Bases >=Q30': hist[:, qscores >= 30].sum(axis=1)})
+    if errors is not None:
+        errors = pd.DataFrame({'lane': errors['lane'], 'tile': errors['tile'], 'cycle': errors['cycle'], 'rate': errors['rate']})
+
+    out = []
+    number = 0
+    for start, nc, isIndex in reads:
+        number += 1
+        first, last = _usable(start, nc)
+        df = lanes.copy()
+
+        b = bases[(bases['cycle'] >= first) & (bases['cycle'] < last)]
+        df = df.join(b.groupby('lane')[['Bases', 'Bases >=Q30']].sum())
+        df['%>=Q30'] = 100 * df['Bases >=Q30'] / df['Bases']
+        df['Yield'] = lanesPF * (last - first) / 1e9
+
+        a = aligned[aligned['read'] == number].groupby('lane')['aligned'].agg(['mean', 'std'])
+        df['Aligned'] = a['mean']
+        df['Aligned SD'] = a['std']
+        df[['Aligned', 'Aligned SD']] = df[['Aligned', 'Aligned SD']].fillna(0.0)
+
+        df['Error'] = np.nan
+        df['Error SD'] = np.nan
+        df['Cycles Error'] = 0
+        if errors is not None:
+            e = errors[(errors['cycle'] >= first) & (errors['cycle'] < last)]
+            if len(e):
+                perTile = e.groupby(['lane', 'tile'])['rate'].mean().groupby('lane').agg(['mean', 'std'])
+                df['Error'] = perTile['mean']
+                df['Error SD'] = perTile['std']
+                df['Cycles Error'] = e.groupby('lane')['cycle'].nunique()
+                df['Cycles Error'] = df['Cycles Error'].fillna(0).astype(int)
+
+        df[['Bases', 'Bases >=Q30']] = df[['Bases', 'Bases >=Q30']].fillna(0)
+        out.append({'label': "Read {}{}".format(number, " (I)" if isIndex else ""),
+                    'isIndex': isIndex,
+                    'cycles': nc,
+                    'lanes': df.reset_index().rename(columns={'lane': 'Lane'})})
+    return out
+
+
+def _pm(mean, sd, fmt="{:.2f}"):
+    return "{} +/- {}".format(fmt.format(mean), fmt.format(0.0 if np.isnan(sd) else sd))
+
+
+def _level(label, reads):
+    '''
+    A row of the "Level" table of interop_summary for the given reads
+    '''
+    lanes = pd.concat([r['lanes'] for r in reads])
+    q30 = 100 * lanes['Bases >=Q30'].sum() / lanes['Bases'].sum() if lanes['Bases'].sum() else np.nan
+    return "{},{:.2f},{:.2f},{:.2f},{:.2f},nan,{:.2f}".format(
+        label, lanes['Yield'].sum(), lanes['Yield'].sum(), lanes['Aligned'].mean(), lanes['Error'].mean(), q30)
+
+
+def writeSummary(runDir, ofile, reads=None):
+    '''
+    Write what "interop_summary runDir --csv=1" would (lane rows only)
+    '''
+    s = summary(runDir, reads)
+    lines = ["# Version: native", os.path.basename(os.path.normpath(runDir)),
+             "Level,Yield,Projected Yield,Aligned,Error Rate,Intensity C1,%>=Q30"]
+    lines.extend(_level(r['label'], [r]) for r in s)
+    nonIndex = [r for r in s if not r['isIndex']]
+    if nonIndex:
+        lines.append(_level("Non-indexed", nonIndex))
+    lines.append(_level("Total", s))
+    lines.extend(["", "", ""])
+
+    for r in s:
+        lines.append(r['label'])
+        lines.append(",".join(SUMMARY_COLUMNS))
+        for row in r['lanes'].to_dict('records'):
+            lines.append(",".join([
+                "{}".format(row['Lane']), "-", "{}".format(row['Tiles']),
+                _pm(row['Density'], row['Density SD'], "{:.0f}"),
+                _pm(row['Cluster PF'], row['Cluster PF SD']),
+                "nan / nan", "nan / nan", "nan / nan",
+                "{:.2f}".format(row['Reads']), "{:.2f}".format(row['Reads PF']),
+                "{:.2f}".format(row['%>=Q30']), "{:.2f}".format(row['Yield']),
+                "{}".format(row['Cycles Error']),
+                _pm(row['Aligned'], row['Aligned SD']),
+                _pm(row['Error'], row['Error SD']),
+                "nan", "nan", "nan", "nan"]))
+
+    cycles = sum(nc for start, nc, isIndex in (reads or runMetadata.load(runDir).reads))
+    lines.extend(["Extracted: {}".format(cycles), "Called: {}".format(cycles), "Scored: {}".format(cycles)])
+    _write(ofile, lines)
+
+
+def indexSummary(flowDir):
+    '''
+    The demultiplexing summary of a bcl2fastq output directory, from its
+    InterOp/IndexMetricsOut.bin and TileMetricsOut.bin. Returns a list of
+    (lane, totals, samples), where totals is a dictionary and samples a
+    DataFrame like the two tables of interop_index-summary.
+    '''
+    interop = os.path.join(flowDir, "InterOp")
+    tiles = readTileMetrics(os.path.join(interop, "TileMetricsOut.bin"))[0]
+    index = readIndexMetrics(os.path.join(interop, "IndexMetricsOut.bin"))
+    #Each tile is counted once per index read, only use the first
+    if len(index):
+        index = index[index['read'] == index.groupby('lane')['read'].transform('min')]
+    totals = tiles.groupby('lane')[['clusters', 'pf']].sum()
+
+    out = []
+    for lane, row in totals.iterrows():
+        idx = index[index['lane'] == lane]
+        samples = idx.groupby(['sample', 'project', 'index'], sort=False)['count'].sum().reset_index()
+        pct = 100 * samples['count'] / row['pf'] if row['pf'] else samples['count'] * np.nan
+        barcodes = samples['index'].str.replace("+", "-", regex=False).str.split("-", n=1, expand=True)
+        if barcodes.shape[1] == 1:
+            barcodes[1] = ""
+        samples = pd.DataFrame({
+            'Index Number': np.arange(1, len(samples) + 1),
+            'Sample Id': samples['sample'],
+            'Project': samples['project'],
+            'Index 1 (I7)': barcodes[0],
+            'Index 2 (I5)': barcodes[1].fillna(""),
+            '% Read Identified (PF)': pct,
+        })
+        mean = pct.mean() if len(pct) else np.nan
+        out.append((int(lane), {
+            'Total Reads': int(row['clusters']),
+            'PF Reads': int(row['pf']),
+            '% Read Identified (PF)': pct.sum() if len(pct) else 0.0,
+            'CV': pct.std(ddof=0) / mean if mean else np.nan,
+            'Min': pct.min() if len(pct) else np.nan,
+            'Max': pct.max() if len(pct) else np.nan,
+        }, samples))
+    return out
+
+
+def writeIndexSummary(flowDir, ofile):
+    '''
+    Write what "interop_index-summary flowDir --csv=1" would
+    '''
+    lines = ["# Version: native"]
+    for lane, totals, samples in indexSummary(flowDir):
+        lines.append("Lane {}".format(lane))
+        lines.append(",".join(totals.keys()))
+        lines.append("{},{},{:.4f},{:.4f},{:.4f},{:.4f}".format(*totals.values()))
+        lines.append(",".join(samples.columns))
+        for row in samples.itertuples(index=False):
+            lines.append("{},{},{},{},{},{:.4f}".format(*row))
+    _write(ofile, lines)
+
+
+def _write(ofile, lines):
+    with open("{}.tmp".format(ofile), "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace("{}.tmp".format(ofile), ofile)
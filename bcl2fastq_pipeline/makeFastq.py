@@ -5,12 +5,10 @@ import subprocess
 import os
 import sys
 import shutil
-import glob
 import syslog
 import csv
 import codecs
 import tempfile
-import xml.etree.ElementTree as ET
 import re
 from distutils.dir_util import copy_tree
 from reportlab.lib import colors, utils
@@ -18,6 +16,10 @@ from reportlab.platypus import BaseDocTemplate, Table, Preformatted, Paragraph,
 from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
+import bcl2fastq_pipeline.stages as stages
+import bcl2fastq_pipeline.manifest as manifest
+import bcl2fastq_pipeline.runMetadata as runMetadata
+import bcl2fastq_pipeline.shards as shards
 
 def determineMask(config):
     '''
@@ -41,15 +43,13 @@ def determineMask(config):
     bcNum = 0
     if mask != "":
         return "--use-bases-mask {} {}".format(mask, lanes)
-    elif os.path.isfile("{}/{}/RunInfo.xml".format(config.get("Paths","baseDir"),config.get("Options","runID"))):
-        xml = ET.parse("{}/{}/RunInfo.xml".format(config.get("Paths","baseDir"),config.get("Options","runID")))
-        root = xml.getroot()[0][3]
+    else:
+        runDir = os.path.join(config.get("Paths","baseDir"), config.get("Options","sequencer"), "data", config.get("Options","runID"))
         l = []
-        for read in root.findall("Read"):
-            if read.get("IsIndexedRead") == "N":
+        for (start, nc, isIndex) in runMetadata.load(runDir).reads:
+            if not isIndex:
                 l.append("Y*")
             else:
-                nc = int(read.get("NumCycles"))
                 if nc > bcLens[bcNum]:
                     if bcLens[bcNum] > 0:
                         l.append("I{}{}".format(bcLens[bcNum], "n" * (nc - bcLens[bcNum])))
@@ -64,21 +64,21 @@ def determineMask(config):
 
 
 def fixNames(config) :
-    lanes = config.get("Options", "lanes")
-    if lanes != "":
-        lanes = "_lanes{}".format(lanes)
-
     if config.get("Options","singleCell") == "1":
         return
 
-    names = glob.glob("%s/%s%s/*/*.fastq.gz" % (config.get("Paths","outputDir"), config.get("Options","runID"), lanes))
-    names.extend(glob.glob("%s/%s%s/*/*/*.fastq.gz" % (config.get("Paths","outputDir"), config.get("Options","runID"), lanes)))
-    for fname in names:
+    m = manifest.get(config)
+    for fname in m.fastqs(roles=None, reads=None):
         if "_001.fastq.gz" in fname:
             fnew = fname.replace("_001.fastq.gz", ".fastq.gz")
             fnew = re.sub("_S[0-9]+","",fnew) 
-            syslog.syslog("Moving %s to %s\n" % (fname, fnew))
-            shutil.move(fname, fnew)
+            if os.path.exists(fname):
+                syslog.syslog("Moving %s to %s\n" % (fname, fnew))
+                shutil.move(fname, fnew)
+            elif not os.path.exists(fnew):
+                continue
+            #A rerun after the move but before the manifest was updated just records it
+            m.rename(fname, fnew)
 
 
 def bcl2fq(config) :
@@ -119,6 +119,34 @@ def bcl2fq(config) :
                 cellranger_options = config.get("cellranger","cellranger_mkfastq_options")
                 )
     else:
+        runDir = runMetadata.runDir(config)
+        flowDir = "{}/{}{}".format(config.get("Paths","outputDir"), config.get("Options","runID"), lanes)
+        if config.get("Options","lanes") != "":
+            laneList = [int(l) for l in config.get("Options","lanes").split("_")]
+        else:
+            laneList = list(range(1, runMetadata.load(runDir).lanes + 1))
+        shardLanes = shards.groups(config, laneList)
+        if shardLanes:
+            #One bcl2fastq per lane (group), see shards.py
+            shutil.rmtree(os.path.join(flowDir, shards.SHARD_DIR), ignore_errors=True)
+            options = shards.splitThreads(config.get("bcl2fastq","bcl2fastq_options"), len(shardLanes),
+                                          config.getint("bcl2fastq","threads",fallback=0))
+            shardDirs = [os.path.join(flowDir, shards.SHARD_DIR, shards.name(l)) for l in shardLanes]
+            cmds = ["%s %s --tiles %s --sample-sheet %s -o %s -R %s --interop-dir %s/InterOp" % (
+                config.get("bcl2fastq","bcl2fastq"),
+                options,
+                ",".join("s_{}".format(x) for x in l),
+                config.get("Options","sampleSheet"),
+                d,
+                runDir,
+                d,
+            ) for l, d in zip(shardLanes, shardDirs)]
+            logs = ["%s/%s%s_%s.log" % (config.get("Paths","logDir"), config.get("Options","runID"), lanes, shards.name(l)) for l in shardLanes]
+            shards.run(cmds, logs, numa=config.get("bcl2fastq","numa",fallback="0") == "1")
+            shards.merge(flowDir, shardDirs, os.path.join(config.get("Paths","outputDir"),config.get("Options","runID"),'InterOp'))
+            os.chdir(old_wd)
+            manifest.rebuild(config)
+            return
         cmd = "%s %s --sample-sheet %s -o %s/%s%s -R %s/%s/data/%s --interop-dir %s/%s/InterOp" % (
             config.get("bcl2fastq","bcl2fastq"),
             config.get("bcl2fastq","bcl2fastq_options"),
@@ -134,9 +162,11 @@ def bcl2fq(config) :
         )
     syslog.syslog("[bcl2fq] Running: %s\n" % cmd)
     logOut = open("%s/%s%s.log" % (config.get("Paths","logDir"), config.get("Options","runID"), lanes), "w")
-    subprocess.check_call(cmd, stdout=logOut, stderr=subprocess.STDOUT, shell=True)
+    stages.check_call(cmd, stdout=logOut, stderr=subprocess.STDOUT, shell=True)
     logOut.close()
     os.chdir(old_wd)
+    #The fastq files are only looked for once, see manifest.py
+    manifest.rebuild(config)
 
 def getOffSpecies(fname) :
     total = 0
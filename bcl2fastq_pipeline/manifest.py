@@ -0,0 +1,238 @@
+'''
+This file keeps a manifest of the fastq files of a flow cell, so that the
+output directory is walked once (with os.scandir) rather than globbed again by
+every step. It's built once bcl2fastq has finished (or the first time it's
+needed, e.g., for flow cells started by an older version) and the steps that
+rename or create fastq files record that in it:
+
+    m = manifest.get(config)
+    m.fastqs()                  #The R1/R2 files to run FastQC on
+    m.projectDirs()             #See get_project_dirs()
+    m.rename(old, new)
+    manifest.add(config, path)  #Only appends the change, for pool workers
+
+Each file is classified by project, sample, read (R1, R2, I1 or I2), lane and
+role: clean, contaminated (mapped to the masked human genome), filtered,
+duplicates (optical duplicates split out after clumpify) or Undetermined.
+
+The manifest is kept as manifest.jsonl in the flow cell directory. It holds a
+line per file as of the last walk, followed by the changes made since, which
+are appended as they happen (by pool workers too, like stages.jsonl). get()
+doesn't check that the files still exist, check() does that once per flow
+cell process and rebuilds the manifest if a step was interrupted between
+moving a file and recording that.
+'''
+import collections
+import json
+import os
+import re
+import syslog
+import bcl2fastq_pipeline.stages as stages
+
+FNAME = "manifest.jsonl"
+
+#Directories in the flow cell directory without fastq files
+SKIP = ("QC_", "Stats", "InterOp", "Reports")
+
+READ = re.compile(r'_([RI][12])(_001)?(_optical_duplicates)?\.fastq\.gz$')
+LANE = re.compile(r'_L([0-9]{3})_')
+SAMPLE_SUFFIX = re.compile(r'(_S[0-9]+)?(_L[0-9]{3})?_[RI][12](_001)?(_optical_duplicates)?\.fastq\.gz$')
+
+
+def classify(rel):
+    '''
+    The manifest entry of a fastq file, given its path relative to the flow
+    cell directory
+    '''
+    parts = rel.split("/")
+    name = parts[-1]
+    dirs = parts[:-1]
+    if name.startswith("Undetermined"):
+        role = "Undetermined"
+    elif "contaminated" in dirs:
+        role = "contaminated"
+    elif "filtered" in dirs:
+        role = "filtered"
+    elif name.endswith("_optical_duplicates.fastq.gz"):
+        role = "duplicates"
+    else:
+        role = "clean"
+    read = READ.search(name)
+    lane = LANE.search(name)
+    sampleDirs = [d for d in dirs[1:] if d not in ["contaminated", "filtered"]]
+    return {
+        'path': rel,
+        'project': dirs[0] if dirs else "",
+        'sample': sampleDirs[-1] if sampleDirs else SAMPLE_SUFFIX.sub("", name),
+        'read': read.group(1) if read else None,
+        'lane': int(lane.group(1)) if lane else None,
+        'role': role,
+    }
+
+
+def _walk(top, rel="", depth=0):
+    '''
+    Yield the fastq.gz files up to two directories below top, relative to it
+    '''
+    with os.scandir(top) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                if depth < 2 and not entry.name.startswith(SKIP):
+                    yield from _walk(entry.path, rel + entry.name + "/", depth + 1)
+            elif entry.name.endswith(".fastq.gz"):
+                yield rel + entry.name
+
+
+class RunManifest:
+    def __init__(self, flowDir):
+        self.flowDir = flowDir
+        self.files = collections.OrderedDict()
+
+    @classmethod
+    def build(cls, flowDir):
+        '''
+        Walk flowDir and write a new manifest
+        '''
+        m = cls(flowDir)
+        for rel in sorted(_walk(flowDir)):
+            m.files[rel] = classify(rel)
+        m.save()
+        return m
+
+    @classmethod
+    def load(cls, flowDir):
+        '''
+        The manifest of flowDir, or None if there isn't one
+        '''
+        m = cls(flowDir)
+        try:
+            with open(os.path.join(flowDir, FNAME)) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    m._apply(record)
+        except OSError:
+            return None
+        return m
+
+    def _apply(self, record):
+        op = record.get('op', 'file')
+        if op in ['file', 'add']:
+            self.files[record['path']] = classify(record['path'])
+        elif op == 'remove':
+            self.files.pop(record['path'], None)
+        elif op == 'rename':
+            self.files.pop(record['old'], None)
+            self.files[record['new']] = classify(record['new'])
+
+    def save(self):
+        fname = os.path.join(self.flowDir, FNAME)
+        with open("{}.tmp".format(fname), "w") as f:
+            for entry in self.files.values():
+                f.write(json.dumps(entry) + "\n")
+        os.replace("{}.tmp".format(fname), fname)
+
+    def _record(self, record):
+        self._apply(record)
+        _append(self.flowDir, record)
+
+    def _rel(self, path):
+        return os.path.relpath(path, self.flowDir)
+
+    def add(self, path):
+        self._record({'op': 'add', 'path': self._rel(path)})
+
+    def remove(self, path):
+        self._record({'op': 'remove', 'path': self._rel(path)})
+
+    def rename(self, old, new):
+        self._record({'op': 'rename', 'old': self._rel(old), 'new': self._rel(new)})
+
+    def entries(self, roles=None, reads=None):
+        '''
+        The entries of files in a project directory, optionally only those
+        with the given roles and reads
+        '''
+        for entry in self.files.values():
+            if not entry['project']:
+                continue
+            if roles is not None and entry['role'] not in roles:
+                continue
+            if reads is not None and entry['read'] not in reads:
+                continue
+            yield entry
+
+    def fastqs(self, roles=("clean",), reads=("R1", "R2")):
+        '''
+        The full paths of the files with the given roles and reads (None for any)
+        '''
+        return [os.path.join(self.flowDir, e['path']) for e in self.entries(roles, reads)]
+
+    def projectDirs(self):
+        '''
+        The project directories (GCF-*) or the directories holding each
+        project's files, as found by get_project_dirs()
+        '''
+        s = set()
+        for entry in self.entries():
+            parts = entry['path'].split("/")
+            if len(parts) not in [2, 3]:
+                continue
+            d = os.path.join(self.flowDir, *parts[:-1])
+            if parts[-2].startswith("GCF-"):
+                s.add(d)
+            else:
+                s.add(os.path.dirname(d))
+        return s
+
+
+def _append(flowDir, record):
+    try:
+        #A single write of a short line to a file opened for appending isn't interleaved with other processes
+        with open(os.path.join(flowDir, FNAME), "a") as f:
+            f.write(json.dumps(record) + "\n")
+    except OSError as e:
+        syslog.syslog("[manifest] Couldn't record {} ({})\n".format(record, e))
+
+
+def get(config):
+    '''
+    The flow cell's manifest, which is built if there isn't one yet
+    '''
+    flowDir = stages.stageDir(config)
+    m = RunManifest.load(flowDir)
+    if m is None:
+        m = RunManifest.build(flowDir)
+    return m
+
+
+def check(config):
+    '''
+    get(), but the manifest is rebuilt if a file in it no longer exists, e.g.,
+    if a step was interrupted between moving a file and recording that. This
+    stats every file, so it's only done once per flow cell process.
+    '''
+    flowDir = stages.stageDir(config)
+    m = RunManifest.load(flowDir)
+    if m is not None:
+        missing = [rel for rel in m.files if not os.path.exists(os.path.join(flowDir, rel))]
+        if missing:
+            syslog.syslog("[manifest] {} files in {} no longer exist (e.g., {}), rebuilding\n".format(len(missing), flowDir, missing[0]))
+            m = None
+    if m is None:
+        m = RunManifest.build(flowDir)
+    return m
+
+
+def add(config, path):
+    '''
+    Record that path was created, without loading the manifest
+    '''
+    flowDir = stages.stageDir(config)
+    _append(flowDir, {'op': 'add', 'path': os.path.relpath(path, flowDir)})
+
+
+def rebuild(config):
+    return RunManifest.build(stages.stageDir(config))
@@ -2,7 +2,7 @@
 Misc. functions
 """
 import pandas as pd
-import tempfile as tmp
+import io
 import configparser
 import shutil
 import smtplib
@@ -10,7 +10,6 @@ from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.utils import COMMASPACE, formatdate
-import xml.etree.ElementTree as ET
 from reportlab.lib import colors, utils
 from reportlab.platypus import BaseDocTemplate, Table, Preformatted, Paragraph, Spacer, Image, Frame, NextPageTemplate, PageTemplate, TableStyle, PageBreak, ListFlowable, ListItem
 from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
@@ -29,6 +28,8 @@ import codecs
 import requests
 import json
 
+import bcl2fastq_pipeline.interop as interop
+import bcl2fastq_pipeline.demuxStats as demuxStats
 from bcl2fastq_pipeline.afterFastq import get_project_dirs, get_project_names, get_sequencer, get_read_geometry
 
 style = """
@@ -60,39 +61,26 @@ def getSampleID(sampleTuple, project, lane, sampleName) :
     return " "
 
 
-def getFCmetrics(root) :
-    barcode = root[0][0] #Sample "all", barcode "all"
+def getFCmetrics(lanes) :
+    '''
+    A text table of the per lane metrics, from the lanes table of demuxStats.stats()
+    '''
+    reads = sorted(int(c.split(" R")[-1]) for c in lanes.columns if c.startswith("Yield R"))[:2]
     message = "Lane\t# Clusters (% pass)\t% Bases >=Q30\tAve. base qual.\n"
-    for lane in barcode.findall("Lane") :
-        message += "Lane %s" % lane.get("number")
-        clusterCount = 0
-        clusterCountPass = 0
-        baseYield = [0,0]
-        baseYieldQ30 = [0,0]
-        QualSum = [0,0]
-        rlens=[0,0]
-        for tile in lane :
-            clusterCount += int(tile[0][0].text)
-            clusterCountPass += int(tile[1][0].text)
-            #Yield
-            baseYield[0] += int(tile[1][1][0].text)
-            if(len(tile[1]) == 3) :
-                baseYield[1] += int(tile[1][2][0].text)
-            #YieldQ30
-            baseYieldQ30[0] += int(tile[1][1][1].text)
-            if(len(tile[1]) == 3) :
-                baseYieldQ30[1] += int(tile[1][2][1].text)
-            #QualSum
-            QualSum[0] += int(tile[1][1][2].text)
-            if(len(tile[1]) == 3) :
-                QualSum[1] += int(tile[1][2][2].text)
+    for lane in lanes.to_dict("records") :
+        message += "Lane %s" % lane["Lane"]
+        clusterCount = lane["Clusters"]
+        clusterCountPass = lane["Clusters PF"]
+        baseYield = [lane["Yield R{}".format(r)] for r in reads]
+        baseYieldQ30 = [lane["Yield Q30 R{}".format(r)] for r in reads]
+        QualSum = [lane["Quality Sum R{}".format(r)] for r in reads]
         #Number of clusters (%passing filter)
         try:
             message += "\t%s (%5.2f%%)" % ("{:,}".format(clusterCount).replace(","," "),100*clusterCountPass/clusterCount)
         except:
             message += "\t%s (NA)" % ("{:,}".format(clusterCount).replace(","," "))
         #%bases above Q30
-        if(baseYield[1] > 0) :
+        if(len(baseYield) == 2 and baseYield[1] > 0) :
             try:
                 message += "\t%5.2f%%/%5.2f%%" % (100*(baseYieldQ30[0]/baseYield[0]),
                     100*(baseYieldQ30[1]/baseYield[1]))
@@ -104,7 +92,7 @@ def getFCmetrics(root) :
             except:
                 message += "\tNA"
         #Average base quality
-        if(baseYield[1] > 0) :
+        if(len(baseYield) == 2 and baseYield[1] > 0) :
             try:
                 message += "\t%4.1f/%4.1f\n" % (QualSum[0]/float(baseYield[0]),
                     QualSum[1]/float(baseYield[1]))
@@ -118,19 +106,23 @@ def getFCmetrics(root) :
 
     return message
 
-def getFCmetricsImproved(config):
-    message = ""
-    try:
-        with open(os.path.join(config.get("Paths","outputDir"),config.get("Options","runID"),"Stats","interop_summary.csv"),"r") as fh:
-            header = False
-            while not header:
+FC_METRICS_COLUMNS = {"Cluster PF": "% Cluster PF", "Reads": " Total Reads (M)", "Aligned": "% PhiX"}
+
+
+def fcMetricsFromCSV(config):
+    '''
+    The per lane metrics of each non-index read, from Stats/interop_summary.csv
+    '''
+    with open(os.path.join(config.get("Paths","outputDir"),config.get("Options","runID"),"Stats","interop_summary.csv"),"r") as fh:
+        header = False
+        while not header:
+            line = fh.readline()
+            if not line:
+                return []
+            if line.startswith("\n"):
                 line = fh.readline()
-                if line.startswith("\n"):
-                    line = fh.readline()
-                    header = True
-            lines = fh.readlines()
-    except Exception as e:
-        return "Not able to generate table for flowcell metrics."
+                header = True
+        lines = fh.readlines()
 
     read_start = []
     for i,l in enumerate(lines):
@@ -143,11 +135,7 @@ def getFCmetricsImproved(config):
     for i in range(len(read_start)-1):
         if lines[read_start[i]].endswith("(I)\n"):
             continue
-        tmpfh = tmp.NamedTemporaryFile(mode="w+")
-        tmpfh.writelines(lines[read_start[i]+1:read_start[i+1]])
-        tmpfh.seek(0)
-        df = pd.read_csv(tmpfh)
-        tmpfh.close()
+        df = pd.read_csv(io.StringIO("".join(lines[read_start[i]+1:read_start[i+1]])))
         df = df[["Lane","Surface","Density","Reads","Cluster PF","Aligned","%>=Q30"]]
         df = df[df["Surface"]=='-']
         df = df.drop(columns=["Surface"])
@@ -155,104 +143,74 @@ def getFCmetricsImproved(config):
         df["Density"] = [float(v.split(" ")[0]) for v in df["Density"]]
         df["Cluster PF"] = [float(v.split(" ")[0]) for v in df["Cluster PF"]]
         df["Aligned"] = [float(v.split(" ")[0]) for v in df["Aligned"]]
+        dfs.append(df.round(2).rename(columns=FC_METRICS_COLUMNS))
+    return dfs
 
-        df = df.round(2)
 
-        mapper = {"Cluster PF": "% Cluster PF", "Reads": " Total Reads (M)", "Aligned": "% PhiX"}
-        df = df.rename(columns=mapper)
-        dfs.append(df)
+def fcMetrics(config):
+    '''
+    The per lane metrics of each non-index read, read directly from the run's
+    InterOp files (see interop.py)
+    '''
+    runDir = os.path.join(config.get("Paths","baseDir"),config.get("Options","sequencer"),"data",config.get("Options","runID"))
+    dfs = []
+    for read in interop.summary(runDir):
+        if read["isIndex"]:
+            continue
+        df = read["lanes"][["Lane","Density","Reads","Cluster PF","Aligned","%>=Q30"]].round(2)
+        df["Density"] = df["Density"].round(0)
+        dfs.append(df.rename(columns=FC_METRICS_COLUMNS))
+    return dfs
 
 
+def getFCmetricsImproved(config):
+    message = ""
+    try:
+        if config.get("InterOp","engine",fallback="native") == "native":
+            dfs = fcMetrics(config)
+        else:
+            dfs = fcMetricsFromCSV(config)
+    except (interop.InterOpError, OSError, ValueError) as e:
+        syslog.syslog("[getFCmetricsImproved] Falling back to interop_summary.csv ({})\n".format(e))
+        try:
+            dfs = fcMetricsFromCSV(config)
+        except Exception:
+            dfs = []
+    if not dfs:
+        return "Not able to generate table for flowcell metrics."
+
     undeter = parserDemultiplexStats(config)
     if len(dfs) > 1:
         dfs[0]["R2 %>=Q30"] = dfs[1]["%>=Q30"]
         dfs[0] = dfs[0].rename(columns={"%>=Q30": "R1 %>=Q30"})
     dfs[0] = dfs[0].join(undeter.set_index("Lane"),on="Lane")
-    #message += "\n<br>\n<br><strong>{} metrics </strong>\n<br>".format(lines[read_start[i]].rstrip())
-    message += "\n<br><strong>Flowcell metrics </strong>\n<br>".format(lines[read_start[i]].rstrip())
+    message += "\n<br><strong>Flowcell metrics </strong>\n<br>"
     message += dfs[0].to_html(index=False,classes="border-collapse: collapse",border=1,justify="center",col_space=12)
     return message
 
 
 def parserDemultiplexStats(config) :
     '''
-    Parse DemultiplexingStats.xml under outputDir/Stats/ to get the
-    number/percent of undetermined indices.
-
-    In particular, we extract the BarcodeCount values from Project "default"
-    Sample "all" and Project "all" Sample "all", as the former gives the total
-    undetermined and the later simply the total clusters
+    The percent of undetermined indices per lane, from the demultiplexing
+    statistics (see demuxStats.py)
     '''
-    lanes = config.get("Options", "lanes")
-    if lanes != "":
-        lanes = "_lanes{}".format(lanes)
-
-    totals = [0,0,0,0,0,0,0,0]
-    undetermined = [0,0,0,0,0,0,0,0]
-    tree = ET.parse("%s/%s%s/Stats/DemultiplexingStats.xml" % (config.get("Paths","outputDir"),config.get("Options","runID"), lanes))
-    root = tree.getroot()
-    for child in root[0].findall("Project") :
-        if(child.get("name") == "default") :
-            break
-    for sample in child.findall("Sample") :
-        if(sample.get("name") == "all") :
-            break
-    child = sample[0] #Get inside Barcode
-    for lane in child.findall("Lane") :
-        lnum = int(lane.get("number"))
-        undetermined[lnum-1] += int(lane[0].text)
-
-    for child in root[0].findall("Project") :
-        if(child.get("name") == "all") :
-            break
-    for sample in child.findall("Sample") :
-        if(sample.get("name") == "all") :
-            break
-    child = sample[0] #Get Inside Barcode
-    for lane in child.findall("Lane") :
-        lnum = int(lane.get("number"))
-        totals[lnum-1] += int(lane[0].text)
-
-    out = ""
-    lanes = []
-    undeter = []
-    for i in range(8) :
-        if(totals[i] == 0) :
-            continue
-        #Bad hack with "{:,}".format(val).replace(","," ") for separator, but avoids using locale. The "right" locale would also yield unwanted results (comma as separatpr)
-        """
-        out += "Lane %i: %s of %s reads/pairs had undetermined indices (%5.2f%%)\n<br>" % (
-            i+1,"{:,}".format(undetermined[i]).replace(","," "),"{:,}".format(totals[i]).replace(","," "),100*undetermined[i]/totals[i])
-        """
-        lanes.append(i+1)
-        undeter.append(100*undetermined[i]/totals[i])
-        #out_d.append({"Lane": i+1, "Undetermined": 100*undetermined[i]/totals[i]})
-    return pd.DataFrame.from_dict({'Lane': lanes, "% Undetermined": undeter}).round(2)
+    lanes, samples = demuxStats.stats(config)
+    lanes = lanes[lanes["Demultiplexed"] > 0]
+    return pd.DataFrame.from_dict({
+        'Lane': lanes["Lane"].tolist(),
+        "% Undetermined": (100*lanes["Undetermined"]/lanes["Demultiplexed"]).tolist(),
+        }).round(2)
 
 
 def parseConversionStats(config) :
     """
-    Parse ConversionStats.xml, producing:
-     1) A PDF file for each project
-     2) A message that will be included in the email message
+    The per lane metrics (see getFCmetrics()) that are included in the email message
     """
-    lanes = config.get("Options", "lanes")
-    if lanes != "":
-        lanes = "_lanes{}".format(lanes)
-
     try :
-        tree = ET.parse("%s/%s%s/Stats/ConversionStats.xml" % (config.get("Paths","outputDir"),config.get("Options","runID"), lanes))
-        root = tree.getroot()[0] #We only ever have a single flow cell
+        lanes, samples = demuxStats.stats(config)
     except :
         return None
-    metrics = None
-    #Per-project PDF files
-    for project in root.findall("Project") :
-        if(project.get("name") == "default") :
-            continue
-        if(project.get("name") == "all") :
-            metrics = getFCmetrics(project)
-    return metrics
+    return getFCmetrics(lanes)
 
 def enoughFreeSpace(config) :
     """
@@ -287,8 +245,8 @@ def finishedEmail(config, msg, runTime) :
     message = "<strong>Short summary for {}. </strong>\n\n".format(", ".join(projects))
     message += "<strong>User: {} </strong>\n".format(config.get("Options","User")) if config.get("Options","User") != "N/A" else ""
     message += "Flow cell: %s \n" % (config.get("Options","runID"))
-    message += "Sequencer: {} \n".format(get_sequencer(os.path.join(config.get("Paths","baseDir"),config.get("Options","runID"))))
-    message += "Read geometry: {} \n\n".format(get_read_geometry(os.path.join(config.get("Paths","outputDir"),config.get("Options","runID"))))
+    message += "Sequencer: {} \n".format(get_sequencer(config))
+    message += "Read geometry: {} \n\n".format(get_read_geometry(config))
     message += "bcl2fastq_pipeline run time: %s \n" % runTime
     #message += "Data transfer: %s\n" % transferTime
     message = message.replace("\n","\n<br>")
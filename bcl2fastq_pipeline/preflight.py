@@ -0,0 +1,273 @@
+'''
+This file contains the pre-flight check run before bcl2fastq. It samples the
+index cycles of the run with pyBarcodes and compares the most common barcodes
+to the indices in the sample sheet, also trying the reverse complement of
+index (i7) and index2 (i5). A sample sheet with the wrong orientation (e.g., a
+missing ReverseComplementIndexP5) would otherwise only show up as a huge
+Undetermined fraction once bcl2fastq has finished.
+
+Options, under [Preflight]:
+  mode       - correct (default) rewrites the indices in the output directory's
+               SampleSheet.csv if another orientation matches, check only
+               fails, off skips the check entirely
+  minMatched - The percentage of sampled clusters that need to match a sample
+               (default 50), allowing for bcl2fastq's --barcode-mismatches
+  tiles      - The number of tiles sampled per lane (default 8)
+  threads    - The number of threads used for sampling (default 4)
+'''
+import csv
+import io
+import itertools
+import os
+import re
+import shutil
+import syslog
+import numpy as np
+import bcl2fastq_pipeline.instruments as instruments
+import bcl2fastq_pipeline.runMetadata as runMetadata
+
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+
+ORIENTATIONS = [(False, False), (True, False), (False, True), (True, True)]
+
+
+class PreflightError(Exception):
+    pass
+
+
+def revcomp(s):
+    return s.translate(COMPLEMENT)[::-1]
+
+
+def readSampleSheet(ss):
+    '''
+    Returns the lines of the sample sheet, the index of the [Data] header line
+    (or None) and the [Data] rows as dictionaries.
+    '''
+    with open(ss) as f:
+        lines = f.read().splitlines()
+    for i, line in enumerate(lines):
+        if line.startswith("[Data]"):
+            rows = [r for r in csv.DictReader(lines[i + 1:]) if any(r.values())]
+            return lines, i + 1, rows
+    return lines, None, []
+
+
+def getSamples(rows, rc7=False, rc5=False):
+    '''
+    Return a list of (lane or None, index, index2) in the given orientation
+    '''
+    samples = []
+    for r in rows:
+        i7 = (r.get("index") or "").strip().upper()
+        i5 = (r.get("index2") or "").strip().upper()
+        lane = r.get("Lane")
+        samples.append((
+            int(lane) if lane and lane.strip().isdigit() else None,
+            revcomp(i7) if rc7 else i7,
+            revcomp(i5) if rc5 else i5,
+        ))
+    return samples
+
+
+def indexCycles(reads, i7len, i5len):
+    '''
+    The cycles holding the first i7len bases of the first index read and the
+    first i5len bases of the second, according to RunInfo.xml
+    '''
+    indexReads = [(start, nc) for (start, nc, isIndex) in reads if isIndex]
+    cycles = []
+    for (start, nc), length in zip(indexReads, [i7len, i5len]):
+        cycles.extend(range(start, start + min(nc, length)))
+    return cycles
+
+
+def barcodeMismatches(options):
+    '''
+    The mismatches bcl2fastq allows in (index, index2), from its options
+    '''
+    m = re.search(r'--barcode-mismatches[ =]([0-9,]+)', options)
+    if m is None:
+        return 1, 1
+    values = [int(x) for x in m.group(1).split(",")]
+    return values[0], values[-1]
+
+
+def _key(seq):
+    '''
+    A barcode packed like pyBarcodes does, followed by its N mask
+    '''
+    code = 0
+    nmask = 0
+    for b in seq:
+        code = (code << 2) | max("ACGT".find(b), 0)
+        nmask = (nmask << 1) | (b == "N")
+    return (code << len(seq)) | nmask
+
+
+def _neighbourhood(seq, mismatches):
+    '''
+    The keys of seq and of everything within the given number of mismatches
+    (an N is a mismatch)
+    '''
+    keys = set()
+    for n in range(min(mismatches, len(seq)) + 1):
+        for positions in itertools.combinations(range(len(seq)), n):
+            choices = [[b for b in "ACGTN" if b != seq[p]] for p in positions]
+            for bases in itertools.product(*choices):
+                s = list(seq)
+                for p, b in zip(positions, bases):
+                    s[p] = b
+                keys.add(_key("".join(s)))
+    return keys
+
+
+def _ids(observed, seqs, mismatches):
+    '''
+    For each observed key, the indices in seqs it's within mismatches of.
+    A key can be close to several sequences (the other index may still tell
+    them apart), so this is a list of arrays: the first, second, ... match,
+    -1 where there's none.
+    '''
+    pairs = sorted((k, i) for i, seq in enumerate(seqs) for k in _neighbourhood(seq, mismatches))
+    keys = np.array([k for k, i in pairs], dtype=np.uint64)
+    owners = np.array([i for k, i in pairs], dtype=np.int64)
+    left = np.searchsorted(keys, observed, side="left")
+    n = np.searchsorted(keys, observed, side="right") - left
+    rv = []
+    for j in range(int(n.max()) if len(n) else 0):
+        rv.append(np.where(n > j, owners[np.minimum(left + j, len(keys) - 1)], -1))
+    return rv
+
+
+def _part(codes, nmasks, nCycles, start, length):
+    '''
+    The keys of cycles start to start + length of packed barcodes
+    '''
+    shift = nCycles - start - length
+    code = (codes >> np.uint64(2 * shift)) & np.uint64((1 << 2 * length) - 1)
+    nmask = (nmasks.astype(np.uint64) >> np.uint64(shift)) & np.uint64((1 << length) - 1)
+    return (code << np.uint64(length)) | nmask
+
+
+def matched(observed, samples, i7len, i5len, mismatches=(1, 1)):
+    '''
+    The average (over lanes) percentage of sampled clusters whose barcode
+    matches a sample in that lane, with up to mismatches (index, index2)
+    mismatches. observed holds the (codes, nmasks, counts) of each lane, as
+    returned by pyBarcodes.getLaneStats(arrays=True), so low abundance
+    barcodes are counted too.
+    '''
+    pcts = []
+    for lane, (codes, nmasks, counts) in observed.items():
+        laneSamples = [(i7, i5) for (l, i7, i5) in samples if l is None or l == lane]
+        laneSamples = [s for s in laneSamples if re.fullmatch("[ACGT]*", s[0] + s[1])]
+        total = counts.sum()
+        if not laneSamples or total == 0:
+            continue
+        codes = codes.astype(np.uint64)
+        hit = np.zeros(len(codes), dtype=bool)
+        #Samples with shorter indices only need to match their first bases
+        for l7, l5 in set((len(i7), len(i5)) for i7, i5 in laneSamples):
+            group = [(i7, i5) for i7, i5 in laneSamples if len(i7) == l7 and len(i5) == l5]
+            seqs7 = sorted(set(i7 for i7, i5 in group))
+            seqs5 = sorted(set(i5 for i7, i5 in group))
+            pairs = np.array([seqs7.index(i7) * len(seqs5) + seqs5.index(i5) for i7, i5 in group])
+            all5 = _ids(_part(codes, nmasks, i7len + i5len, i7len, l5), seqs5, mismatches[1])
+            for ids7 in _ids(_part(codes, nmasks, i7len + i5len, 0, l7), seqs7, mismatches[0]):
+                for ids5 in all5:
+                    hit |= (ids7 >= 0) & (ids5 >= 0) & np.isin(ids7 * len(seqs5) + ids5, pairs)
+        pcts.append(100.0 * counts[hit].sum() / total)
+    if not pcts:
+        return None
+    return sum(pcts) / len(pcts)
+
+
+def rewriteSampleSheet(ss, lines, start, rc7, rc5):
+    '''
+    Reverse complement the index and/or index2 columns of the [Data] section,
+    the original is kept with a .preflight suffix
+    '''
+    data = [r for r in csv.reader(lines[start:])]
+    header = data[0]
+    for row in data[1:]:
+        for col, rc in [("index", rc7), ("index2", rc5)]:
+            if rc and col in header and header.index(col) < len(row):
+                row[header.index(col)] = revcomp(row[header.index(col)].strip().upper())
+    out = io.StringIO()
+    csv.writer(out, lineterminator="\n").writerows(data)
+    shutil.copyfile(ss, "{}.preflight".format(ss))
+    with open(ss, "w") as f:
+        f.write("\n".join(lines[:start]) + "\n" + out.getvalue())
+
+
+def preflight(config):
+    '''
+    Check the sample sheet against the barcodes on the flow cell. Raises
+    PreflightError if they don't match (and can't be corrected).
+    '''
+    mode = config.get("Preflight", "mode", fallback="correct")
+    if mode == "off" or config.get("Options", "singleCell") == "1":
+        return
+
+    try:
+        import pyBarcodes
+    except ImportError:
+        syslog.syslog("[preflight] pyBarcodes isn't available, skipping\n")
+        return
+
+    instrument = instruments.getInstrument(config)
+    if instrument is None or instrument.runType not in ["NextSeq", "HiSeq2500", "HiSeq3000", "MiSeq"]:
+        syslog.syslog("[preflight] Unsupported instrument for {}, skipping\n".format(config.get("Options", "runID")))
+        return
+
+    ss = config.get("Options", "sampleSheet")
+    lines, start, rows = readSampleSheet(ss)
+    samples = getSamples(rows)
+    i7len = max([len(s[1]) for s in samples] + [0])
+    i5len = max([len(s[2]) for s in samples] + [0])
+    if i7len == 0:
+        return
+
+    runDir = os.path.join(config.get("Paths", "baseDir"), config.get("Options", "sequencer"), "data", config.get("Options", "runID"))
+    cycles = indexCycles(runMetadata.load(runDir).reads, i7len, i5len)
+    if len(cycles) != i7len + i5len or len(cycles) > 32 or max(i7len, i5len) > 21:
+        syslog.syslog("[preflight] The index reads in RunInfo.xml don't fit the sample sheet, skipping\n")
+        return
+
+    observed = pyBarcodes.getLaneStats(
+        runDir, instrument.runType, cycles,
+        tiles=config.getint("Preflight", "tiles", fallback=8),
+        threads=config.getint("Preflight", "threads", fallback=4),
+        arrays=True)
+    mismatches = barcodeMismatches(config.get("bcl2fastq", "bcl2fastq_options", fallback=""))
+
+    scores = {}
+    for (rc7, rc5) in ORIENTATIONS:
+        if rc5 and i5len == 0:
+            continue
+        scores[(rc7, rc5)] = matched(observed, getSamples(rows, rc7, rc5), i7len, i5len, mismatches)
+    if scores[(False, False)] is None:
+        syslog.syslog("[preflight] No lanes with samples were sampled, skipping\n")
+        return
+
+    summary = ", ".join("{}{}: {:.1f}%".format(
+        "index RC" if rc7 else "index",
+        "" if i5len == 0 else (" + index2 RC" if rc5 else " + index2"),
+        pct) for (rc7, rc5), pct in scores.items())
+    syslog.syslog("[preflight] {} {}\n".format(config.get("Options", "runID"), summary))
+
+    minMatched = config.getfloat("Preflight", "minMatched", fallback=50)
+    if scores[(False, False)] >= minMatched:
+        return
+
+    best = max(scores, key=lambda x: scores[x])
+    if mode == "correct" and best != (False, False) and scores[best] >= minMatched:
+        syslog.syslog("[preflight] Reverse complementing{}{} in {}\n".format(
+            " index" if best[0] else "",
+            " index2" if best[1] else "",
+            ss))
+        rewriteSampleSheet(ss, lines, start, best[0], best[1])
+        return
+
+    raise PreflightError("Only {:.1f}% of the sampled clusters match the sample sheet ({}). Check the indices and the ReverseComplementIndexP5/P7 options.\n".format(scores[(False, False)], summary))
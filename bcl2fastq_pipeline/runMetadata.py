@@ -0,0 +1,170 @@
+'''
+This file parses the metadata of a run once: RunInfo.xml and RunParameters.xml
+in the run folder and, once bcl2fastq has run, Stats/Stats.json in the output
+directory. RunMetadata objects are memoized on the modification times of these
+files, so asking again only costs a stat() of each, until one of them changes.
+
+    meta = runMetadata.get(config)
+    meta.reads           #[(first cycle, number of cycles, is an index read), ...]
+    meta.lanes           #The number of lanes on the flow cell
+    meta.indexCycles     #The number of cycles of each index read
+    meta.instrument(config)
+    meta.demuxTotals     #{lane: {"Clusters": ..., "Clusters PF": ..., "Undetermined": ...}}
+    meta.readGeometry()  #E.g., for the emails and MultiQC reports
+
+runMetadata.load(runDir) does the same for a run folder without a config.
+'''
+import json
+import os
+import xml.etree.ElementTree as ET
+import bcl2fastq_pipeline.instruments as instruments
+import bcl2fastq_pipeline.stages as stages
+
+#{(runDir, flowDir): (modification times, RunMetadata)}
+_cache = {}
+
+
+def _mtime(fname):
+    try:
+        return os.stat(fname).st_mtime_ns
+    except OSError:
+        return None
+
+
+class RunMetadata:
+    def __init__(self, runDir, flowDir=None):
+        self.runDir = runDir
+        self.flowDir = flowDir
+        self.runID = os.path.basename(os.path.normpath(runDir))
+        self.flowcell = None
+        self.serial = None
+        self.reads = []
+        self.lanes = 1
+        self.tiles = 0
+        self.application = None
+        self.parametersFile = self._parametersFile()
+        self.demuxTotals = {}
+        self.readInfos = None
+        self._parseRunInfo()
+        self._parseRunParameters()
+        self._parseStats()
+
+    def _parametersFile(self):
+        #Illumina sequencer update - RunParameters.xml -> runParameters.xml
+        for name in ["RunParameters.xml", "runParameters.xml"]:
+            if os.path.isfile(os.path.join(self.runDir, name)):
+                return os.path.join(self.runDir, name)
+        return None
+
+    def files(self):
+        '''
+        The files this is parsed from, whether or not they exist
+        '''
+        files = [os.path.join(self.runDir, "RunInfo.xml"), self.parametersFile or os.path.join(self.runDir, "RunParameters.xml")]
+        if self.flowDir:
+            files.append(os.path.join(self.flowDir, "Stats", "Stats.json"))
+        return files
+
+    def _parseRunInfo(self):
+        fname = os.path.join(self.runDir, "RunInfo.xml")
+        if not os.path.isfile(fname):
+            return
+        run = ET.parse(fname).getroot()[0]
+        self.runID = run.get("Id", self.runID)
+        self.flowcell = run.findtext("Flowcell")
+        self.serial = run.findtext("Instrument")
+        cycle = 1
+        for read in run.find("Reads").findall("Read"):
+            nc = int(read.get("NumCycles"))
+            self.reads.append((cycle, nc, read.get("IsIndexedRead") == "Y"))
+            cycle += nc
+        layout = run.find("FlowcellLayout")
+        if layout is not None:
+            self.lanes = int(layout.get("LaneCount", 1))
+            self.tiles = 1
+            for k in ["LaneCount", "SurfaceCount", "SwathCount", "TileCount"]:
+                self.tiles *= int(layout.get(k, 1))
+
+    def _parseRunParameters(self):
+        if self.parametersFile is None:
+            return
+        root = ET.parse(self.parametersFile).getroot()
+        for tag in ["ApplicationName", "Setup/ApplicationName", "Application"]:
+            if root.findtext(tag):
+                self.application = root.findtext(tag)
+                break
+
+    def _parseStats(self):
+        if not self.flowDir or not os.path.isfile(os.path.join(self.flowDir, "Stats", "Stats.json")):
+            return
+        with open(os.path.join(self.flowDir, "Stats", "Stats.json")) as f:
+            stats = json.load(f)
+        infos = stats.get('ReadInfosForLanes') or [{}]
+        self.readInfos = infos[0].get('ReadInfos', None)
+        for result in stats.get('ConversionResults', []):
+            self.demuxTotals[int(result['LaneNumber'])] = {
+                'Clusters': int(result.get('TotalClustersRaw', 0)),
+                'Clusters PF': int(result.get('TotalClustersPF', 0)),
+                'Undetermined': int((result.get('Undetermined') or {}).get('NumberReads', 0)),
+            }
+
+    @property
+    def cycles(self):
+        return sum(nc for start, nc, isIndex in self.reads)
+
+    @property
+    def indexCycles(self):
+        return [nc for start, nc, isIndex in self.reads if isIndex]
+
+    def instrument(self, config):
+        '''
+        The instruments.Instrument of the run, or None
+        '''
+        return instruments.lookup(instruments.getRegistry(config), self.runID)
+
+    def readGeometry(self):
+        '''
+        A description of the (non-index) reads, from Stats.json once bcl2fastq
+        has run and from RunInfo.xml before that
+        '''
+        R1 = None
+        R2 = None
+        if self.readInfos is not None:
+            for read in self.readInfos:
+                if read['IsIndexedRead'] == True:
+                    continue
+                elif read['Number'] == 1:
+                    R1 = int(read['NumCycles'])
+                elif read['Number'] == 2:
+                    R2 = int(read['NumCycles'])
+        else:
+            reads = [nc for start, nc, isIndex in self.reads if not isIndex]
+            R1 = reads[0] if len(reads) > 0 else None
+            R2 = reads[1] if len(reads) > 1 else None
+        if R1 and R2:
+            return 'Paired end - forward read length (R1): {}, reverse read length (R2): {}'.format(R1,R2)
+        elif R1:
+            return 'Single end - read length (R1): {}'.format(R1)
+        return 'Read geometry could not be automatically determined.'
+
+
+def load(runDir, flowDir=None):
+    '''
+    The RunMetadata of runDir (and of the bcl2fastq output in flowDir, if
+    given). This is only parsed again if one of the files changed.
+    '''
+    key = (runDir, flowDir)
+    cached = _cache.get(key)
+    if cached is not None and cached[0] == [_mtime(f) for f in cached[1].files()]:
+        return cached[1]
+    meta = RunMetadata(runDir, flowDir)
+    _cache[key] = ([_mtime(f) for f in meta.files()], meta)
+    return meta
+
+
+def runDir(config):
+    return os.path.join(config.get("Paths", "baseDir"), config.get("Options", "sequencer"), "data", config.get("Options", "runID"))
+
+
+def get(config):
+    return load(runDir(config), stages.stageDir(config))
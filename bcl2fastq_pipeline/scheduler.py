@@ -0,0 +1,233 @@
+'''
+This file holds the flow cell scheduler, which allows several flow cells to be
+processed at the same time.
+
+Each flow cell is processed in its own process (see processFlowcell() in
+bfq.py). This is required since the workers in afterFastq.py rely on
+module-level state (localConfig) and change the working directory. The
+existing bcl.done, files.renamed and fastq.made files are still used as
+checkpoints, so a flow cell that fails part way through picks up where it left
+off the next time it's scheduled. A flow cell that fails isn't submitted
+again for [Options] sleepTime hours, so it doesn't send an error email every
+time the main loop wakes up.
+
+Stages that compete for the same resources across flow cells need to acquire
+a slot first (see slot()). A slot is an flock()ed file under [Paths] logDir,
+so the kernel releases it if the process holding it dies, even with SIGKILL.
+The budgets are set under [Scheduler] and are read again on every pass of the
+main loop. Changes apply to the flow cells started afterwards:
+  maxFlowcells     - The number of flow cells processed at once
+  bcl2fastqSlots   - The number of concurrent bcl2fastq/cellranger processes
+  ioSlots          - The number of concurrent finalize() steps (md5sum/7za)
+  fastqScreenSlots - The number of concurrent fastq_screen processes, summed
+                     over all flow cells
+  priority         - The order in which queued flow cells are started. One of
+                     fifo, smallest or oldest.
+'''
+import fcntl
+import multiprocessing as mp
+import os
+import sys
+import signal
+import syslog
+import time
+import contextlib
+import bcl2fastq_pipeline.runMetadata as runMetadata
+
+#slot name -> (config key, default budget)
+SLOTS = {
+    'bcl2fastq': ('bcl2fastqSlots', 1),
+    'io': ('ioSlots', 1),
+    'fastqScreen': ('fastqScreenSlots', 4),
+}
+
+PRIORITIES = ['fifo', 'smallest', 'oldest']
+
+#Seconds between attempts to get a slot while they're all held
+SLOT_POLL = 5
+
+#{slot name: lock files}, set in each flow cell process and inherited by any
+#pool workers it starts
+_slots = None
+
+
+def slotFiles(config):
+    '''
+    The lock files of each slot, one per unit of its budget
+    '''
+    d = os.path.join(config.get("Paths", "logDir"), ".slots")
+    os.makedirs(d, exist_ok=True)
+    files = {}
+    for name, (key, default) in SLOTS.items():
+        n = max(1, config.getint("Scheduler", key, fallback=default))
+        files[name] = [os.path.join(d, "{}.{}.lock".format(name, i)) for i in range(n)]
+    return files
+
+
+def _lock(files):
+    '''
+    flock() one of files, waiting until one is free. Returns its descriptor.
+    '''
+    while True:
+        for fname in files:
+            fd = os.open(fname, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        time.sleep(SLOT_POLL)
+
+
+@contextlib.contextmanager
+def slot(name):
+    '''
+    Hold one of the named slots for the duration of a with block. Outside of
+    a scheduled flow cell (e.g., when running steps manually) this does nothing.
+    '''
+    files = _slots.get(name) if _slots else None
+    fd = _lock(files) if files else None
+    try:
+        yield
+    finally:
+        if fd is not None:
+            #Also releases it for any pool workers forked in the meantime
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+def runKey(config):
+    lanes = config.get("Options", "lanes")
+    if lanes != "":
+        lanes = "_lanes{}".format(lanes)
+    return "{}{}".format(config.get("Options", "runID"), lanes)
+
+
+def runSize(config):
+    '''
+    A rough measure of the amount of data in a run: the number of cycles
+    times the number of tiles, according to RunInfo.xml. 0 if that can't be
+    determined.
+    '''
+    try:
+        meta = runMetadata.load(runMetadata.runDir(config))
+        return meta.cycles * meta.tiles
+    except:
+        return 0
+
+
+def _runChild(target, config, slots):
+    global _slots
+    _slots = slots
+    #The handlers of the main loop make no sense here
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    if not target(config):
+        sys.exit(1)
+    #Only a flow cell that finished wakes the main loop early, see bfq.py
+    os.kill(os.getppid(), signal.SIGHUP)
+
+
+class FlowcellScheduler:
+    '''
+    Keeps track of queued and running flow cells. This is created once by
+    bfq.py and survives the module reloads in the main loop.
+
+    target is called with the configuration of a single flow cell in a new
+    process and should return True on success.
+    '''
+    def __init__(self, config, target):
+        self.target = target
+        self.ctx = mp.get_context("fork")
+        self.queued = {}
+        self.running = {}
+        self.submitted = 0
+        #key -> time after which a failed flow cell may be submitted again
+        self.failed = {}
+        self.configure(config)
+
+    def configure(self, config):
+        '''
+        (Re)read the budgets and priority, bfq.py calls this on every pass
+        '''
+        self.maxFlowcells = config.getint("Scheduler", "maxFlowcells", fallback=1)
+        self.priority = config.get("Scheduler", "priority", fallback="fifo")
+        if self.priority not in PRIORITIES:
+            syslog.syslog("[FlowcellScheduler] Unknown priority {}, using fifo\n".format(self.priority))
+            self.priority = "fifo"
+        self.slots = slotFiles(config)
+        self.retryDelay = float(config.get("Options", "sleepTime", fallback="1")) * 60 * 60
+
+    def isActive(self, config):
+        key = runKey(config)
+        return key in self.queued or key in self.running
+
+    def isBackingOff(self, config):
+        '''
+        True if the flow cell failed less than sleepTime hours ago
+        '''
+        key = runKey(config)
+        if key not in self.failed:
+            return False
+        if time.time() < self.failed[key]:
+            return True
+        del self.failed[key]
+        return False
+
+    def submit(self, config, marker=None):
+        '''
+        Queue a flow cell. config must be a copy that's not modified later on,
+        marker is the completion file, whose mtime is used by "oldest".
+        '''
+        key = runKey(config)
+        try:
+            age = os.path.getmtime(marker)
+        except:
+            age = 0
+        self.submitted += 1
+        self.queued[key] = {
+            'config': config,
+            'order': self.submitted,
+            'size': runSize(config) if self.priority == "smallest" else 0,
+            'age': age,
+        }
+        syslog.syslog("[FlowcellScheduler] Queued {}\n".format(key))
+
+    def _sortKey(self, item):
+        if self.priority == "smallest":
+            return (item['size'], item['order'])
+        elif self.priority == "oldest":
+            return (item['age'], item['order'])
+        return item['order']
+
+    def reap(self):
+        '''
+        Clean up flow cells that have finished, returns their keys.
+        '''
+        done = []
+        for key, p in list(self.running.items()):
+            if p.is_alive():
+                continue
+            p.join()
+            if p.exitcode != 0:
+                syslog.syslog("[FlowcellScheduler] {} exited with {}, not retrying for {} hours\n".format(key, p.exitcode, self.retryDelay / 3600))
+                self.failed[key] = time.time() + self.retryDelay
+            else:
+                syslog.syslog("[FlowcellScheduler] {} finished\n".format(key))
+            del self.running[key]
+            done.append(key)
+        return done
+
+    def launch(self):
+        '''
+        Start queued flow cells, in order of priority, while there's room.
+        '''
+        self.reap()
+        for key, item in sorted(self.queued.items(), key=lambda x: self._sortKey(x[1])):
+            if len(self.running) >= self.maxFlowcells:
+                break
+            p = self.ctx.Process(target=_runChild, args=(self.target, item['config'], self.slots), name=key)
+            p.start()
+            syslog.syslog("[FlowcellScheduler] Started {} (pid {})\n".format(key, p.pid))
+            self.running[key] = p
+            del self.queued[key]
@@ -0,0 +1,293 @@
+'''
+This file runs bcl2fastq as one process per lane (or group of lanes), so a
+single slow lane no longer holds up the whole flow cell. It's used by bcl2fq()
+in makeFastq.py when [bcl2fastq] shards is set:
+
+    lanes       - One bcl2fastq per lane
+    1_2,3_4     - One bcl2fastq per group of lanes, separated by commas
+
+Each shard is restricted to its lanes with --tiles and writes to its own
+directory (.shards/<name> in the flow cell directory, with its own InterOp/).
+The thread budget, [bcl2fastq] threads (default: all CPUs), is split over the
+shards by rewriting -r/-p/-w. With [bcl2fastq] numa=1 the shards are also
+spread over the NUMA nodes with numactl.
+
+Once every shard has finished, merge() puts everything where a single
+bcl2fastq would have:
+
+ * fastq files found in more than one shard (e.g., with --no-lane-splitting)
+   are concatenated in lane order. A gzip file may have several members, so
+   the result is a valid fastq.gz with the reads ordered as bcl2fastq would
+   have. The _S<n> sample numbers are ignored when matching, fixNames()
+   removes them anyway.
+ * Stats/Stats.json is merged (each lane comes from one shard), as are
+   ConversionStats.xml and DemultiplexingStats.xml and the
+   InterOp/IndexMetricsOut.bin files.
+ * Other text files in more than one shard (e.g., Stats/AdapterTrimming.txt
+   or the FastqSummary and DemuxSummary files) are concatenated, without
+   repeating the header line.
+ * Each shard's HTML report is kept complete, under Reports/<shard>/.
+ * Anything else is moved if no other shard has it. Otherwise the first
+   shard's copy keeps its name and the others get the shard name appended
+   (e.g., foo_L2.bin).
+
+cellranger mkfastq is never sharded.
+'''
+import copy
+import glob
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import syslog
+import xml.etree.ElementTree as ET
+import bcl2fastq_pipeline.stages as stages
+
+SHARD_DIR = ".shards"
+
+#bcl2fastq's thread options and their defaults (None: all CPUs)
+THREAD_OPTIONS = [("-r", "--loading-threads", 4),
+                  ("-p", "--processing-threads", None),
+                  ("-w", "--writing-threads", 4)]
+
+SAMPLE_NUMBER = re.compile(r'_S[0-9]+(?=(_L[0-9]{3})?_[RI][12]_001\.fastq\.gz$)')
+
+#XML files merged rather than moved, relative to a shard directory
+MERGED_XML = ["Stats/ConversionStats.xml", "Stats/DemultiplexingStats.xml"]
+
+
+def groups(config, lanes):
+    '''
+    The lanes of each shard given the lanes being processed, or [] if
+    bcl2fastq shouldn't be sharded
+    '''
+    setting = config.get("bcl2fastq", "shards", fallback="").strip()
+    if setting in ["", "0", "off"] or config.get("Options", "singleCell", fallback="0") == "1":
+        return []
+    if "--tiles" in config.get("bcl2fastq", "bcl2fastq_options"):
+        syslog.syslog("[shards] bcl2fastq_options already has --tiles, not sharding\n")
+        return []
+    if setting == "lanes":
+        shards = [[l] for l in lanes]
+    else:
+        shards = [[int(l) for l in g.split("_") if int(l) in lanes] for g in setting.split(",")]
+        shards = [g for g in shards if g]
+        missing = sorted(set(lanes) - set(l for g in shards for l in g))
+        if missing:
+            #Lanes not in a group still need to be processed
+            shards.append(missing)
+    if len(shards) < 2:
+        return []
+    return shards
+
+
+def name(lanes):
+    return "L{}".format("_".join(str(l) for l in lanes))
+
+
+def splitThreads(options, n, threads=None):
+    '''
+    options with bcl2fastq's -r/-p/-w (or their long forms) set to 1/n of
+    their value (of threads for -p if it's not given)
+    '''
+    threads = threads or os.cpu_count() or 1
+    args = shlex.split(options)
+    values = {}
+    kept = []
+    i = 0
+    while i < len(args):
+        for short, long, default in THREAD_OPTIONS:
+            if args[i] in [short, long] and i + 1 < len(args):
+                values[short] = int(args[i + 1])
+                i += 1
+                break
+            elif args[i].startswith(long + "="):
+                values[short] = int(args[i].split("=", 1)[1])
+                break
+        else:
+            kept.append(args[i])
+        i += 1
+    for short, long, default in THREAD_OPTIONS:
+        total = values.get(short, default or threads)
+        kept.extend([short, str(max(1, total // n))])
+    return " ".join(shlex.quote(a) for a in kept)
+
+
+def numaNodes():
+    return sorted(int(d[len("/sys/devices/system/node/node"):]) for d in glob.glob("/sys/devices/system/node/node[0-9]*"))
+
+
+def run(commands, logs, numa=False):
+    '''
+    Run the commands at the same time, each logging to the matching file in
+    logs. Raises a CalledProcessError for the first one that fails, once
+    they've all finished.
+    '''
+    nodes = numaNodes() if numa else []
+    if numa and len(nodes) < 2:
+        syslog.syslog("[shards] Not using numactl, {} NUMA node(s)\n".format(len(nodes)))
+        nodes = []
+    procs = []
+    for i, (cmd, log) in enumerate(zip(commands, logs)):
+        if nodes:
+            node = nodes[i % len(nodes)]
+            cmd = "numactl --cpunodebind={0} --membind={0} {1}".format(node, cmd)
+        syslog.syslog("[shards] Running: {}\n".format(cmd))
+        logOut = open(log, "w")
+        procs.append((cmd, logOut, subprocess.Popen(cmd, stdout=logOut, stderr=subprocess.STDOUT, shell=True)))
+    failed = None
+    for cmd, logOut, p in procs:
+        rv = stages.wait(p)
+        logOut.close()
+        if rv != 0 and failed is None:
+            failed = subprocess.CalledProcessError(rv, cmd)
+    if failed is not None:
+        raise failed
+
+
+def _concatenate(sources, dest):
+    with open("{}.tmp".format(dest), "wb") as o:
+        for src in sources:
+            with open(src, "rb") as f:
+                shutil.copyfileobj(f, o, 16 * 1024 * 1024)
+    os.replace("{}.tmp".format(dest), dest)
+    for src in sources:
+        os.remove(src)
+
+
+def mergeStatsJSON(sources, dest):
+    '''
+    Stats.json with the lanes of each source, they're all from one flow cell
+    '''
+    merged = None
+    for src in sources:
+        with open(src) as f:
+            js = json.load(f)
+        if merged is None:
+            merged = js
+            continue
+        for k in ["ConversionResults", "ReadInfosForLanes", "UnknownBarcodes"]:
+            merged.setdefault(k, []).extend(js.get(k, []))
+    for k in ["ConversionResults", "ReadInfosForLanes", "UnknownBarcodes"]:
+        merged.get(k, []).sort(key=lambda x: int(x.get("LaneNumber", x.get("Lane", 0))))
+    with open("{}.tmp".format(dest), "w") as f:
+        json.dump(merged, f, indent=2)
+    os.replace("{}.tmp".format(dest), dest)
+
+
+def concatenateText(sources, dest):
+    '''
+    Concatenate text files, leaving out the first line of later files if
+    it's the same as the header of the first
+    '''
+    header = None
+    with open("{}.tmp".format(dest), "w") as o:
+        for src in sources:
+            with open(src) as f:
+                for i, line in enumerate(f):
+                    if i == 0:
+                        if header is None:
+                            header = line
+                        elif line == header:
+                            continue
+                    o.write(line)
+    os.replace("{}.tmp".format(dest), dest)
+
+
+def _key(elem):
+    return (elem.tag, tuple(sorted(elem.attrib.items())))
+
+
+def _mergeElement(dst, src):
+    children = {_key(c): c for c in dst}
+    for child in src:
+        match = children.get(_key(child))
+        if match is not None and len(match) and len(child):
+            _mergeElement(match, child)
+        else:
+            dst.append(copy.deepcopy(child))
+
+
+def mergeXML(sources, dest):
+    '''
+    ConversionStats.xml or DemultiplexingStats.xml with the lanes of each
+    source. Projects, samples and barcodes are matched on their names, their
+    Lane elements come from one shard each.
+    '''
+    tree = ET.parse(sources[0])
+    for src in sources[1:]:
+        _mergeElement(tree.getroot(), ET.parse(src).getroot())
+    tree.write("{}.tmp".format(dest), encoding="utf-8", xml_declaration=True)
+    os.replace("{}.tmp".format(dest), dest)
+
+
+def mergeIndexMetrics(sources, dest):
+    '''
+    IndexMetricsOut.bin is a version byte followed by records
+    '''
+    version = None
+    with open("{}.tmp".format(dest), "wb") as o:
+        for src in sources:
+            with open(src, "rb") as f:
+                data = f.read()
+            if not data:
+                continue
+            if version is None:
+                version = data[0]
+                o.write(data[:1])
+            elif data[0] != version:
+                raise ValueError("{} is IndexMetrics version {}, not {}".format(src, data[0], version))
+            o.write(data[1:])
+    os.replace("{}.tmp".format(dest), dest)
+
+
+def _files(d):
+    for root, dirs, files in os.walk(d):
+        for f in files:
+            yield os.path.relpath(os.path.join(root, f), d)
+
+
+def merge(flowDir, shardDirs, interopDir):
+    '''
+    Merge the output of the shards into flowDir and their InterOp directories
+    into interopDir, see above. The shard directories are removed afterwards.
+    '''
+    found = {}
+    for d in shardDirs:
+        for rel in _files(d):
+            key = SAMPLE_NUMBER.sub("", rel) if rel.endswith(".fastq.gz") else rel
+            if rel.startswith("Reports/"):
+                #The HTML reports link to each other, so they're kept whole
+                key = os.path.join("Reports", os.path.basename(d), rel[len("Reports/"):])
+            found.setdefault(key, []).append((d, rel))
+
+    for key, sources in sorted(found.items()):
+        rel = sources[0][1]
+        paths = [os.path.join(d, r) for d, r in sources]
+        if rel.startswith("InterOp/"):
+            dest = os.path.join(interopDir, rel[len("InterOp/"):])
+        else:
+            dest = os.path.join(flowDir, key if rel.startswith("Reports/") else rel)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if len(paths) == 1:
+            shutil.move(paths[0], dest)
+        elif rel.endswith(".fastq.gz"):
+            _concatenate(paths, dest)
+        elif rel == "Stats/Stats.json":
+            mergeStatsJSON(paths, dest)
+        elif rel in MERGED_XML:
+            mergeXML(paths, dest)
+        elif os.path.basename(rel) == "IndexMetricsOut.bin":
+            mergeIndexMetrics(paths, dest)
+        elif rel.endswith((".txt", ".csv", ".tsv")):
+            concatenateText(paths, dest)
+        else:
+            shutil.move(paths[0], dest)
+            root, ext = os.path.splitext(dest)
+            for (d, r), path in zip(sources[1:], paths[1:]):
+                syslog.syslog("[shards] Keeping {} from {} as {}_{}{}\n".format(rel, os.path.basename(d), os.path.basename(root), os.path.basename(d), ext))
+                shutil.move(path, "{}_{}{}".format(root, os.path.basename(d), ext))
+
+    shutil.rmtree(os.path.join(flowDir, SHARD_DIR), ignore_errors=True)
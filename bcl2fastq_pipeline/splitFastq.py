@@ -0,0 +1,317 @@
+'''
+This file splits the output of clumpify (run with markduplicates=t) into
+optical duplicates and everything else. It replaces splitFastq.c, which read
+through zcat and wrote through four pigz processes.
+
+Everything happens in the calling process:
+  * BGZF input (e.g., from bgzip or bbmap with bgzip available) is split into
+    its blocks, which are inflated in a thread pool. Other gzip files are
+    inflated in a separate thread, so this still overlaps with the rest.
+  * Records are found by splitting large decompressed blocks on newlines, so
+    reads can be any length.
+  * Output is written as BGZF (readable by anything that reads gzip), with
+    the blocks compressed in the same thread pool. zlib releases the GIL
+    while (de)compressing, so the threads really do run in parallel.
+
+Example:
+
+    dupes, total = splitFastq(["S1_R1_clumped.fastq.gz", "S1_R2_clumped.fastq.gz"],
+                              ["S1_R1.fastq.gz", "S1_R2.fastq.gz"],
+                              ["S1_R1_optical_duplicates.fastq.gz", "S1_R2_optical_duplicates.fastq.gz"],
+                              threads=8)
+'''
+import collections
+import concurrent.futures
+import queue
+import struct
+import threading
+import zlib
+
+#The most uncompressed data in a BGZF block, as used by bgzip/htslib
+BLOCKSIZE = 0xff00
+#Decompressed input is handled in chunks of about this size
+CHUNKSIZE = 4*1024*1024
+#The number of BGZF blocks inflated per task
+INFLATEBLOCKS = 64
+
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+DUPLICATE = b" duplicate"
+
+
+class SplitError(Exception):
+    pass
+
+
+def _bgzfBlock(data, level):
+    '''
+    Compress data (at most BLOCKSIZE bytes) into one BGZF block
+    '''
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    if len(cdata) > 0x10000 - 26:
+        #Incompressible, store it
+        c = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = c.compress(data) + c.flush()
+    header = struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+class BGZFWriter:
+    '''
+    Write a BGZF file, compressing blocks in pool. At most maxPending blocks
+    are held in memory.
+    '''
+    def __init__(self, fname, pool, level=6, maxPending=32):
+        self.f = open(fname, "wb")
+        self.pool = pool
+        self.level = level
+        self.maxPending = maxPending
+        self.buf = bytearray()
+        self.pending = collections.deque()
+
+    def _submit(self, data):
+        self.pending.append(self.pool.submit(_bgzfBlock, data, self.level))
+        while len(self.pending) > self.maxPending:
+            self.f.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buf += data
+        if len(self.buf) >= BLOCKSIZE:
+            view = memoryview(self.buf)
+            n = len(self.buf) - len(self.buf) % BLOCKSIZE
+            for i in range(0, n, BLOCKSIZE):
+                self._submit(bytes(view[i:i + BLOCKSIZE]))
+            view.release()
+            del self.buf[:n]
+
+    def close(self):
+        if self.buf:
+            self._submit(bytes(self.buf))
+            self.buf = bytearray()
+        while self.pending:
+            self.f.write(self.pending.popleft().result())
+        self.f.write(BGZF_EOF)
+        self.f.close()
+
+
+def _isBGZF(header):
+    return len(header) >= 18 and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+
+def _inflateBlocks(blocks):
+    out = []
+    for block in blocks:
+        #The header is 18 bytes, the footer (CRC and size) 8
+        data = zlib.decompress(block[18:-8], -15)
+        crc, isize = struct.unpack("<II", block[-8:])
+        if isize != len(data) or crc != zlib.crc32(data):
+            raise SplitError("Corrupt BGZF block\n")
+        out.append(data)
+    return b"".join(out)
+
+
+def _readBGZF(f, pool, threads):
+    '''
+    Yield decompressed chunks of a BGZF file, inflating batches of blocks in pool
+    '''
+    pending = collections.deque()
+    batch = []
+    while True:
+        header = f.read(18)
+        if not header:
+            break
+        if not _isBGZF(header):
+            raise SplitError("Not a BGZF block\n")
+        bsize = struct.unpack("<H", header[16:18])[0] + 1
+        block = header + f.read(bsize - 18)
+        if len(block) != bsize:
+            raise SplitError("Truncated BGZF block\n")
+        batch.append(block)
+        if len(batch) == INFLATEBLOCKS:
+            pending.append(pool.submit(_inflateBlocks, batch))
+            batch = []
+            if len(pending) > 2 * threads:
+                yield pending.popleft().result()
+    if batch:
+        pending.append(pool.submit(_inflateBlocks, batch))
+    while pending:
+        yield pending.popleft().result()
+
+
+def inflateChunks(blocks):
+    '''
+    Yield the decompressed contents of blocks, an iterator over the bytes of a
+    (possibly multi-member) gzip file, in chunks of at most CHUNKSIZE
+    '''
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    member = False
+    for data in blocks:
+        while data:
+            member = True
+            out = d.decompress(data, CHUNKSIZE)
+            if out:
+                yield out
+            if d.eof:
+                #The next member of a concatenated file
+                data = d.unused_data
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                member = False
+            else:
+                data = d.unconsumed_tail
+    if member:
+        raise SplitError("Truncated gzip file\n")
+
+
+def lineBlocks(chunks, nlines=4):
+    '''
+    Yield lists of lines, a multiple of nlines long, from decompressed chunks
+    '''
+    leftover = b""
+    for chunk in chunks:
+        lines = (leftover + chunk).split(b"\n")
+        n = (len(lines) - 1) // nlines * nlines
+        leftover = b"\n".join(lines[n:])
+        yield lines[:n]
+    if leftover.strip():
+        raise SplitError("The input ends with an incomplete record\n")
+
+
+def _readGzip(f):
+    '''
+    Yield decompressed chunks of a gzip file, inflated in a background thread
+    '''
+    q = queue.Queue(maxsize=8)
+    stop = threading.Event()
+
+    def inflate():
+        try:
+            for chunk in inflateChunks(iter(lambda: f.read(CHUNKSIZE), b"")):
+                q.put(chunk)
+                if stop.is_set():
+                    return
+            q.put(None)
+        except Exception as e:
+            q.put(e)
+
+    t = threading.Thread(target=inflate, daemon=True)
+    t.start()
+    try:
+        while True:
+            chunk = q.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            if chunk:
+                yield chunk
+    finally:
+        stop.set()
+        #Unblock the thread if it's waiting on a full queue
+        while t.is_alive():
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                t.join(0.1)
+
+
+def readChunks(fname, pool, threads):
+    '''
+    Yield the decompressed contents of a gzipped (or BGZF) file in chunks
+    '''
+    with open(fname, "rb") as f:
+        header = f.read(18)
+        f.seek(0)
+        if _isBGZF(header):
+            yield from _readBGZF(f, pool, threads)
+        else:
+            yield from _readGzip(f)
+
+
+def readRecords(chunks, reads=1):
+    '''
+    Yield lists of records from decompressed chunks. Each record is a list of
+    whether the first read is marked as a duplicate, followed by the "reads"
+    fastq entries (bytes, with " duplicate" removed from the read names).
+    '''
+    nlines = 4 * reads
+    for lines in lineBlocks(chunks, nlines):
+        records = []
+        for i in range(0, len(lines), nlines):
+            record = [lines[i].endswith(DUPLICATE)]
+            for j in range(i, i + nlines, 4):
+                name = lines[j]
+                if name[:1] != b"@":
+                    raise SplitError("Expected a read name, got {}\n".format(name[:50]))
+                if name.endswith(DUPLICATE):
+                    name = name[:-len(DUPLICATE)]
+                record.append(b"\n".join([name, lines[j + 1], lines[j + 2], lines[j + 3], b""]))
+            records.append(record)
+        yield records
+
+
+def _pairRecords(r1, r2):
+    '''
+    Combine the records of two files into those of a pair
+    '''
+    p1 = []
+    p2 = []
+    for a in r1:
+        p1.extend(a)
+        while len(p2) < len(p1):
+            try:
+                p2.extend(next(r2))
+            except StopIteration:
+                raise SplitError("Read #2 has fewer reads than read #1\n")
+        n = len(p1)
+        yield [(x[0], x[1], y[1]) for x, y in zip(p1, p2[:n])]
+        p1 = []
+        p2 = p2[n:]
+    if p2 or next(r2, None):
+        raise SplitError("Read #2 has more reads than read #1\n")
+
+
+def splitFastq(ifiles, ofiles, dfiles, interleaved=False, threads=4, level=6):
+    '''
+    Split clumpify output into non-duplicates (written to ofiles) and optical
+    duplicates (written to dfiles), according to whether " duplicate" is at
+    the end of the name of read #1.
+
+    ifiles is [R1], [R1, R2] or, with interleaved=True, a single interleaved
+    paired-end file. ofiles and dfiles have one file per read (1 or 2).
+
+    Returns (duplicates, total), counting pairs for paired-end data.
+    '''
+    reads = len(ofiles)
+    if len(dfiles) != reads or reads not in [1, 2] or (len(ifiles) != reads and not (interleaved and len(ifiles) == 1)):
+        raise SplitError("splitFastq() needs one output file per read and matching inputs\n")
+
+    dupes = 0
+    total = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        outs = [BGZFWriter(f, pool, level) for f in ofiles]
+        douts = [BGZFWriter(f, pool, level) for f in dfiles]
+        try:
+            if len(ifiles) == 2:
+                records = _pairRecords(readRecords(readChunks(ifiles[0], pool, threads)),
+                                       readRecords(readChunks(ifiles[1], pool, threads)))
+            else:
+                records = readRecords(readChunks(ifiles[0], pool, threads), reads)
+
+            for batch in records:
+                keep = [[] for _ in range(reads)]
+                dup = [[] for _ in range(reads)]
+                for record in batch:
+                    out = dup if record[0] else keep
+                    dupes += record[0]
+                    for i in range(reads):
+                        out[i].append(record[i + 1])
+                total += len(batch)
+                for i in range(reads):
+                    outs[i].write(b"".join(keep[i]))
+                    douts[i].write(b"".join(dup[i]))
+        finally:
+            for w in outs + douts:
+                w.close()
+
+    return dupes, total
@@ -0,0 +1,158 @@
+'''
+This file records how long each stage of processing a flow cell takes and
+what it costs, so it's possible to see which stage dominates on each
+instrument type.
+
+Stages are wrapped in stage(), and their subprocesses are run with
+stages.check_call() (or waited for with stages.wait()), for example:
+
+    with stages.stage(config, "FastQC", fname):
+        stages.check_call(cmd, shell=True)
+
+Every stage appends one JSON line to stages.jsonl in the flow cell output
+directory (next to bcl2fastq.ini). This is safe from several pool workers at
+once. writeReport() converts that to stages.csv once the flow cell is done.
+
+For each stage the following are recorded:
+  wall      - Wall time, in seconds
+  cpu       - User plus system CPU time of the thread running the stage and
+              of the subprocesses it ran, in seconds
+  maxrss    - The largest peak resident set size (kB) of the subprocesses the
+              stage ran, from os.wait4(). null for stages without any (e.g.,
+              the native FastQC), there's no per-thread figure for those.
+  readBytes/writeBytes - Bytes read from and written to storage by the
+              thread (/proc/thread-self/io) and its subprocesses. null if
+              /proc/thread-self/io can't be read.
+
+Everything is measured per thread and per subprocess, so stages running at
+the same time in threads of one process (e.g., the archives and md5 sums)
+don't count each other's usage.
+'''
+import contextlib
+import csv
+import datetime
+import json
+import os
+import subprocess
+import syslog
+import threading
+import time
+
+FIELDS = ['runID', 'stage', 'item', 'pid', 'start', 'wall', 'cpu', 'maxrss', 'readBytes', 'writeBytes', 'failed']
+
+
+def stageDir(config):
+    lanes = config.get("Options", "lanes")
+    if lanes != "":
+        lanes = "_lanes{}".format(lanes)
+    return os.path.join(config.get("Paths", "outputDir"), "{}{}".format(config.get("Options", "runID"), lanes))
+
+
+#The stages open in each thread, innermost last
+_open = threading.local()
+
+
+def _io():
+    '''
+    Returns (read_bytes, write_bytes) for this thread, or None
+    '''
+    rv = {}
+    try:
+        with open("/proc/thread-self/io") as f:
+            for line in f:
+                k, v = line.split(":")
+                rv[k] = int(v)
+    except:
+        return None
+    return rv.get("read_bytes", 0), rv.get("write_bytes", 0)
+
+
+def wait(p):
+    '''
+    p.wait() for a subprocess.Popen, which also adds the CPU time, peak RSS and
+    I/O of p (and of its own subprocesses) to the stages open in this thread
+    '''
+    _, status, ru = os.wait4(p.pid, 0)
+    p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    for usage in getattr(_open, "stages", []):
+        usage['cpu'] += ru.ru_utime + ru.ru_stime
+        usage['maxrss'] = max(usage['maxrss'] or 0, ru.ru_maxrss)
+        #Linux counts these in 512 byte units
+        usage['readBytes'] += ru.ru_inblock * 512
+        usage['writeBytes'] += ru.ru_oublock * 512
+    return p.returncode
+
+
+def check_call(cmd, **kwargs):
+    '''
+    subprocess.check_call(), recording the usage of cmd in the open stages
+    '''
+    p = subprocess.Popen(cmd, **kwargs)
+    if wait(p):
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+
+
+@contextlib.contextmanager
+def stage(config, name, item=""):
+    '''
+    Record the resources used by the enclosed block as stage name. item is,
+    e.g., the file or project being processed.
+    '''
+    start = datetime.datetime.now()
+    t0 = time.monotonic()
+    cpu0 = time.thread_time()
+    io0 = _io()
+    usage = {'cpu': 0, 'maxrss': None, 'readBytes': 0, 'writeBytes': 0}
+    if not hasattr(_open, "stages"):
+        _open.stages = []
+    _open.stages.append(usage)
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        _open.stages.remove(usage)
+        io1 = _io()
+        record = {
+            'runID': config.get("Options", "runID"),
+            'stage': name,
+            'item': os.path.basename(item),
+            'pid': os.getpid(),
+            'start': start.isoformat(timespec="seconds"),
+            'wall': round(time.monotonic() - t0, 3),
+            'cpu': round(time.thread_time() - cpu0 + usage['cpu'], 3),
+            'maxrss': usage['maxrss'],
+            'readBytes': io1[0] - io0[0] + usage['readBytes'] if io0 and io1 else None,
+            'writeBytes': io1[1] - io0[1] + usage['writeBytes'] if io0 and io1 else None,
+            'failed': failed,
+        }
+        try:
+            d = stageDir(config)
+            os.makedirs(d, exist_ok=True)
+            #A single write of a short line to a file opened for appending isn't interleaved with other processes
+            with open(os.path.join(d, "stages.jsonl"), "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            syslog.syslog("[stage] Couldn't record {} ({})\n".format(name, e))
+
+
+def writeReport(config):
+    '''
+    Convert stages.jsonl to stages.csv, in the order in which the stages started
+    '''
+    d = stageDir(config)
+    records = []
+    try:
+        with open(os.path.join(d, "stages.jsonl")) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        return
+    records.sort(key=lambda x: x['start'])
+    with open(os.path.join(d, "stages.csv"), "w") as f:
+        w = csv.DictWriter(f, fieldnames=FIELDS, extrasaction="ignore")
+        w.writeheader()
+        w.writerows(records)
@@ -0,0 +1,212 @@
+'''
+This file contains a "tee" reader, so that a fastq.gz file is read and
+inflated once for several consumers, rather than once per step.
+
+tee() reads the compressed file in large blocks and inflates it, handing the
+compressed blocks and/or blocks of fastq records to each consumer. Every
+consumer runs in its own thread and is fed through a bounded queue, so the
+reader waits for the slowest one rather than buffering the file in memory.
+zlib, hashlib and most of NumPy release the GIL, so the consumers really do
+run alongside the inflation.
+
+For example, the native QC, the md5sum and the fastq_screen subsample of a
+file are computed with:
+
+    qc = stream.QCConsumer(fname, odir)
+    md5 = stream.MD5Consumer(fname, cache)
+    sample = stream.SampleConsumer(subsample, 1000000)
+    stream.tee(fname, [qc, md5, sample])
+
+Consumers subclass Consumer and set wantsRaw and/or wantsRecords.
+'''
+import hashlib
+import os
+import queue
+import threading
+import numpy as np
+import bcl2fastq_pipeline.checksum as checksum
+import bcl2fastq_pipeline.fastqQC as fastqQC
+from bcl2fastq_pipeline.splitFastq import CHUNKSIZE, inflateChunks, lineBlocks
+
+#Blocks queued per consumer
+MAXQUEUED = 8
+
+
+class Consumer:
+    '''
+    raw() gets the compressed file and records() lists of fastq lines (a
+    multiple of 4 long), both in order and in the consumer's own thread.
+    finish() is called from the calling thread once the whole file was read.
+    '''
+    wantsRaw = False
+    wantsRecords = False
+
+    def raw(self, data):
+        pass
+
+    def records(self, lines):
+        pass
+
+    def finish(self):
+        pass
+
+
+class MD5Consumer(Consumer):
+    '''
+    The md5sum of the compressed file, recorded in cache (see
+    checksum.rememberDigest()) if that's given
+    '''
+    wantsRaw = True
+
+    def __init__(self, fname, cache=None):
+        self.fname = fname
+        self.cache = cache
+        self.md5 = hashlib.md5()
+        self.digest = None
+
+    def raw(self, data):
+        self.md5.update(data)
+
+    def finish(self):
+        self.digest = self.md5.hexdigest()
+        if self.cache:
+            checksum.rememberDigest(self.cache, self.fname, self.digest)
+
+
+class QCConsumer(Consumer):
+    '''
+    The native QC report, see fastqQC.py
+    '''
+    wantsRecords = True
+
+    def __init__(self, fname, odir):
+        self.fname = fname
+        self.odir = odir
+        self.stats = fastqQC.FastqStats()
+
+    def records(self, lines):
+        self.stats.add(lines)
+
+    def finish(self):
+        fastqQC.writeReport(self.stats, self.fname, self.odir)
+
+
+def _mix(x):
+    '''
+    splitmix64 of a uint64 array
+    '''
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class SampleConsumer(Consumer):
+    '''
+    A uniform random sample of n reads (reservoir sampling), written to ofile
+    (uncompressed) in their original order. The random draw for each read
+    only depends on the seed and the read's position in the file, so R1 and
+    R2 of a pair sampled with the same seed keep the same pairs.
+    '''
+    wantsRecords = True
+
+    def __init__(self, ofile, n, seed=123456):
+        self.ofile = ofile
+        self.n = n
+        self.key = _mix(np.array([seed], dtype=np.uint64))
+        self.seen = 0
+        self.reads = []
+        self.order = []
+
+    def records(self, lines):
+        count = len(lines) // 4
+        #Fill the reservoir
+        fill = max(0, min(count, self.n - self.seen))
+        for i in range(fill):
+            self.reads.append(b"\n".join(lines[4 * i:4 * i + 4]))
+            self.order.append(self.seen + i)
+        #Then read j replaces a random one with probability n/(j+1)
+        if fill < count:
+            idx = np.arange(self.seen + fill, self.seen + count, dtype=np.uint64)
+            slots = _mix(idx ^ self.key) % (idx + np.uint64(1))
+            for i in np.nonzero(slots < self.n)[0]:
+                j = 4 * (fill + i)
+                self.reads[slots[i]] = b"\n".join(lines[j:j + 4])
+                self.order[slots[i]] = int(idx[i])
+        self.seen += count
+
+    def finish(self):
+        with open("{}.tmp".format(self.ofile), "wb") as f:
+            for i in np.argsort(self.order, kind="stable"):
+                f.write(self.reads[i])
+                f.write(b"\n")
+        os.replace("{}.tmp".format(self.ofile), self.ofile)
+
+
+def _consume(consumer, q, errors):
+    failed = False
+    while True:
+        item = q.get()
+        if item is None:
+            return
+        if failed:
+            #Keep draining, so the reader isn't blocked
+            continue
+        kind, data = item
+        try:
+            if kind == "raw":
+                consumer.raw(data)
+            else:
+                consumer.records(data)
+        except Exception as e:
+            errors.append(e)
+            failed = True
+
+
+def tee(fname, consumers):
+    '''
+    Read fname once, feeding each consumer. Raises the first error of any
+    consumer (or of reading the file) once everything is done, otherwise
+    calls finish() on each consumer.
+    '''
+    consumers = list(consumers)
+    if not consumers:
+        return
+    errors = []
+    queues = [queue.Queue(maxsize=MAXQUEUED) for c in consumers]
+    threads = [threading.Thread(target=_consume, args=(c, q, errors), daemon=True) for c, q in zip(consumers, queues)]
+    for t in threads:
+        t.start()
+    raws = [q for c, q in zip(consumers, queues) if c.wantsRaw]
+    recs = [q for c, q in zip(consumers, queues) if c.wantsRecords]
+
+    try:
+        with open(fname, "rb") as f:
+            def blocks():
+                while not errors:
+                    data = f.read(CHUNKSIZE)
+                    if not data:
+                        return
+                    for q in raws:
+                        q.put(("raw", data))
+                    yield data
+
+            if recs:
+                for lines in lineBlocks(inflateChunks(blocks())):
+                    for q in recs:
+                        q.put(("records", lines))
+            else:
+                for data in blocks():
+                    pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        for q in queues:
+            q.put(None)
+        for t in threads:
+            t.join()
+
+    if errors:
+        raise errors[0]
+    for c in consumers:
+        c.finish()
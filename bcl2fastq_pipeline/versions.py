@@ -0,0 +1,138 @@
+'''
+This file keeps track of the versions of the software used by the pipeline.
+Probing a version can mean starting a JVM (FastQC, clumpify.sh), so versions
+are cached in a JSON file under [Paths] logDir, keyed on the full path and
+modification time of each executable. A tool is only probed again once it's
+replaced (e.g., upgraded).
+
+getVersions() returns {name: version}, e.g., for reports:
+
+    for name, version in versions.getVersions(config).items():
+        ...
+
+The versions used for a flow cell are also written to its software.versions
+file by get_software_versions() in afterFastq.py.
+'''
+import collections
+import json
+import os
+import shutil
+import subprocess
+import syslog
+import bcl2fastq_pipeline.fastqQC as fastqQC
+
+#The pipeline version, this isn't an executable
+PIPELINE_VERSION = "/bfq_version/bfq.version"
+
+
+def _line(n, field):
+    '''
+    Field "field" of line "n" of the output
+    '''
+    return lambda out: out.split("\n")[n].split(" ")[field].strip()
+
+
+#(name, [section, option] holding the command, default command, arguments, parser, include stderr)
+TOOLS = [
+    ('cellranger', ["cellranger", "cellranger_mkfastq"], "cellranger", "mkfastq --version", lambda out: _line(1, -1)(out).strip("()"), True),
+    ('bcl2fastq', ["bcl2fastq", "bcl2fastq"], "bcl2fastq", "--version", _line(1, 1), True),
+    ('fastq_screen', ["fastq_screen", "fastq_screen_command"], "fastq_screen", "--version", _line(0, -1), False),
+    ('FastQC', ["FastQC", "fastqc_command"], "fastqc", "--version", _line(0, -1), False),
+    ('clumpify/bbmap', ["clumpify", "clumpify_cmd"], "clumpify.sh", "--version", _line(1, -1), True),
+    ('multiqc', ["MultiQC", "multiqc_command"], "multiqc", "--version", _line(0, -1), True),
+]
+
+
+def cacheFile(config):
+    return os.path.join(config.get("Paths", "logDir"), "software.versions.json")
+
+
+def _loadCache(fname):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _saveCache(fname, cache):
+    tmp = "{}.{}".format(fname, os.getpid())
+    try:
+        with open(tmp, "w") as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(tmp, fname)
+    except OSError as e:
+        syslog.syslog("[versions] Couldn't write {} ({})\n".format(fname, e))
+
+
+def _command(config, section, option, default):
+    '''
+    The executable, which may be given with its options in the config file
+    '''
+    cmd = config.get(section, option, fallback=default).split()
+    return cmd[0] if cmd else default
+
+
+def probe(executable, args, parser, stderr):
+    out = subprocess.check_output("{} {}".format(executable, args), shell=True,
+                                  stderr=subprocess.STDOUT if stderr else subprocess.DEVNULL)
+    return parser(out.decode(errors="replace"))
+
+
+def tools(config):
+    '''
+    The tools used by this flow cell
+    '''
+    singleCell = config.get("Options", "SingleCell", fallback="0") == "1"
+    native = config.get("FastQC", "engine", fallback="native") == "native"
+    for tool in TOOLS:
+        name = tool[0]
+        if name == 'cellranger' and not singleCell:
+            continue
+        if name in ['bcl2fastq', 'fastq_screen'] and singleCell:
+            continue
+        if name == 'FastQC' and native:
+            continue
+        yield tool
+
+
+def getVersions(config):
+    '''
+    Returns an ordered {name: version}. Tools that can't be found are left out.
+    '''
+    versions = collections.OrderedDict()
+    try:
+        with open(PIPELINE_VERSION) as f:
+            versions['GCF-NTNU bcl2fastq pipeline'] = f.read().strip()
+    except OSError:
+        pass
+
+    fname = cacheFile(config)
+    cache = _loadCache(fname)
+    changed = False
+    for name, (section, option), default, args, parser, stderr in tools(config):
+        executable = shutil.which(_command(config, section, option, default))
+        if executable is None:
+            syslog.syslog("[versions] Couldn't find {}\n".format(name))
+            continue
+        real = os.path.realpath(executable)
+        key = "{}:{}".format(real, os.stat(real).st_mtime_ns)
+        if key not in cache:
+            try:
+                cache[key] = probe(executable, args, parser, stderr)
+            except (subprocess.CalledProcessError, IndexError) as e:
+                syslog.syslog("[versions] Couldn't get the version of {} ({})\n".format(name, e))
+                continue
+            changed = True
+        versions[name] = cache[key]
+
+    if config.get("FastQC", "engine", fallback="native") == "native":
+        versions['QC'] = "native (FastQC {} format)".format(fastqQC.VERSION)
+
+    if changed:
+        _saveCache(fname, cache)
+    return versions
+
+
+def asText(versions):
+    return '\n'.join('{}: {}'.format(k, v) for k, v in versions.items())
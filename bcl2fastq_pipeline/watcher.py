@@ -0,0 +1,189 @@
+'''
+This file contains an inotify-based watcher that wakes the main loop as soon
+as a sequencer writes one of its run completion files, rather than waiting
+for the next poll.
+
+The instrument data directories (see instruments.getDataDirs()) are watched
+for new run directories and each run directory is watched for the completion markers.
+inotify isn't available on all systems and doesn't see changes made by other
+hosts on network file systems (e.g., NFS), in which case the caller should
+fall back to polling every sleepTime hours.
+
+Options, under [Discovery]:
+  mode       - inotify (default) or poll
+  settleTime - Seconds to wait after a marker appears before waking up, to let
+               the sequencer finish writing (default 5)
+'''
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import syslog
+import threading
+import time
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+#File systems on which inotify won't see changes made by the sequencers
+NETWORK_FS = ['nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'fuse.sshfs', 'lustre', 'gpfs', 'beegfs', 'afs']
+
+
+def fsType(path):
+    '''
+    Return the file system type of the mount holding path, or None
+    '''
+    path = os.path.realpath(path)
+    best = ""
+    fstype = None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                mnt = fields[1].replace("\\040", " ")
+                if (path == mnt or path.startswith(mnt.rstrip("/") + "/")) and len(mnt) >= len(best):
+                    best = mnt
+                    fstype = fields[2]
+    except:
+        return None
+    return fstype
+
+
+def getLibc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except:
+        return None
+    return libc
+
+
+class RunWatcher(threading.Thread):
+    '''
+    Sets wake (a threading.Event) whenever a file named in markers is written
+    to a run directory under one of the watched data directories.
+    '''
+    def __init__(self, libc, markers, wake, settleTime=5):
+        threading.Thread.__init__(self, name="RunWatcher", daemon=True)
+        self.libc = libc
+        self.markers = set(markers)
+        self.wake = wake
+        self.settleTime = settleTime
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.lock = threading.Lock()
+        self.dataDirs = {}
+        self.runDirs = {}
+        self.pending = None
+
+    def _addWatch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "Couldn't watch {}".format(path))
+        return wd
+
+    def _watchRun(self, path):
+        try:
+            self.runDirs[self._addWatch(path, IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ONLYDIR)] = path
+        except OSError:
+            #The directory may have been removed again in the meantime
+            pass
+
+    def watch(self, dataDirs):
+        '''
+        Add the data directories (and the run directories below them) that
+        aren't already being watched. Returns False if any couldn't be added.
+        '''
+        rv = True
+        with self.lock:
+            known = set(self.dataDirs.values())
+            for d in dataDirs:
+                if d in known:
+                    continue
+                try:
+                    self.dataDirs[self._addWatch(d, IN_CREATE | IN_MOVED_TO | IN_ONLYDIR)] = d
+                    for entry in os.scandir(d):
+                        if entry.is_dir():
+                            self._watchRun(entry.path)
+                except OSError as e:
+                    syslog.syslog("[RunWatcher] Couldn't watch {} ({})\n".format(d, e))
+                    rv = False
+                    continue
+                syslog.syslog("[RunWatcher] Watching {}\n".format(d))
+        return rv
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_IGNORED:
+            self.dataDirs.pop(wd, None)
+            self.runDirs.pop(wd, None)
+        elif wd in self.dataDirs and mask & IN_ISDIR:
+            self._watchRun(os.path.join(self.dataDirs[wd], name))
+            #A run directory moved in place may already be complete
+            for m in self.markers:
+                if os.path.exists(os.path.join(self.dataDirs[wd], name, m)):
+                    self.pending = time.time()
+        elif wd in self.runDirs and name in self.markers:
+            self.pending = time.time()
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.pending is not None:
+                timeout = max(0, self.pending + self.settleTime - time.time())
+            r, _, _ = select.select([self.fd], [], [], timeout)
+            if r:
+                try:
+                    buf = os.read(self.fd, 65536)
+                except BlockingIOError:
+                    continue
+                offset = 0
+                with self.lock:
+                    while offset + EVENT_HEADER.size <= len(buf):
+                        wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+                        offset += EVENT_HEADER.size
+                        name = os.fsdecode(buf[offset:offset + length].rstrip(b"\0"))
+                        offset += length
+                        self._handle(wd, mask, name)
+            if self.pending is not None and time.time() >= self.pending + self.settleTime:
+                self.pending = None
+                self.wake.set()
+
+
+def startWatcher(config, dataDirs, markers, wake):
+    '''
+    Start watching the instrument data directories, returns the watcher or
+    None if polling should be used instead.
+    '''
+    if config.get("Discovery", "mode", fallback="inotify") != "inotify":
+        return None
+    libc = getLibc()
+    if libc is None:
+        syslog.syslog("[RunWatcher] inotify is unavailable, falling back to polling\n")
+        return None
+    for d in dataDirs + [config.get("Paths","baseDir")]:
+        fstype = fsType(d)
+        if fstype in NETWORK_FS:
+            syslog.syslog("[RunWatcher] {} is on {}, falling back to polling\n".format(d, fstype))
+            return None
+    try:
+        watcher = RunWatcher(libc, markers, wake, config.getfloat("Discovery", "settleTime", fallback=5))
+    except OSError as e:
+        syslog.syslog("[RunWatcher] Couldn't set up inotify ({}), falling back to polling\n".format(e))
+        return None
+    if not watcher.watch(dataDirs):
+        os.close(watcher.fd)
+        syslog.syslog("[RunWatcher] Falling back to polling\n")
+        return None
+    watcher.start()
+    return watcher
@@ -3,12 +3,28 @@ import sys
 import os
 import datetime
 import time
-import glob
 import syslog
 import bcl2fastq_pipeline.getConfig
-import bcl2fastq_pipeline.findFlowCells
+import flowcell_manager.flowcell_manager
+import bcl2fastq_pipeline.instruments
+import bcl2fastq_pipeline.stages
+import bcl2fastq_pipeline.checksum
+import bcl2fastq_pipeline.dag
+import bcl2fastq_pipeline.splitFastq
+import bcl2fastq_pipeline.shards
+import bcl2fastq_pipeline.watcher
+import bcl2fastq_pipeline.runMetadata
+import bcl2fastq_pipeline.manifest
+import bcl2fastq_pipeline.fastqQC
+import bcl2fastq_pipeline.stream
+import bcl2fastq_pipeline.versions
+import bcl2fastq_pipeline.interop
+import bcl2fastq_pipeline.preflight
+import bcl2fastq_pipeline.demuxStats
+import bcl2fastq_pipeline.scheduler
 import bcl2fastq_pipeline.makeFastq
 import bcl2fastq_pipeline.afterFastq
+import bcl2fastq_pipeline.findFlowCells
 import bcl2fastq_pipeline.misc
 import importlib
 import signal
@@ -23,17 +39,132 @@ def breakSleep(signo, _frame):
     gotHUP.set()
 
 def sleep(config) :
+    #With a watcher running this is just a safety net, it'll set gotHUP when a run finishes
     gotHUP.wait(timeout=float(config['Options']['sleepTime'])*60*60)
     gotHUP.clear()
 
+def processFlowcell(config) :
+    '''
+    Process a single flow cell, this is run by the scheduler in its own process.
+    Returns True if the flow cell was finished.
+    '''
+    lanes = config["Options"]["lanes"]
+    if lanes != "":
+        lanes = "_lanes{}".format(lanes)
+
+    startTime=datetime.datetime.now()
+
+    #Make the fastq files, if not already done
+    if not os.path.exists("{}/{}{}/bcl.done".format(config["Paths"]["outputDir"], config["Options"]["runID"], lanes)):
+        #Check the sample sheet against the index reads before spending hours in bcl2fastq
+        try:
+            with bcl2fastq_pipeline.stages.stage(config, "preflight"):
+                bcl2fastq_pipeline.preflight.preflight(config)
+        except :
+            syslog.syslog("Got an error in preflight\n")
+            bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error in preflight")
+            return False
+
+        try:
+            with bcl2fastq_pipeline.scheduler.slot("bcl2fastq"), bcl2fastq_pipeline.stages.stage(config, "bcl2fq"):
+                bcl2fastq_pipeline.makeFastq.bcl2fq(config)
+            open("{}/{}{}/bcl.done".format(config["Paths"]["outputDir"], config["Options"]["runID"], lanes), "w").close()
+        except :
+            syslog.syslog("Got an error in bcl2fq\n")
+            bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error in bcl2fq")
+            return False
+
+    if not os.path.exists("{}/{}{}/files.renamed".format(config["Paths"]["outputDir"], config["Options"]["runID"], lanes)):
+        try:
+            with bcl2fastq_pipeline.stages.stage(config, "fixNames"):
+                bcl2fastq_pipeline.makeFastq.fixNames(config)
+            open("{}/{}{}/files.renamed".format(config["Paths"]["outputDir"], config["Options"]["runID"], lanes), "w").close()
+        except :
+            syslog.syslog("Got an error in fixNames\n")
+            bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error in fixNames")
+            return False
+
+    #Run post-processing steps
+    try :
+        message = bcl2fastq_pipeline.afterFastq.postMakeSteps(config)
+    except :
+        syslog.syslog("Got an error during postMakeSteps\n")
+        bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error during postMakeSteps")
+        return False
+
+    #Get more statistics and create PDFs
+    try :
+        #message += "\n\n"+bcl2fastq_pipeline.misc.parseConversionStats(config)
+        message += bcl2fastq_pipeline.misc.getFCmetricsImproved(config)
+    except :
+        syslog.syslog("Got an error during parseConversionStats\n")
+        bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error during parseConversionStats")
+        return False
+    endTime = datetime.datetime.now()
+    runTime = endTime-startTime
+
+    #Email finished message
+    try :
+        bcl2fastq_pipeline.misc.finishedEmail(config, message, runTime)
+    except :
+        #Unrecoverable error
+        syslog.syslog("Couldn't send the finished email! Quiting")
+        bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error during finishedEmail()")
+        return False
+
+    #Finalize
+    try:
+        with bcl2fastq_pipeline.scheduler.slot("io"):
+            bcl2fastq_pipeline.afterFastq.finalize(config)
+    except Exception as e:
+        syslog.syslog("Got an error during finalize!\n")
+        bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), str(e))
+        return False
+    finalizeTime = datetime.datetime.now()-endTime
+    runTime += finalizeTime
+    try:
+        bcl2fastq_pipeline.misc.finalizedEmail(config, "", finalizeTime, runTime)
+    except:
+        #Unrecoverable error
+        syslog.syslog("Couldn't send the finalize email! Quiting")
+        bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error during finishedEmail()")
+        return False
+    #Per-stage timings, see stages.py
+    bcl2fastq_pipeline.stages.writeReport(config)
+    #Mark the flow cell as having been processed
+    bcl2fastq_pipeline.findFlowCells.markFinished(config)
+    return True
+
+#A flow cell finishing also sends a SIGHUP, which frees up room for the next one
 signal.signal(signal.SIGHUP, breakSleep)
 
+scheduler = None
+processedCache = None
+watcher = None
+watcherStarted = False
 while True:
-    #Reimport to allow reloading a new version
+    #Reimport to allow reloading a new version. Modules are reloaded before those importing them.
     importlib.reload(bcl2fastq_pipeline.getConfig)
-    importlib.reload(bcl2fastq_pipeline.findFlowCells)
+    importlib.reload(flowcell_manager.flowcell_manager)
+    importlib.reload(bcl2fastq_pipeline.instruments)
+    importlib.reload(bcl2fastq_pipeline.stages)
+    importlib.reload(bcl2fastq_pipeline.checksum)
+    importlib.reload(bcl2fastq_pipeline.dag)
+    importlib.reload(bcl2fastq_pipeline.splitFastq)
+    importlib.reload(bcl2fastq_pipeline.shards)
+    importlib.reload(bcl2fastq_pipeline.watcher)
+    importlib.reload(bcl2fastq_pipeline.runMetadata)
+    importlib.reload(bcl2fastq_pipeline.manifest)
+    importlib.reload(bcl2fastq_pipeline.fastqQC)
+    importlib.reload(bcl2fastq_pipeline.stream)
+    importlib.reload(bcl2fastq_pipeline.versions)
+    importlib.reload(bcl2fastq_pipeline.interop)
+    importlib.reload(bcl2fastq_pipeline.preflight)
+    importlib.reload(bcl2fastq_pipeline.demuxStats)
+    importlib.reload(bcl2fastq_pipeline.scheduler)
     importlib.reload(bcl2fastq_pipeline.makeFastq)
     importlib.reload(bcl2fastq_pipeline.afterFastq)
+    importlib.reload(bcl2fastq_pipeline.findFlowCells)
     importlib.reload(bcl2fastq_pipeline.misc)
 
     #Read the config file
@@ -42,23 +173,34 @@ while True:
         #There's no recovering from this!
         sys.exit("Error: couldn't read the config file!")
 
+    if scheduler is None:
+        scheduler = bcl2fastq_pipeline.scheduler.FlowcellScheduler(config, processFlowcell)
+    else:
+        #Budget changes in [Scheduler] apply to the flow cells started from now on
+        scheduler.configure(config)
+    if processedCache is None:
+        processedCache = bcl2fastq_pipeline.findFlowCells.ProcessedRunCache(os.path.join(config.get("Paths","logDir"), "processed_runs.json"))
+    scheduler.reap()
+
+    registry = bcl2fastq_pipeline.instruments.getRegistry(config)
+    dataDirs = bcl2fastq_pipeline.instruments.getDataDirs(config, registry)
+
+    #Wake up as soon as a completion file appears, if possible. Otherwise just poll.
+    if not watcherStarted:
+        watcher = bcl2fastq_pipeline.watcher.startWatcher(config, dataDirs, bcl2fastq_pipeline.instruments.getMarkers(registry), gotHUP)
+        watcherStarted = True
+    elif watcher is not None:
+        watcher.watch(dataDirs)
+
     #Get the next flow cell to process, or sleep
-    #HiSeq2500
-    dirs = glob.glob("%s/*/data/*_SN7001334_*/ImageAnalysis_Netcopy_complete.txt" % config.get("Paths","baseDir"))
-    #NextSeq 500
-    dirs.extend(glob.glob("%s/*/data/*_NB501038_*/RunCompletionStatus.xml" % config.get("Paths","baseDir")))
-    #MiSeq NTNU
-    dirs.extend(glob.glob("%s/*/data/*_M026575*_*/ImageAnalysis_Netcopy_complete.txt" % config.get("Paths","baseDir")))
-    #MiSeq St. Olav
-    dirs.extend(glob.glob("%s/*/data/*_M03942*_*/ImageAnalysis_Netcopy_complete.txt" % config.get("Paths","baseDir")))
-    #MiSeq SINTEF
-    dirs.extend(glob.glob("%s/*/data/*_M05617*_*/ImageAnalysis_Netcopy_complete.txt" % config.get("Paths","baseDir")))
-    #HiSeq4000
-    dirs.extend(glob.glob("%s/*/data/*_K00251*_*/SequencingComplete.txt" % config.get("Paths","baseDir")))
+    #The sequencers and their completion files are listed in instruments.py and [Instrument ...] sections
+    dirs = bcl2fastq_pipeline.instruments.findCompletedRuns(config)
     for d in dirs :
         config.set('Options','runID',d.split("/")[-2])
         config.set('Options', 'sequencer',d.split("/")[-4])
-        if bcl2fastq_pipeline.findFlowCells.flowCellProcessed(config):
+        if scheduler.isActive(config) or scheduler.isBackingOff(config):
+            continue
+        if bcl2fastq_pipeline.findFlowCells.flowCellProcessed(config, processedCache):
             continue
 
         config = bcl2fastq_pipeline.findFlowCells.newFlowCell(config)
@@ -70,76 +212,12 @@ while True:
             bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Error: insufficient free space!")
             break
 
-        startTime=datetime.datetime.now()
-
-        #Make the fastq files, if not already done
-        lanes = config["Options"]["lanes"]
-        if lanes != "":
-            lanes = "_lanes{}".format(lanes)
-        if not os.path.exists("{}/{}{}/bcl.done".format(config["Paths"]["outputDir"], config["Options"]["runID"], lanes)):
-            try:
-                bcl2fastq_pipeline.makeFastq.bcl2fq(config)
-                open("{}/{}{}/bcl.done".format(config["Paths"]["outputDir"], config["Options"]["runID"], lanes), "w").close()
-            except :
-                syslog.syslog("Got an error in bcl2fq\n")
-                bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error in bcl2fq")
-                continue
-
-        if not os.path.exists("{}/{}{}/files.renamed".format(config["Paths"]["outputDir"], config["Options"]["runID"], lanes)):
-            try:
-                bcl2fastq_pipeline.makeFastq.fixNames(config)
-                open("{}/{}{}/files.renamed".format(config["Paths"]["outputDir"], config["Options"]["runID"], lanes), "w").close()
-            except :
-                syslog.syslog("Got an error in fixNames\n")
-                bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error in fixNames")
-                continue
-
-        #Run post-processing steps
-        try :
-            message = bcl2fastq_pipeline.afterFastq.postMakeSteps(config)
-        except :
-            syslog.syslog("Got an error during postMakeSteps\n")
-            bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error during postMakeSteps")
-            continue
-
-        #Get more statistics and create PDFs
-        try :
-            #message += "\n\n"+bcl2fastq_pipeline.misc.parseConversionStats(config)
-            message += bcl2fastq_pipeline.misc.getFCmetricsImproved(config)
-        except :
-            syslog.syslog("Got an error during parseConversionStats\n")
-            bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error during parseConversionStats")
-            continue
-        endTime = datetime.datetime.now()
-        runTime = endTime-startTime
+        scheduler.submit(bcl2fastq_pipeline.getConfig.copyConfig(config), d)
+    #Written once per poll rather than for every run that was checked
+    processedCache.save()
 
-        #Email finished message
-        try :
-            bcl2fastq_pipeline.misc.finishedEmail(config, message, runTime)
-        except :
-            #Unrecoverable error
-            syslog.syslog("Couldn't send the finished email! Quiting")
-            bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error during finishedEmail()")
-            continue
-
-        #Finalize
-        try:
-            bcl2fastq_pipeline.afterFastq.finalize(config)
-        except Exception as e:
-            syslog.syslog("Got an error during finalize!\n")
-            bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), str(e))
-            continue
-        finalizeTime = datetime.datetime.now()-endTime
-        runTime += finalizeTime
-        try:
-            bcl2fastq_pipeline.misc.finalizedEmail(config, "", finalizeTime, runTime)
-        except:
-            #Unrecoverable error
-            syslog.syslog("Couldn't send the finalize email! Quiting")
-            bcl2fastq_pipeline.misc.errorEmail(config, sys.exc_info(), "Got an error during finishedEmail()")
-            continue
-        #Mark the flow cell as having been processed
-        bcl2fastq_pipeline.findFlowCells.markFinished(config)
+    #Start whatever fits in the budget, the rest waits for a running flow cell to finish
+    scheduler.launch()
 
     #done processing, no more flowcells in queue
     sleep(config)
@@ -4,6 +4,8 @@ import bcl2fastq_pipeline.getConfig
 import sys
 import pandas as pd
 import os
+import csv
+import sqlite3
 import subprocess
 import datetime
 import argparse
@@ -12,32 +14,88 @@ import argparse
 pd.set_option('display.max_rows', 5000)
 pd.set_option('display.max_columns', 6)
 
+COLUMNS = ['project','flowcell_path','timestamp','archived']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS flowcells (
+    id INTEGER PRIMARY KEY,
+    project TEXT NOT NULL,
+    flowcell_path TEXT NOT NULL,
+    timestamp TEXT NOT NULL DEFAULT '0',
+    archived TEXT NOT NULL DEFAULT '0',
+    UNIQUE (flowcell_path, project)
+);
+CREATE INDEX IF NOT EXISTS flowcells_project ON flowcells (project);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def connect(config=None):
+    """
+    Open the inventory (flowcells.db in managerDir), creating it if needed.
+
+    The first time this happens, the rows of the old flowcells.processed CSV
+    file, if any, are imported. That file isn't updated afterwards.
+    """
+    if config is None:
+        config = bcl2fastq_pipeline.getConfig.getConfig()
+    conn = sqlite3.connect(os.path.join(config.get("FlowCellManager","managerDir"),'flowcells.db'), timeout=60, isolation_level=None)
+    conn.executescript(SCHEMA)
+    csv_file = os.path.join(config.get("FlowCellManager","managerDir"),'flowcells.processed')
+    if os.path.exists(csv_file) and not conn.execute("SELECT 1 FROM meta WHERE key = 'csv_imported'").fetchone():
+        import_csv(conn, csv_file)
+    return conn
+
+def import_csv(conn, csv_file, once=True):
+    """
+    Copy the rows of a flowcells.processed CSV file into the inventory. With
+    once=True, this only happens if the meta table doesn't record an earlier
+    import. Projects already listed for a flow cell are left alone, so
+    importing a file again doesn't add anything.
+    """
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        #Someone else may have beaten us to it
+        if not once or not conn.execute("SELECT 1 FROM meta WHERE key = 'csv_imported'").fetchone():
+            with open(csv_file, newline='') as f:
+                rows = [[row.get(c) or '0' for c in COLUMNS] for row in csv.DictReader(f)]
+            conn.executemany("INSERT OR IGNORE INTO flowcells (project, flowcell_path, timestamp, archived) VALUES (?, ?, ?, ?)", rows)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('csv_imported', ?)", (str(datetime.datetime.now()),))
+
+def import_flowcells(**args):
+    conn = connect()
+    try:
+        import_csv(conn, args['csv_file'], once=False)
+    finally:
+        conn.close()
+
+def query(sql, params=()):
+    conn = connect()
+    try:
+        return pd.read_sql_query(sql, conn, params=params)
+    finally:
+        conn.close()
+
 def add_flowcell(**args):
-    config = bcl2fastq_pipeline.getConfig.getConfig()
-    row_list = [
-            {
-            'project': args['project'],
-            'flowcell_path': args['path'],
-            'timestamp': args['timestamp'],
-            'archived': 0
-            }
-            ]
-    df = pd.DataFrame(row_list)
-    flowcells_processed = pd.read_csv(os.path.join(config.get("FlowCellManager","managerDir"),'flowcells.processed'))
-    flowcells_processed = flowcells_processed.append(df,sort=True)
-    flowcells_processed.to_csv(
-            os.path.join(config.get("FlowCellManager","managerDir"),'flowcells.processed'),
-            index=False,
-            columns = ['project','flowcell_path','timestamp', 'archived'],
+    conn = connect()
+    try:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT INTO flowcells (project, flowcell_path, timestamp, archived) VALUES (?, ?, ?, '0') "
+                "ON CONFLICT (flowcell_path, project) DO UPDATE SET timestamp = excluded.timestamp",
+                (args['project'], args['path'], str(args['timestamp'])),
             )
+    finally:
+        conn.close()
 
 
 def archive_flowcell(**args):
     force = args.get("force",False)
     flowcell = args['flowcell']
-    config = bcl2fastq_pipeline.getConfig.getConfig()
-    flowcells_processed = pd.read_csv(os.path.join(config.get("FlowCellManager","managerDir"),'flowcells.processed'))
-    fc_for_deletion = flowcells_processed.loc[flowcells_processed['flowcell_path'] == flowcell]
+    fc_for_deletion = list_flowcell_all(flowcell)
     if fc_for_deletion.empty:
         print("No such flowcell in inventory!")
         return
@@ -53,21 +111,20 @@ def archive_flowcell(**args):
         cmd = "rm -rf {}".format(" ".join(deletions))
         print("DELETING: {}".format(cmd))
         subprocess.check_call(cmd, shell=True)
-        flowcells_processed.loc[flowcells_processed['flowcell_path'] == flowcell,'archived'] = datetime.datetime.now()
-        flowcells_processed.to_csv(
-            os.path.join(config.get("FlowCellManager","managerDir"),'flowcells.processed'),
-            index=False,
-            columns = ['project','flowcell_path','timestamp','archived'],
-            )
+        conn = connect()
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("UPDATE flowcells SET archived = ? WHERE flowcell_path = ?", (str(datetime.datetime.now()), flowcell))
+        finally:
+            conn.close()
     else:
         print("Skipping...")
 
 def rerun_flowcell(**args):
     force = args.get("force",False)
     flowcell = args['flowcell']
-    config = bcl2fastq_pipeline.getConfig.getConfig()
-    flowcells_processed = pd.read_csv(os.path.join(config.get("FlowCellManager","managerDir"),'flowcells.processed'))
-    fc_for_deletion = flowcells_processed.loc[flowcells_processed['flowcell_path'] == flowcell]
+    fc_for_deletion = list_flowcell_all(flowcell)
     if fc_for_deletion.empty:
         print("No such flowcell in inventory!")
         return
@@ -80,39 +137,41 @@ def rerun_flowcell(**args):
         cmd = "rm -rf {}".format(flowcell)
         print("DELETING FLOWCELL: {}".format(cmd))
         subprocess.check_call(cmd, shell=True)
-        flowcells_processed = flowcells_processed.loc[flowcells_processed['flowcell_path'] != flowcell]
-        flowcells_processed.to_csv(
-            os.path.join(config.get("FlowCellManager","managerDir"),'flowcells.processed'),
-            index=False,
-            columns = ['project','flowcell_path','timestamp','archived'],
-            )
+        conn = connect()
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("DELETE FROM flowcells WHERE flowcell_path = ?", (flowcell,))
+        finally:
+            conn.close()
     else:
         print("Skipping...")
 
 def list_processed(**args):
-    config = bcl2fastq_pipeline.getConfig.getConfig()
-    flowcells_processed = pd.read_csv(os.path.join(config.get("FlowCellManager","managerDir"),'flowcells.processed'))
-    return flowcells_processed.loc[(flowcells_processed['timestamp'] != '0') | (flowcells_processed['archived'] != '0')]
+    return query("SELECT project, flowcell_path, timestamp, archived FROM flowcells WHERE timestamp != '0' OR archived != '0' ORDER BY id")
 
 def list_all(**args):
-    config = bcl2fastq_pipeline.getConfig.getConfig()
-    return pd.read_csv(os.path.join(config.get("FlowCellManager","managerDir"),'flowcells.processed'))
+    return query("SELECT project, flowcell_path, timestamp, archived FROM flowcells ORDER BY id")
 
 def list_project(project):
-    config = bcl2fastq_pipeline.getConfig.getConfig()
-    flowcells_processed = pd.read_csv(os.path.join(config.get("FlowCellManager","managerDir"),'flowcells.processed'))
-    return flowcells_processed.loc[(flowcells_processed['project'] == project) & (flowcells_processed['timestamp'] != '0')]
+    return query("SELECT project, flowcell_path, timestamp, archived FROM flowcells WHERE project = ? AND timestamp != '0' ORDER BY id", (project,))
 
 def list_flowcell(flowcell):
-    config = bcl2fastq_pipeline.getConfig.getConfig()
-    flowcells_processed = pd.read_csv(os.path.join(config.get("FlowCellManager","managerDir"),'flowcells.processed'))
-    return flowcells_processed.loc[(flowcells_processed['flowcell_path'] == flowcell) & (flowcells_processed['timestamp'] != '0')]
+    return query("SELECT project, flowcell_path, timestamp, archived FROM flowcells WHERE flowcell_path = ? AND timestamp != '0' ORDER BY id", (flowcell,))
 
 def list_flowcell_all(flowcell):
     #USED TO AVOID RUNNING OLD FLOWCELLS
-    config = bcl2fastq_pipeline.getConfig.getConfig()
-    flowcells_processed = pd.read_csv(os.path.join(config.get("FlowCellManager","managerDir"),'flowcells.processed'))
-    return flowcells_processed.loc[flowcells_processed['flowcell_path'] == flowcell]
+    return query("SELECT project, flowcell_path, timestamp, archived FROM flowcells WHERE flowcell_path = ? ORDER BY id", (flowcell,))
+
+def flowcell_in_inventory(flowcell, config=None):
+    """
+    The same as `not list_flowcell_all(flowcell).empty`, but a single indexed lookup
+    """
+    conn = connect(config)
+    try:
+        return conn.execute("SELECT 1 FROM flowcells WHERE flowcell_path = ? LIMIT 1", (flowcell,)).fetchone() is not None
+    finally:
+        conn.close()
 
 def pretty_print(df):
     print("Project \t Flowcell path \t Timestamp \t Archived")
@@ -145,6 +204,10 @@ if __name__=='__main__':
     parser_list_processed = subparsers.add_parser("list-processed",help="List only flowcells in the inventory file processed by bfq pipeline.")
     parser_list_processed.set_defaults(func=list_processed,print_res=True)
 
+    parser_import = subparsers.add_parser("import",help="Import a flowcells.processed CSV file into the inventory. The one in managerDir is imported automatically.")
+    parser_import.set_defaults(func=import_flowcells)
+    parser_import.add_argument("csv_file",type=str,help="Path to the CSV file.")
+
     args = parser.parse_args()
     if vars(args).get("print_res",False):
         pretty_print(args.func(**vars(args)))
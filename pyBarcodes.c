@@ -5,17 +5,35 @@
 #include <inttypes.h>
 #include <zlib.h>
 #include <stdarg.h>
+#include <unistd.h>
+#include <pthread.h>
 #include "khash.h"
 #define MINCLUSTERS 1000000
 #define THRESHOLD 0.005
-KHASH_MAP_INIT_STR(32, uint32_t)
+//The most cycles that can be packed into a barcode
+#define MAXCYCLES 32
+//The read size for filter and BCL files
+#define CHUNKSIZE (4*1024*1024)
+#define FNAMELEN 16384
+//Barcodes are counted on their 2-bit packed code. Those containing Ns are
+//rare, so they go in a separate hash per N mask (the bits of an N are 0 in
+//the code, as with A), keyed on the mask. Mask 0 is the hash without Ns.
+KHASH_MAP_INIT_INT64(64, uint32_t)
+KHASH_MAP_INIT_INT(nmask, khash_t(64)*)
+
+typedef struct {
+    khash_t(nmask) *masks;
+    khash_t(64) *clean; //masks[0]
+} counter_t;
 
 #define pyBarcodesVersion "0.1.0"
 
-static PyObject *pyGetStats(PyObject *self, PyObject *args);
+static PyObject *pyGetStats(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *pyGetLaneStats(PyObject *self, PyObject *args, PyObject *kwds);
+static PyObject *pyDecode(PyObject *self, PyObject *args);
 
 static PyMethodDef barcodesMethods[] = {
-    {"getStats", (PyCFunction) pyGetStats, METH_VARARGS,
+    {"getStats", (PyCFunction) pyGetStats, METH_VARARGS|METH_KEYWORDS,
 "Get a dictionary of barcodes seen and their frequencies.\n\
 \n\
 Required arguments:\n\
@@ -25,9 +43,14 @@ Required arguments:\n\
 \n\
 Optional arguments:\n\
     lane:    The lane number (defaults to 1).\n\
+    arrays:  If True, return numpy arrays rather than a dictionary.\n\
 \n\
 Returns:\n\
     A dictionary with barcodes as keys and fractional prevalence as values.\n\
+    With arrays=True, a tuple of (codes, nmasks, counts) instead, covering\n\
+    all of the barcodes seen. codes holds the barcodes packed 2 bits per\n\
+    base (A=0, C=1, G=2, T=3, first cycle highest) and nmasks has a bit set\n\
+    for every N (again, first cycle highest). See decode().\n\
 \n\
 >>> from pyBarcodes import getStats\n\
 >>> getStats(`/data/180215_J00182_0064_AHNVNGBBXX', 'HiSeq3000', range([77, 92]), 5)\n\
@@ -38,6 +61,41 @@ Returns:\n\
 'CCTGAGCAGAGGATA': 7.6103925704956055, 'GTACTAGTCTACTCT': 6.675393104553223,\n\
 'AGGCATGAGAGGATA': 4.3499956130981445, 'GTACTAGAGAGGATA': 5.3411946296691895,\n\
 'AAGGCGAAGAGGATA': 8.967890739440918}\n"},
+    {"getLaneStats", (PyCFunction) pyGetLaneStats, METH_VARARGS|METH_KEYWORDS,
+"Get the barcodes seen in each lane and their frequencies. A spread of tiles\n\
+in every lane is examined in parallel, without holding the GIL.\n\
+\n\
+Required arguments:\n\
+    path: The path to the flow cell (it should contain a Data directory).\n\
+    runType: One of HiSeq3000, HiSeq2500, NextSeq or MiSeq.\n\
+    cycles:  The cycles containing the barcodes.\n\
+\n\
+Optional arguments:\n\
+    lanes:   A list of lanes (defaults to all lanes that are present).\n\
+    tiles:   The number of tiles examined per lane, spread evenly over the\n\
+             flow cell (defaults to 8). Up to a million clusters are counted\n\
+             per lane. NextSeq lanes are a single file, so this is ignored.\n\
+    threads: The number of threads to use (defaults to 4).\n\
+    arrays:  If True, return numpy arrays rather than dictionaries.\n\
+\n\
+Returns:\n\
+    A dictionary with lanes as keys and dictionaries (or tuples of arrays)\n\
+    like those returned by getStats() as values.\n\
+\n\
+>>> from pyBarcodes import getLaneStats\n\
+>>> getLaneStats('/data/180215_J00182_0064_AHNVNGBBXX', 'HiSeq3000', range(77, 92), threads=8)\n\
+{1: {'GGCAGAAAGAGGATA': 4.001095771789551, ...}, 2: {...}, ...}\n"},
+    {"decode", (PyCFunction) pyDecode, METH_VARARGS,
+"Convert a packed barcode, as returned by getStats(arrays=True), to a string.\n\
+\n\
+Required arguments:\n\
+    code:   The packed barcode.\n\
+    nmask:  The N mask.\n\
+    length: The number of cycles.\n\
+\n\
+>>> from pyBarcodes import decode\n\
+>>> decode(27, 0, 4)\n\
+'ACGT'\n"},
     {NULL, NULL, 0, NULL}
 };
 
@@ -64,235 +122,314 @@ PyObject *PyString_FromString(const char *v) {
 }
 #endif
 
+/*
+ * BCL files hold a 4 byte cluster count followed by one byte per cluster, the
+ * base in the lower 2 bits and the quality in the rest (0 is an N). Rather
+ * than seeking to each passing cluster in every cycle (which forces zlib to
+ * inflate from the start of the file again on every backwards seek), each
+ * cycle is inflated once, sequentially, up to the last cluster that's needed
+ * and the barcodes are then assembled a column (cycle) at a time, 2 bits per
+ * base.
+ */
+
 //NextSeq 500/550 and MiniSeq
-gzFile *openNextSeqBCLs(char *basePath, int *cycles, int nCycles) {
+void nameNextSeqBCLs(char *fnames, char *basePath, int lane, int *cycles, int nCycles) {
     int i;
-    char fname[16384];
-    gzFile *o = NULL;
-    o = calloc(nCycles, sizeof(FILE*));
-    if(!o) return NULL;
-
     for(i=0; i<nCycles; i++) {
-        sprintf(fname, "%s/Data/Intensities/BaseCalls/L001/%04i.bcl.bgzf", basePath, cycles[i]);
-        o[i] = gzopen(fname, "r");
-        if(!o[i] != Z_NULL) goto error;
+        snprintf(fnames + i * FNAMELEN, FNAMELEN, "%s/Data/Intensities/BaseCalls/L00%i/%04i.bcl.bgzf", basePath, lane, cycles[i]);
     }
-    return o;
-
-error:
-    for(i=0; i<=nCycles; i++) if(o[i] != Z_NULL && o[i] != NULL) gzclose(o[i]);
-    free(o);
-    return NULL;
 }
 
 //HiSeq 2000/2500/3000/4000/X single tile
-gzFile *openHiSeq(char *basePath, int lane, int tile, int *cycles, int nCycles) {
+void nameHiSeqBCLs(char *fnames, char *basePath, int lane, int tile, int *cycles, int nCycles) {
     int i;
-    char fname[16384];
-    gzFile *o = NULL;
-    o = calloc(nCycles, sizeof(FILE*));
-    if(!o) return NULL;
-
     for(i=0; i<nCycles; i++) {
-        sprintf(fname, "%s/Data/Intensities/BaseCalls/L00%i/C%i.1/s_%i_%i.bcl.gz", basePath, lane, cycles[i], lane, tile);
-        o[i] = gzopen(fname, "r");
-        if(!o[i] != Z_NULL) goto error;
+        snprintf(fnames + i * FNAMELEN, FNAMELEN, "%s/Data/Intensities/BaseCalls/L00%i/C%i.1/s_%i_%i.bcl.gz", basePath, lane, cycles[i], lane, tile);
     }
-    return o;
-
-error:
-    for(i=0; i<=nCycles; i++) if(o[i] != Z_NULL && o[i] != NULL) gzclose(o[i]);
-    free(o);
-    return NULL;
 }
 
 //MiSeq runs are the same as HiSeq, except the bcl files aren't compressed
-gzFile *openMiSeq(char *basePath, int tile, int *cycles, int nCycles) {
+void nameMiSeqBCLs(char *fnames, char *basePath, int tile, int *cycles, int nCycles) {
     int i;
-    char fname[16384];
-    gzFile *o = NULL;
-    o = calloc(nCycles, sizeof(FILE*));
-    if(!o) return NULL;
-
     for(i=0; i<nCycles; i++) {
-        sprintf(fname, "%s/Data/Intensities/BaseCalls/L001/C%i.1/s_1_%i.bcl", basePath, cycles[i], tile);
-        o[i] = gzopen(fname, "r");
-        if(!o[i] != Z_NULL) goto error;
+        snprintf(fnames + i * FNAMELEN, FNAMELEN, "%s/Data/Intensities/BaseCalls/L001/C%i.1/s_1_%i.bcl", basePath, cycles[i], tile);
     }
-    return o;
-
-error:
-    for(i=0; i<=nCycles; i++) if(o[i] != Z_NULL && o[i] != NULL) gzclose(o[i]);
-    free(o);
-    return NULL;
 }
 
 //NextSeq 500/550 and MiniSeq
-FILE *openFilterNextSeq(char *basePath) {
-    char fname[16384];
-    sprintf(fname, "%s/Data/Intensities/BaseCalls/L001/s_1.filter", basePath);
+FILE *openFilterNextSeq(char *basePath, int lane) {
+    char fname[FNAMELEN];
+    snprintf(fname, FNAMELEN, "%s/Data/Intensities/BaseCalls/L00%i/s_%i.filter", basePath, lane, lane);
     return fopen(fname, "r");
 }
 
 //HiSeq 2000/2500/3000/4000/X and MiSeq, single tile
 FILE *openFilterHiSeq(char *basePath, int lane, int tile) {
-    char fname[16384];
-    sprintf(fname, "%s/Data/Intensities/BaseCalls/L00%i/s_%i_%i.filter", basePath, lane, lane, tile);
+    char fname[FNAMELEN];
+    snprintf(fname, FNAMELEN, "%s/Data/Intensities/BaseCalls/L00%i/s_%i_%i.filter", basePath, lane, lane, tile);
     return fopen(fname, "r");
 }
 
-void closeBCLs(gzFile *bcls, int nBCLs) {
+//Read the filter file and store the indices of the clusters passing filter
+//(up to maxGood + 1 of them) in *pf, which must be free()d
+//*limit is set to one past the last of those clusters
+//Returns the number of clusters in *pf, -1 on error
+int readFilter(FILE *filterFile, uint32_t maxGood, uint32_t **pf, uint32_t *limit) {
+    uint32_t header[3], nClusters, i, j, n, good = 0;
+    uint8_t *buf = NULL;
+    uint32_t *idx = NULL;
+
+    //The last value in the header is the number of clusters
+    if(fread((void*) header, 4, 3, filterFile) != 3) return -1;
+    nClusters = header[2];
+
+    idx = malloc((maxGood + 1) * sizeof(uint32_t));
+    buf = malloc(CHUNKSIZE);
+    if(!idx || !buf) goto error;
+
+    for(i=0; i<nClusters && good <= maxGood; i+=n) {
+        n = nClusters - i;
+        if(n > CHUNKSIZE) n = CHUNKSIZE;
+        if(fread((void*) buf, 1, n, filterFile) != n) goto error;
+        for(j=0; j<n; j++) {
+            if(buf[j] & 1) {
+                idx[good++] = i + j;
+                if(good > maxGood) break;
+            }
+        }
+    }
+
+    free(buf);
+    *pf = idx;
+    *limit = (good) ? idx[good - 1] + 1 : 0;
+    return good;
+
+error:
+    if(buf) free(buf);
+    if(idx) free(idx);
+    return -1;
+}
+
+//Inflate the first limit clusters of a cycle into buf
+//Returns 1 on error, 0 on success
+int readCycle(char *fname, uint8_t *buf, uint32_t limit) {
+    gzFile fp;
+    uint32_t nClusters, got = 0;
+    int rv;
+
+    fp = gzopen(fname, "rb");
+    if(!fp) return 1;
+    gzbuffer(fp, CHUNKSIZE);
+    if(gzread(fp, (void*) &nClusters, 4) != 4) goto error;
+    if(nClusters < limit) goto error;
+    while(got < limit) {
+        rv = gzread(fp, (void*) (buf + got), limit - got);
+        if(rv <= 0) goto error;
+        got += rv;
+    }
+    gzclose(fp);
+    return 0;
+
+error:
+    gzclose(fp);
+    return 1;
+}
+
+//Fill codes and nmask, with 2 bits and 1 bit per cycle, respectively, for the good clusters listed in pf
+//Returns 1 on error, 0 on success
+int packCycles(char *fnames, int nCycles, uint32_t *pf, uint32_t good, uint32_t limit, uint64_t *codes, uint32_t *nmask) {
+    uint8_t *buf = NULL, byte;
+    uint32_t j;
     int i;
-    for(i=0; i<nBCLs; i++) gzclose(bcls[i]);
-    free(bcls);
+
+    memset(codes, 0, good * sizeof(uint64_t));
+    memset(nmask, 0, good * sizeof(uint32_t));
+    if(!good) return 0;
+
+    buf = malloc(limit);
+    if(!buf) return 1;
+    for(i=0; i<nCycles; i++) {
+        if(readCycle(fnames + i * FNAMELEN, buf, limit)) goto error;
+        for(j=0; j<good; j++) {
+            byte = buf[pf[j]];
+            codes[j] = (codes[j] << 2) | (byte & 3);
+            nmask[j] = (nmask[j] << 1) | (byte == 0);
+        }
+    }
+    free(buf);
+    return 0;
+
+error:
+    free(buf);
+    return 1;
+}
+
+//seq must hold nCycles + 1 characters
+void decodeBarcode(uint64_t code, uint32_t nmask, int nCycles, char *seq) {
+    int i;
+    for(i=nCycles-1; i>=0; i--) {
+        seq[i] = (nmask & 1) ? 'N' : "ACGT"[code & 3];
+        code >>= 2;
+        nmask >>= 1;
+    }
+    seq[nCycles] = '\0';
+}
+
+counter_t *counterInit(void) {
+    int ret;
+    khiter_t k;
+    counter_t *c = calloc(1, sizeof(counter_t));
+    if(!c) return NULL;
+    c->masks = kh_init(nmask);
+    c->clean = kh_init(64);
+    if(!c->masks || !c->clean) goto error;
+    k = kh_put(nmask, c->masks, 0, &ret);
+    if(ret < 0) goto error;
+    kh_value(c->masks, k) = c->clean;
+    return c;
+
+error:
+    if(c->masks) kh_destroy(nmask, c->masks);
+    if(c->clean) kh_destroy(64, c->clean);
+    free(c);
+    return NULL;
+}
+
+void counterDestroy(counter_t *c) {
+    khiter_t k;
+    if(!c) return;
+    for(k = kh_begin(c->masks); k != kh_end(c->masks); k++) {
+        if(kh_exist(c->masks, k)) kh_destroy(64, kh_value(c->masks, k));
+    }
+    kh_destroy(nmask, c->masks);
+    free(c);
 }
 
 //Returns 1 on error, 0 on success
-int getSequence(uint32_t cluster, gzFile *bcls, uint32_t nBCLs, char *seq) {
-    uint8_t byte;
-    uint32_t i;
-
-    for(i=0; i<nBCLs; i++) {
-        gzseek(bcls[i], cluster + 3, SEEK_SET);
-        if(gzread(bcls[i], (void*) &byte, 1) != 1) return 1;
-        if(byte == 0) {
-            seq[i] = 'N';
-        } else {
-            switch(byte & 3) {
-                case 0:
-                    seq[i] = 'A';
-                    break;
-                case 1:
-                    seq[i] = 'C';
-                    break;
-                case 2:
-                    seq[i] = 'G';
-                    break;
-                default:
-                    seq[i] = 'T';
-                    break;
+int counterAdd(counter_t *c, uint64_t code, uint32_t nmask, uint32_t count) {
+    khash_t(64) *h = c->clean;
+    khiter_t k;
+    int ret;
+
+    if(nmask) {
+        k = kh_get(nmask, c->masks, nmask);
+        if(k == kh_end(c->masks)) {
+            h = kh_init(64);
+            if(!h) return 1;
+            k = kh_put(nmask, c->masks, nmask, &ret);
+            if(ret < 0) {
+                kh_destroy(64, h);
+                return 1;
             }
+            kh_value(c->masks, k) = h;
+        } else {
+            h = kh_value(c->masks, k);
         }
     }
 
+    k = kh_put(64, h, code, &ret);
+    if(ret < 0) return 1;
+    if(ret) kh_value(h, k) = 0;
+    kh_value(h, k) += count;
     return 0;
 }
 
-//Return the number of clusters passing filter (up to 1 million), -1 on error
-int commonProcess(FILE *filterFile, gzFile *bcls, khash_t(32) *h, int nCycles) {
+//Add the counts in src to dst. Returns 1 on error, 0 on success
+int counterMerge(counter_t *dst, counter_t *src) {
+    khiter_t k, k2;
+    khash_t(64) *h;
+
+    for(k = kh_begin(src->masks); k != kh_end(src->masks); k++) {
+        if(!kh_exist(src->masks, k)) continue;
+        h = kh_value(src->masks, k);
+        for(k2 = kh_begin(h); k2 != kh_end(h); k2++) {
+            if(!kh_exist(h, k2)) continue;
+            if(counterAdd(dst, kh_key(h, k2), kh_key(src->masks, k), kh_value(h, k2))) return 1;
+        }
+    }
+    return 0;
+}
+
+//The number of distinct barcodes
+uint64_t counterSize(counter_t *c) {
     khiter_t k;
-    int i, ret, good = 0;
-    uint32_t nClusters;
-    uint8_t byte;
-    char *seq = NULL;
+    uint64_t n = 0;
+    for(k = kh_begin(c->masks); k != kh_end(c->masks); k++) {
+        if(kh_exist(c->masks, k)) n += kh_size(kh_value(c->masks, k));
+    }
+    return n;
+}
 
-    seq = malloc(nCycles + 1);
-    if(!seq) return -1;
-    seq[nCycles] = '\0';
+//Return the number of clusters passing filter (up to maxGood + 1), -1 on error
+int commonProcess(FILE *filterFile, char *fnames, counter_t *c, int nCycles, uint32_t maxGood) {
+    int32_t good;
+    uint32_t j, limit, *pf = NULL, *nmask = NULL;
+    uint64_t *codes = NULL;
 
-    //Read in the header
-    if(fread((void*) &nClusters, 4, 1, filterFile) != 1) goto error;
-    if(fread((void*) &nClusters, 4, 1, filterFile) != 1) goto error;
-    if(fread((void*) &nClusters, 4, 1, filterFile) != 1) goto error;
-
-    for(i=0; i<nClusters; i++) {
-        if(fread((void*) &byte, 1, 1, filterFile) != 1) goto error;
-        if(byte & 1) {
-            good++;
-            if(getSequence(i, bcls, nCycles, seq)) goto error;
-
-            //increment the counter
-            k = kh_get(32, h, seq);
-            if(k == kh_end(h)) {
-                k = kh_put(32, h, seq, &ret);
-                kh_value(h, k) = 0;
-                seq = malloc(nCycles + 1);
-                if(!seq) goto error;
-                seq[nCycles] = '\0';
-            }
-            kh_value(h, k)++;
-        }
-        if(good > MINCLUSTERS) break;
+    good = readFilter(filterFile, maxGood, &pf, &limit);
+    if(good < 0) return -1;
+
+    codes = malloc((good + 1) * sizeof(uint64_t));
+    nmask = malloc((good + 1) * sizeof(uint32_t));
+    if(!codes || !nmask) goto error;
+    if(packCycles(fnames, nCycles, pf, good, limit, codes, nmask)) goto error;
+
+    //increment the counters
+    for(j=0; j<(uint32_t) good; j++) {
+        if(counterAdd(c, codes[j], nmask[j], 1)) goto error;
     }
 
-    free(seq);
+    free(pf);
+    free(codes);
+    free(nmask);
     return good;
 
 error:
-    if(seq) free(seq);
+    if(pf) free(pf);
+    if(codes) free(codes);
+    if(nmask) free(nmask);
     return -1;
 }
 
 //Handle NextSeq 500/550 and MiniSeq runs, will only look at lane 1
-//Returns the number of values in *barcodes and *frequencies, which must both be free()d
-int handleNextSeq(char *basePath, int nCycles, int *cycles, char ***barcodes, float **frequencies) {
+//Returns the number of clusters counted in c, -1 on error
+int handleNextSeq(char *basePath, int nCycles, int *cycles, counter_t *c) {
     FILE *filterFile = NULL;
-    gzFile *bcls = NULL;
-    uint32_t i;
-    int good = 0, nBarcodes = 0;
-    khiter_t k;
+    char *fnames = NULL;
+    int good = 0;
 
-    khash_t(32) *h = kh_init(32);
-    filterFile = openFilterNextSeq(basePath);
+    filterFile = openFilterNextSeq(basePath, 1);
     if(!filterFile) goto error;
 
-    bcls = openNextSeqBCLs(basePath, cycles, nCycles);
-    if(!bcls) goto error;
+    fnames = malloc(nCycles * FNAMELEN);
+    if(!fnames) goto error;
+    nameNextSeqBCLs(fnames, basePath, 1, cycles, nCycles);
 
-    good = commonProcess(filterFile, bcls, h, nCycles);
+    good = commonProcess(filterFile, fnames, c, nCycles, MINCLUSTERS);
     if(good == -1) goto error;
 
-    //Count the number of barcodes that will be output
-    for(k = kh_begin(h); k != kh_end(h); k++) {
-        if(kh_exist(h, k)) {
-            if(kh_value(h, k) >= THRESHOLD * good) nBarcodes++;
-        }
-    }
-
-    *barcodes = malloc(nBarcodes * sizeof(char**));
-    *frequencies = malloc(nBarcodes * sizeof(float));
-    if(!*barcodes) goto error;
-    if(!*frequencies) goto error;
-    for(k = kh_begin(h), i = 0; k != kh_end(h); k++) {
-        if(kh_exist(h, k)) {
-            if(kh_value(h, k) >= THRESHOLD * good) {
-                (*frequencies)[i] = (100. * kh_value(h, k)) / good;
-                (*barcodes)[i++] = (char *) kh_key(h, k);
-            } else {
-                free((char*) kh_key(h, k));
-            }
-        }
-    }
-
     fclose(filterFile);
-    closeBCLs(bcls, nCycles);
-    kh_destroy(32, h);
+    free(fnames);
 
-    return nBarcodes;
+    return good;
 
 error:
-    if(bcls) closeBCLs(bcls, nCycles);
+    if(fnames) free(fnames);
     if(filterFile) fclose(filterFile);
-    kh_destroy(32, h);
     return -1;
 }
 
-// Returns the number of values in *barcodes and *frequencies, which must both be free()d
-int handleHiSeq(char *basePath, int lane, int nCycles, int maxSwath, int maxTile, int *cycles, char ***barcodes, float **frequencies) {
+//Returns the number of clusters counted in c, -1 on error
+int handleHiSeq(char *basePath, int lane, int nCycles, int maxSwath, int maxTile, int *cycles, counter_t *c) {
     FILE *filterFile = NULL;
-    gzFile *bcls = NULL;
-    char *seq;
-    uint32_t i, good = 0;
-    int side, swath, tile, tileNum, rv, nBarcodes = 0;
-    khiter_t k;
+    char *fnames = NULL;
+    uint32_t good = 0;
+    int side, swath, tile, tileNum, rv;
 
-    seq = malloc(nCycles + 1);
-    if(!seq) return -1;
-    seq[nCycles] = '\0';
-
-    //This hash will get reused until we've processed up to a million clusters
-    khash_t(32) *h = kh_init(32);
+    fnames = malloc(nCycles * FNAMELEN);
+    if(!fnames) return -1;
 
+    //The counter will get reused until we've processed up to a million clusters
     for(side=1; side<3; side++) {
         for(swath=1; swath<=maxSwath; swath++) {
             for(tile=1; tile<=maxTile; tile++) {
@@ -300,17 +437,14 @@ int handleHiSeq(char *basePath, int lane, int nCycles, int maxSwath, int maxTile
                 filterFile = openFilterHiSeq(basePath, lane, tileNum);
                 if(!filterFile) goto error;
 
-                if(maxSwath > 1) bcls = openHiSeq(basePath, lane, tileNum, cycles, nCycles);
-                else bcls = openMiSeq(basePath, tileNum, cycles, nCycles);
-                if(!bcls) goto error;
+                if(maxSwath > 1) nameHiSeqBCLs(fnames, basePath, lane, tileNum, cycles, nCycles);
+                else nameMiSeqBCLs(fnames, basePath, tileNum, cycles, nCycles);
 
-                rv = commonProcess(filterFile, bcls, h, nCycles);
+                rv = commonProcess(filterFile, fnames, c, nCycles, MINCLUSTERS);
                 if(rv == -1) goto error;
                 good += rv;
 
                 fclose(filterFile);
-                closeBCLs(bcls, nCycles);
-                bcls = NULL;
                 filterFile = NULL;
                 if(good > MINCLUSTERS) break;
             }
@@ -319,39 +453,195 @@ int handleHiSeq(char *basePath, int lane, int nCycles, int maxSwath, int maxTile
         if(good > MINCLUSTERS) break;
     }
 
-    //Count the number of barcodes that will be output
-    for(k = kh_begin(h); k != kh_end(h); k++) {
-        if(kh_exist(h, k)) {
-            if(kh_value(h, k) >= THRESHOLD * good) nBarcodes++;
+    free(fnames);
+
+    return good;
+
+error:
+    free(fnames);
+    if(filterFile) fclose(filterFile);
+    return -1;
+}
+
+/*
+ * The multi-lane census used by getLaneStats(). Each (lane, tile) pair is a
+ * job. A pool of threads takes jobs in turn, each thread counting into its
+ * own counter per lane, and the counters are merged per lane once all of the
+ * jobs are done.
+ */
+typedef struct {
+    int lane;
+    int laneIdx;
+    int tile; //-1 for NextSeq, where all tiles are in one file per lane
+} censusJob_t;
+
+typedef struct {
+    char *basePath;
+    int *cycles;
+    int nCycles;
+    int maxSwath; //0 for NextSeq
+    uint32_t maxGood; //per job
+    censusJob_t *jobs;
+    int nJobs;
+    int nextJob;
+    int nLanes;
+    int error;
+    pthread_mutex_t lock;
+} census_t;
+
+typedef struct {
+    census_t *c;
+    counter_t **h; //one per lane
+    uint64_t *good; //one per lane
+} censusThread_t;
+
+//Returns 1 on error, 0 on success. Tiles without a filter file are skipped.
+int censusJob(census_t *c, censusJob_t *job, char *fnames, counter_t *h, uint64_t *good) {
+    FILE *filterFile = NULL;
+    int rv;
+
+    if(job->tile < 0) {
+        filterFile = openFilterNextSeq(c->basePath, job->lane);
+        if(!filterFile) return 1;
+        nameNextSeqBCLs(fnames, c->basePath, job->lane, c->cycles, c->nCycles);
+    } else {
+        filterFile = openFilterHiSeq(c->basePath, job->lane, job->tile);
+        if(!filterFile) return 0;
+        if(c->maxSwath > 1) nameHiSeqBCLs(fnames, c->basePath, job->lane, job->tile, c->cycles, c->nCycles);
+        else nameMiSeqBCLs(fnames, c->basePath, job->tile, c->cycles, c->nCycles);
+    }
+
+    rv = commonProcess(filterFile, fnames, h, c->nCycles, c->maxGood);
+    fclose(filterFile);
+    if(rv < 0) return 1;
+    *good += rv;
+    return 0;
+}
+
+void *censusWorker(void *arg) {
+    censusThread_t *t = (censusThread_t*) arg;
+    census_t *c = t->c;
+    char *fnames = malloc(c->nCycles * FNAMELEN);
+    int i;
+
+    if(!fnames) {
+        pthread_mutex_lock(&(c->lock));
+        c->error = 1;
+        pthread_mutex_unlock(&(c->lock));
+        return NULL;
+    }
+
+    while(1) {
+        pthread_mutex_lock(&(c->lock));
+        i = (c->error) ? c->nJobs : c->nextJob++;
+        pthread_mutex_unlock(&(c->lock));
+        if(i >= c->nJobs) break;
+
+        if(censusJob(c, c->jobs + i, fnames, t->h[c->jobs[i].laneIdx], t->good + c->jobs[i].laneIdx)) {
+            pthread_mutex_lock(&(c->lock));
+            c->error = 1;
+            pthread_mutex_unlock(&(c->lock));
         }
     }
 
-    *barcodes = malloc(nBarcodes * sizeof(char**));
-    *frequencies = malloc(nBarcodes * sizeof(float));
-    if(!*barcodes) goto error;
-    if(!*frequencies) goto error;
-    for(k = kh_begin(h), i = 0; k != kh_end(h); k++) {
-        if(kh_exist(h, k)) {
-            if(kh_value(h, k) >= THRESHOLD * good) {
-                (*frequencies)[i] = (100. * kh_value(h, k)) / good;
-                (*barcodes)[i++] = (char *) kh_key(h, k);
+    free(fnames);
+    return NULL;
+}
+
+//Run a census over the given lanes, with up to nTiles tiles per lane spread
+//over the flow cell. counters and good (one per lane) are filled in.
+//Returns 1 on error, 0 on success.
+int runCensus(char *basePath, int *cycles, int nCycles, int maxSwath, int maxTile, int *lanes, int nLanes, int nTiles, int nThreads, counter_t **counters, uint64_t *good) {
+    census_t c;
+    censusThread_t *threads = NULL;
+    pthread_t *tids = NULL;
+    int i, j, l, nStarted = 0, totalTiles, tileIdx, side, swath, tile;
+    int rv = 1;
+
+    memset(&c, 0, sizeof(census_t));
+    c.basePath = basePath;
+    c.cycles = cycles;
+    c.nCycles = nCycles;
+    c.maxSwath = maxSwath;
+    c.nLanes = nLanes;
+    if(pthread_mutex_init(&(c.lock), NULL)) return 1;
+
+    totalTiles = 2 * maxSwath * maxTile;
+    if(maxSwath == 0 || nTiles > totalTiles) nTiles = (maxSwath) ? totalTiles : 1;
+    if(nTiles < 1) nTiles = 1;
+    c.maxGood = MINCLUSTERS / nTiles;
+    c.jobs = malloc(nLanes * nTiles * sizeof(censusJob_t));
+    if(!c.jobs) goto cleanup;
+
+    for(l=0; l<nLanes; l++) {
+        for(j=0; j<nTiles; j++) {
+            c.jobs[c.nJobs].lane = lanes[l];
+            c.jobs[c.nJobs].laneIdx = l;
+            if(maxSwath) {
+                //Spread the tiles evenly over the sides and swaths
+                tileIdx = (j * totalTiles) / nTiles;
+                side = 1 + tileIdx / (maxSwath * maxTile);
+                swath = 1 + (tileIdx / maxTile) % maxSwath;
+                tile = 1 + tileIdx % maxTile;
+                c.jobs[c.nJobs].tile = 1000 * side + 100 * swath + tile;
             } else {
-                free((char*) kh_key(h, k));
+                c.jobs[c.nJobs].tile = -1;
             }
+            c.nJobs++;
         }
     }
 
-    kh_destroy(32, h);
-    free(seq);
+    if(nThreads > c.nJobs) nThreads = c.nJobs;
+    if(nThreads < 1) nThreads = 1;
+    threads = calloc(nThreads, sizeof(censusThread_t));
+    tids = calloc(nThreads, sizeof(pthread_t));
+    if(!threads || !tids) goto cleanup;
+    for(i=0; i<nThreads; i++) {
+        threads[i].c = &c;
+        threads[i].h = calloc(nLanes, sizeof(counter_t*));
+        threads[i].good = calloc(nLanes, sizeof(uint64_t));
+        if(!threads[i].h || !threads[i].good) goto cleanup;
+        for(l=0; l<nLanes; l++) {
+            threads[i].h[l] = counterInit();
+            if(!threads[i].h[l]) goto cleanup;
+        }
+    }
 
-    return nBarcodes;
+    for(i=0; i<nThreads; i++) {
+        if(pthread_create(tids + i, NULL, censusWorker, threads + i)) {
+            pthread_mutex_lock(&(c.lock));
+            c.error = 1;
+            pthread_mutex_unlock(&(c.lock));
+            break;
+        }
+        nStarted++;
+    }
+    for(i=0; i<nStarted; i++) pthread_join(tids[i], NULL);
+    if(c.error || nStarted < nThreads) goto cleanup;
 
-error:
-    kh_destroy(32, h);
-    if(seq) free(seq);
-    if(bcls) closeBCLs(bcls, nCycles);
-    if(filterFile) fclose(filterFile);
-    return -1;
+    for(i=0; i<nThreads; i++) {
+        for(l=0; l<nLanes; l++) {
+            if(counterMerge(counters[l], threads[i].h[l])) goto cleanup;
+            good[l] += threads[i].good[l];
+        }
+    }
+    rv = 0;
+
+cleanup:
+    if(threads) {
+        for(i=0; i<nThreads; i++) {
+            if(threads[i].h) {
+                for(l=0; l<nLanes; l++) counterDestroy(threads[i].h[l]);
+                free(threads[i].h);
+            }
+            if(threads[i].good) free(threads[i].good);
+        }
+        free(threads);
+    }
+    if(tids) free(tids);
+    if(c.jobs) free(c.jobs);
+    pthread_mutex_destroy(&(c.lock));
+    return rv;
 }
 
 /********************************************************************
@@ -359,16 +649,105 @@ error:
  * Begin python wrapping stuff
  *
  ********************************************************************/
-static PyObject *pyGetStats(PyObject *self, PyObject *args) {
+//Convert the counts in c to a dictionary of barcode:percentage, for barcodes above THRESHOLD
+PyObject *counterToDict(counter_t *c, uint64_t good, int nCycles) {
+    PyObject *rv = NULL, *key = NULL, *value = NULL;
+    khash_t(64) *h;
+    khiter_t k, k2;
+    char seq[MAXCYCLES + 1];
+
+    rv = PyDict_New();
+    if(!rv) return NULL;
+    for(k = kh_begin(c->masks); k != kh_end(c->masks); k++) {
+        if(!kh_exist(c->masks, k)) continue;
+        h = kh_value(c->masks, k);
+        for(k2 = kh_begin(h); k2 != kh_end(h); k2++) {
+            if(!kh_exist(h, k2)) continue;
+            if(kh_value(h, k2) < THRESHOLD * good) continue;
+            decodeBarcode(kh_key(h, k2), kh_key(c->masks, k), nCycles, seq);
+            key = PyString_FromString(seq);
+            value = PyFloat_FromDouble((100. * kh_value(h, k2)) / good);
+            if(!key || !value || PyDict_SetItem(rv, key, value)) goto error;
+            Py_DECREF(key);
+            Py_DECREF(value);
+        }
+    }
+    return rv;
+
+error:
+    Py_XDECREF(key);
+    Py_XDECREF(value);
+    Py_DECREF(rv);
+    return NULL;
+}
+
+//A numpy array of the given dtype, holding a copy of data
+PyObject *toArray(PyObject *np, void *data, Py_ssize_t size, const char *dtype) {
+    PyObject *buf, *rv;
+    buf = PyByteArray_FromStringAndSize((const char *) data, size);
+    if(!buf) return NULL;
+    rv = PyObject_CallMethod(np, "frombuffer", "Os", buf, dtype);
+    Py_DECREF(buf);
+    return rv;
+}
+
+//Convert the counts in c to a tuple of numpy arrays: (codes, nmasks, counts)
+//numpy is only imported here, so it's not needed otherwise
+PyObject *counterToArrays(counter_t *c) {
+    PyObject *np = NULL, *codesObj = NULL, *masksObj = NULL, *countsObj = NULL, *rv = NULL;
+    uint64_t n = counterSize(c), i = 0;
+    uint64_t *codes = NULL;
+    uint32_t *masks = NULL, *counts = NULL;
+    khash_t(64) *h;
+    khiter_t k, k2;
+
+    np = PyImport_ImportModule("numpy");
+    if(!np) return NULL;
+
+    codes = malloc((n + 1) * sizeof(uint64_t));
+    masks = malloc((n + 1) * sizeof(uint32_t));
+    counts = malloc((n + 1) * sizeof(uint32_t));
+    if(!codes || !masks || !counts) {
+        PyErr_SetString(PyExc_RuntimeError, "Ran out of memory!");
+        goto cleanup;
+    }
+    for(k = kh_begin(c->masks); k != kh_end(c->masks); k++) {
+        if(!kh_exist(c->masks, k)) continue;
+        h = kh_value(c->masks, k);
+        for(k2 = kh_begin(h); k2 != kh_end(h); k2++) {
+            if(!kh_exist(h, k2)) continue;
+            codes[i] = kh_key(h, k2);
+            masks[i] = kh_key(c->masks, k);
+            counts[i++] = kh_value(h, k2);
+        }
+    }
+
+    codesObj = toArray(np, codes, n * sizeof(uint64_t), "u8");
+    masksObj = toArray(np, masks, n * sizeof(uint32_t), "u4");
+    countsObj = toArray(np, counts, n * sizeof(uint32_t), "u4");
+    if(codesObj && masksObj && countsObj) rv = PyTuple_Pack(3, codesObj, masksObj, countsObj);
+
+cleanup:
+    Py_XDECREF(codesObj);
+    Py_XDECREF(masksObj);
+    Py_XDECREF(countsObj);
+    Py_DECREF(np);
+    if(codes) free(codes);
+    if(masks) free(masks);
+    if(counts) free(counts);
+    return rv;
+}
+
+static PyObject *pyGetStats(PyObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwd_list[] = {"path", "runType", "cycles", "lane", "arrays", NULL};
     char *basePath = NULL;
     char *runType = NULL;
-    PyObject *listObj = NULL, *item = NULL, *rv = NULL, *key = NULL, *value = NULL;
-    int lane = 1;
-    int *cycles = NULL, nCycles, i, nBarcodes = -1;
-    char **barcodes = NULL;
-    float *frequencies = NULL;
+    PyObject *listObj = NULL, *item = NULL, *rv = NULL;
+    int lane = 1, arrays = 0;
+    int *cycles = NULL, nCycles, i, good = -1;
+    counter_t *c = NULL;
 
-    if(!(PyArg_ParseTuple(args, "ssO|i", &basePath, &runType, &listObj, &lane))) {
+    if(!(PyArg_ParseTupleAndKeywords(args, kwds, "ssO|ip", kwd_list, &basePath, &runType, &listObj, &lane, &arrays))) {
         PyErr_SetString(PyExc_RuntimeError, "You must supply at least a path, a run type and a list of cycles.");
         return NULL;
     }
@@ -387,60 +766,192 @@ static PyObject *pyGetStats(PyObject *self, PyObject *args) {
     }
 
     //set up the bounds
-    if(PySequence_Check(listObj)) nCycles = PySequence_Size(listObj);
-    else nCycles = PySequence_Size(listObj);
+    if(!PySequence_Check(listObj)) {
+        PyErr_SetString(PyExc_RuntimeError, "The cycles must be a list.");
+        return NULL;
+    }
+    nCycles = PySequence_Size(listObj);
+    if(nCycles < 1 || nCycles > MAXCYCLES) {
+        PyErr_SetString(PyExc_RuntimeError, "Between 1 and 32 barcode cycles must be given.");
+        return NULL;
+    }
     cycles = malloc(nCycles * sizeof(int));
-    if(!cycles) {
+    c = counterInit();
+    if(!cycles || !c) {
         PyErr_SetString(PyExc_RuntimeError, "Ran out of memory!");
-        return NULL;
+        goto cleanup;
     }
     for(i=0; i<nCycles; i++) {
-        if(PySequence_Check(listObj)) item = PySequence_GetItem(listObj, i);
-        else item = PyList_GET_ITEM(listObj, i);
-        if(!PyLong_Check(item)) goto error;
+        item = PySequence_GetItem(listObj, i);
+        if(!item || !PyLong_Check(item)) goto error;
         cycles[i] = (int) PyLong_AsLong(item);
+        Py_DECREF(item);
+        item = NULL;
     }
 
-    if(strcmp(runType, "NextSeq") == 0) nBarcodes = handleNextSeq(basePath, nCycles, cycles, &barcodes, &frequencies);
+    if(strcmp(runType, "NextSeq") == 0) good = handleNextSeq(basePath, nCycles, cycles, c);
     else if(strcmp(runType, "HiSeq3000") == 0 || \
             strcmp(runType, "HiSeq4000") == 0 || \
-            strcmp(runType, "HiSeqX") == 0) nBarcodes = handleHiSeq(basePath, lane, nCycles, 2, 28, cycles, &barcodes, &frequencies);
+            strcmp(runType, "HiSeqX") == 0) good = handleHiSeq(basePath, lane, nCycles, 2, 28, cycles, c);
     else if(strcmp(runType, "HiSeq2500") == 0 || \
-            strcmp(runType, "HiSeq2000") == 0) nBarcodes = handleHiSeq(basePath, lane, nCycles, 2, 16, cycles, &barcodes, &frequencies);
-    else if(strcmp(runType, "MiSeq") == 0) nBarcodes = handleHiSeq(basePath, 1, nCycles, 1, 19, cycles, &barcodes, &frequencies);
-    if(nBarcodes < 0) goto error;
+            strcmp(runType, "HiSeq2000") == 0) good = handleHiSeq(basePath, lane, nCycles, 2, 16, cycles, c);
+    else if(strcmp(runType, "MiSeq") == 0) good = handleHiSeq(basePath, 1, nCycles, 1, 19, cycles, c);
+    if(good < 0) goto error;
 
-    // Create a dictionary with barcodes as keys and frequencies as views
-    rv = PyDict_New();
-    if(!rv) goto error;
-    if(nBarcodes) {
-        for(i=0; i<nBarcodes; i++) {
-            key = PyString_FromString(barcodes[i]);
-            if(!key) goto error;
-            value = PyFloat_FromDouble((double) frequencies[i]);
-            if(!value) goto error;
-            if(PyDict_SetItem(rv, key, value)) goto error;
-            free(barcodes[i]);
+    // Create a dictionary with barcodes as keys and frequencies as values, or the arrays
+    if(arrays) rv = counterToArrays(c);
+    else rv = counterToDict(c, good, nCycles);
+    goto cleanup;
+
+error:
+    PyErr_SetString(PyExc_RuntimeError, "Received an error while parsing the BCL files!");
+cleanup:
+    Py_XDECREF(item);
+    if(cycles) free(cycles);
+    counterDestroy(c);
+
+    return rv;
+}
+
+static PyObject *pyGetLaneStats(PyObject *self, PyObject *args, PyObject *kwds) {
+    static char *kwd_list[] = {"path", "runType", "cycles", "lanes", "tiles", "threads", "arrays", NULL};
+    char *basePath = NULL;
+    char *runType = NULL;
+    char dname[FNAMELEN];
+    PyObject *listObj = NULL, *laneObj = Py_None, *item = NULL, *rv = NULL, *key = NULL, *value = NULL;
+    int *cycles = NULL, *lanes = NULL, nCycles, nLanes = 0, i, nTiles = 8, nThreads = 4, maxSwath, maxTile, maxLane, err, arrays = 0;
+    counter_t **counters = NULL;
+    uint64_t *good = NULL;
+
+    if(!(PyArg_ParseTupleAndKeywords(args, kwds, "ssO|Oiip", kwd_list, &basePath, &runType, &listObj, &laneObj, &nTiles, &nThreads, &arrays))) {
+        PyErr_SetString(PyExc_RuntimeError, "You must supply at least a path, a run type and a list of cycles.");
+        return NULL;
+    }
+
+    if(strcmp(runType, "NextSeq") == 0) {
+        maxSwath = 0; maxTile = 0; maxLane = 4;
+    } else if(strcmp(runType, "HiSeq3000") == 0 || strcmp(runType, "HiSeq4000") == 0 || strcmp(runType, "HiSeqX") == 0) {
+        maxSwath = 2; maxTile = 28; maxLane = 8;
+    } else if(strcmp(runType, "HiSeq2500") == 0 || strcmp(runType, "HiSeq2000") == 0) {
+        maxSwath = 2; maxTile = 16; maxLane = 8;
+    } else if(strcmp(runType, "MiSeq") == 0) {
+        maxSwath = 1; maxTile = 19; maxLane = 1;
+    } else {
+        PyErr_SetString(PyExc_RuntimeError, "The run type must be one of NextSeq, HiSeq2500, HiSeq3000, or MiSeq");
+        return NULL;
+    }
+
+    if(!PySequence_Check(listObj) || (laneObj != Py_None && !PySequence_Check(laneObj))) {
+        PyErr_SetString(PyExc_RuntimeError, "The cycles and lanes must be lists.");
+        return NULL;
+    }
+
+    nCycles = PySequence_Size(listObj);
+    if(nCycles < 1 || nCycles > MAXCYCLES) {
+        PyErr_SetString(PyExc_RuntimeError, "Between 1 and 32 barcode cycles must be given.");
+        return NULL;
+    }
+    cycles = malloc(nCycles * sizeof(int));
+    lanes = malloc(8 * sizeof(int));
+    if(!cycles || !lanes) goto nomem;
+    for(i=0; i<nCycles; i++) {
+        item = PySequence_GetItem(listObj, i);
+        if(!item || !PyLong_Check(item)) goto error;
+        cycles[i] = (int) PyLong_AsLong(item);
+        Py_DECREF(item);
+        item = NULL;
+    }
+
+    //By default, all of the lanes that are present
+    if(laneObj == Py_None) {
+        for(i=1; i<=maxLane; i++) {
+            snprintf(dname, FNAMELEN, "%s/Data/Intensities/BaseCalls/L00%i", basePath, i);
+            if(access(dname, R_OK) == 0) lanes[nLanes++] = i;
+        }
+    } else {
+        if(PySequence_Size(laneObj) > 8) goto error;
+        for(i=0; i<PySequence_Size(laneObj); i++) {
+            item = PySequence_GetItem(laneObj, i);
+            if(!item || !PyLong_Check(item)) goto error;
+            lanes[nLanes] = (int) PyLong_AsLong(item);
+            Py_DECREF(item);
+            item = NULL;
+            if(lanes[nLanes] < 1 || lanes[nLanes] > maxLane) {
+                PyErr_SetString(PyExc_RuntimeError, "You have specified a lane that this run type doesn't have.");
+                goto cleanup;
+            }
+            nLanes++;
         }
-        free(barcodes);
-        free(frequencies);
     }
-    free(cycles);
 
+    counters = calloc(nLanes + 1, sizeof(counter_t*));
+    good = calloc(nLanes + 1, sizeof(uint64_t));
+    if(!counters || !good) goto nomem;
+    for(i=0; i<nLanes; i++) {
+        counters[i] = counterInit();
+        if(!counters[i]) goto nomem;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    err = runCensus(basePath, cycles, nCycles, maxSwath, maxTile, lanes, nLanes, nTiles, nThreads, counters, good);
+    Py_END_ALLOW_THREADS
+    if(err) goto error;
+
+    rv = PyDict_New();
+    if(!rv) goto cleanup;
+    for(i=0; i<nLanes; i++) {
+        key = PyLong_FromLong(lanes[i]);
+        if(arrays) value = counterToArrays(counters[i]);
+        else value = counterToDict(counters[i], good[i], nCycles);
+        if(!key || !value || PyDict_SetItem(rv, key, value)) goto cleanup;
+        Py_DECREF(key);
+        Py_DECREF(value);
+        key = NULL;
+        value = NULL;
+    }
+
+    for(i=0; i<nLanes; i++) counterDestroy(counters[i]);
+    free(counters);
+    free(good);
+    free(cycles);
+    free(lanes);
     return rv;
 
+nomem:
+    PyErr_SetString(PyExc_RuntimeError, "Ran out of memory!");
+    goto cleanup;
 error:
     PyErr_SetString(PyExc_RuntimeError, "Received an error while parsing the BCL files!");
+cleanup:
+    Py_XDECREF(item);
+    Py_XDECREF(key);
+    Py_XDECREF(value);
+    Py_XDECREF(rv);
+    if(counters) {
+        for(i=0; i<nLanes; i++) counterDestroy(counters[i]);
+        free(counters);
+    }
+    if(good) free(good);
     if(cycles) free(cycles);
-    if(barcodes) free(barcodes);
-    if(frequencies) free(frequencies);
-    if(rv) Py_DECREF(rv);
-    if(key) Py_DECREF(key);
-    if(value) Py_DECREF(value);
-
+    if(lanes) free(lanes);
     return NULL;
 }
 
+static PyObject *pyDecode(PyObject *self, PyObject *args) {
+    unsigned long long code;
+    unsigned int nmask;
+    int length;
+    char seq[MAXCYCLES + 1];
+
+    if(!(PyArg_ParseTuple(args, "KIi", &code, &nmask, &length))) return NULL;
+    if(length < 1 || length > MAXCYCLES) {
+        PyErr_SetString(PyExc_RuntimeError, "The length must be between 1 and 32.");
+        return NULL;
+    }
+    decodeBarcode((uint64_t) code, (uint32_t) nmask, length, seq);
+    return PyString_FromString(seq);
+}
+
 #if PY_MAJOR_VERSION >= 3
 PyMODINIT_FUNC PyInit_pyBarcodes(void) {
 #else
@@ -3,7 +3,7 @@ from setuptools import setup, Extension
 from distutils import sysconfig
 
 srcs = ["pyBarcodes.c"]
-libs=["z"]
+libs=["z", "pthread"]
 if sysconfig.get_config_vars('BLDLIBRARY') is not None:
     #Note the "-l" prefix!
     for e in sysconfig.get_config_vars('BLDLIBRARY')[0].split():